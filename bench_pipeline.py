@@ -0,0 +1,369 @@
+"""
+End-to-end benchmark of build_dataset.py on a synthetic corpus, fully offline.
+
+    python bench_pipeline.py                             # 12 repos x 4 notebooks, search/triage/run
+    python bench_pipeline.py --repos 40 --stages search,triage
+    python bench_pipeline.py --compare a.json b.json     # per-stage deltas between two results
+
+Generates local git repos whose notebooks vary in size, cell count and
+imports, carry image outputs, read data paths that are present or missing,
+and include failing, slow and Colab-only notebooks. A stub GitHub API
+serves them to gh_search (GITHUB_API_URL) and clones come from file://
+remotes (NB_GIT_REMOTE_BASE). Each stage runs as a subprocess in a scratch
+copy of this tree with its own HOME, JUPYTER_DATA_DIR (kernelspecs),
+pip/uv caches, mirror cache and wheelhouse, so the real store, caches,
+envs and kernelspecs are untouched.
+
+Per stage: wall time, notebooks/sec, peak RSS of the stage process, and
+bytes on disk under work/, cache/, artifacts/ and the store. Results are
+written to artifacts/bench/<commit>-<time>.json.
+
+Nothing is fetched from the network (PIP_NO_INDEX, UV_OFFLINE): the run
+stage installs from a scratch wheelhouse hardlinked from NB_WHEELHOUSE or
+cache/wheels, which must already hold the base packages; --base-pkgs
+picks a smaller base.
+Same seed and parameters give the same corpus.
+"""
+import os, sys, json, site, time, random, shutil, pathlib, argparse, tempfile, threading, subprocess
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from typing import Any, Dict, List, Optional
+
+import nbformat
+import bench_triage
+from store import DatasetStore
+
+HERE = pathlib.Path(__file__).resolve().parent
+RESULTS = HERE / "artifacts" / "bench"
+STAGES = ("search", "triage", "run")
+ORG = "bench"
+
+# Notebook kinds and their weights in the corpus.
+KINDS = {"plain": 4, "data_ok": 2, "data_missing": 2, "fail": 1, "slow": 1, "colab": 1}
+# Unlike bench_triage's snippets, these must run (given the PREAMBLE cell).
+SNIPPETS = [
+    "import numpy as np", "import json, os, math", "x = np.arange(100).reshape(10, 10)",
+    "for i in range(5):\n    print(i, math.sqrt(i))", "y = (x @ x.T).sum()", "d = {'a': 1}\njson.dumps(d)",
+    "def f(a, b):\n    return a + b\nf(1, 2)", "print('done')",
+]
+
+
+def _git(args: List[str], cwd=None):
+    subprocess.run(["git", "-c", "user.name=bench", "-c", "user.email=bench@localhost", *args],
+                   cwd=cwd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+# Snippets may use x/f in any order, so they are defined up front; only the "fail" kind should fail.
+PREAMBLE = "import numpy as np\nimport json, os, math\nx = np.arange(100).reshape(10, 10)\ndef f(a, b):\n    return a + b"
+
+
+def synth_notebook(rng: random.Random, kind: str, max_cells: int, image_kb: int, slow_seconds: float):
+    """bench_triage's synthetic notebook with runnable snippets, plus the cells that make it a `kind`."""
+    nb = bench_triage.synth_notebook(rng, max_cells, image_kb, snippets=SNIPPETS, max_lines=6)
+    nb.metadata["kernelspec"] = {"name": "python3", "display_name": "Python 3", "language": "python"}
+    nb.cells.insert(0, nbformat.v4.new_code_cell(PREAMBLE))
+    extra = {
+        "data_ok": "rows = open('data/train.csv').read().splitlines()\nlen(rows)",
+        "data_missing": "rows = open('data/missing.csv').read().splitlines()",
+        "fail": "raise ValueError('bench: failing cell')",
+        "slow": f"import time\ntime.sleep({slow_seconds})",
+        "colab": "from google.colab import drive\ndrive.mount('/content/drive')",
+    }.get(kind)
+    if extra:
+        nb.cells.insert(rng.randint(1, len(nb.cells)), nbformat.v4.new_code_cell(extra))
+    nb.cells.append(nbformat.v4.new_code_cell(
+        "from IPython.display import Image, display\ndisplay(Image(data=bytes(range(256)) * 16, format='png'))"))
+    return nb
+
+
+def synth_corpus(root: pathlib.Path, n_repos: int, nbs_per_repo: int, seed: int = 0, max_cells: int = 30,
+                 image_kb: int = 50, slow_seconds: float = 3.0) -> List[Dict[str, Any]]:
+    """Bare repos under root/remotes/<ORG>/; returns the stub's repo records (with their trees)."""
+    rng = random.Random(seed)
+    repos = []
+    for i in range(n_repos):
+        name = f"{ORG}/repo{i:03d}"
+        src = root / "src" / name
+        src.mkdir(parents=True)
+        (src / "data").mkdir()
+        (src / "data" / "train.csv").write_text("a,b\n" + "".join(f"{j},{j * j}\n" for j in range(rng.randint(10, 500))))
+
+        def make(r: random.Random):
+            kind = r.choices(list(KINDS), weights=list(KINDS.values()))[0]
+            return synth_notebook(r, kind, max_cells, image_kb, slow_seconds), kind
+
+        bench_triage.synth_corpus(src, nbs_per_repo, seed=rng.randrange(1 << 32), make=make)
+        _git(["init", "-q", "-b", "main"], cwd=src)
+        _git(["add", "-A"], cwd=src)
+        _git(["commit", "-q", "-m", "synthetic corpus"], cwd=src)
+        bare = root / "remotes" / f"{name}.git"
+        _git(["clone", "-q", "--bare", str(src), str(bare)])
+        tree = []
+        for line in subprocess.run(["git", "-C", str(bare), "ls-tree", "-r", "-t", "-l", "HEAD"],
+                                   capture_output=True, text=True, check=True).stdout.splitlines():
+            meta, path = line.split("\t", 1)
+            _, typ, _, size = meta.split()
+            tree.append({"path": path, "type": typ, **({"size": int(size)} if typ == "blob" else {})})
+        repos.append({"full_name": name, "html_url": f"https://github.com/{name}", "default_branch": "main",
+                      "stargazers_count": n_repos - i, "pushed_at": "2024-01-01T00:00:00Z", "tree": tree})
+    return repos
+
+
+class StubGitHub:
+    """The bits of the GitHub REST API gh_search uses: repo search (paginated), repos and recursive trees."""
+
+    def __init__(self, repos: List[Dict[str, Any]]):
+        self.repos = {r["full_name"]: r for r in repos}
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *a):
+                pass
+
+            def do_GET(self):
+                stub._get(self)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @staticmethod
+    def _public(r: Dict[str, Any]) -> Dict[str, Any]:
+        return {k: v for k, v in r.items() if k != "tree"}
+
+    def _get(self, h: BaseHTTPRequestHandler):
+        u, link = urlparse(h.path), ""
+        q = parse_qs(u.query)
+        parts = u.path.strip("/").split("/")
+        if u.path == "/search/repositories":
+            per, page = int(q.get("per_page", ["30"])[0]), int(q.get("page", ["1"])[0])
+            items = list(self.repos.values())
+            body = {"total_count": len(items), "items": [self._public(r) for r in items[(page - 1) * per:page * per]]}
+            if page * per < len(items):
+                link = f'<{self.url}/search/repositories?q=bench&per_page={per}&page={page + 1}>; rel="next"'
+        elif parts[:1] == ["repos"] and "/".join(parts[1:3]) in self.repos:
+            r = self.repos["/".join(parts[1:3])]
+            body = {"sha": "0" * 40, "tree": r["tree"], "truncated": False} if parts[3:5] == ["git", "trees"] else self._public(r)
+        else:
+            h.send_response(404)
+            h.end_headers()
+            return
+        data = json.dumps(body).encode()
+        h.send_response(200)
+        h.send_header("Content-Type", "application/json")
+        h.send_header("X-RateLimit-Remaining", "5000")
+        h.send_header("X-RateLimit-Reset", str(int(time.time()) + 3600))
+        if link:
+            h.send_header("Link", link)
+        h.send_header("Content-Length", str(len(data)))
+        h.end_headers()
+        h.wfile.write(data)
+
+    def close(self):
+        self.server.shutdown()
+
+
+def _du(path: pathlib.Path) -> int:
+    if path.is_file():
+        return path.stat().st_size
+    total = 0
+    for dirpath, _, files in os.walk(path):
+        for fn in files:
+            try:
+                total += os.lstat(os.path.join(dirpath, fn)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def _disk(tree: pathlib.Path) -> Dict[str, int]:
+    out = {d: _du(tree / d) for d in ("work", "cache", "artifacts")}
+    out["store"] = sum(_du(p) for p in tree.glob("notebook_dataset.sqlite*"))
+    return out
+
+
+def _processed(stage: str, tree: pathlib.Path) -> Dict[str, Any]:
+    """Notebooks a stage got through, from what it left behind."""
+    if stage == "search":
+        log = tree / "artifacts" / "candidates.jsonl"
+        return {"notebooks": sum(1 for _ in open(log)) if log.exists() else 0}
+    db = tree / "notebook_dataset.sqlite"
+    if not db.exists():
+        return {"notebooks": 0}
+    store = DatasetStore(db)
+    try:
+        if stage == "triage":
+            return {"notebooks": store.count(), "runnable": len(store.candidates())}
+        rows = store.rows("runtime_seconds IS NOT NULL")
+        return {"notebooks": len(rows), "status": dict(Counter(r["status"] for r in rows))}
+    finally:
+        store.close()
+
+
+def run_stage(stage: str, argv: List[str], tree: pathlib.Path, env: Dict[str, str]) -> Dict[str, Any]:
+    log = tree / f"bench-{stage}.log"
+    with open(log, "w") as f:
+        t = time.perf_counter()
+        p = subprocess.Popen([sys.executable, "build_dataset.py", stage, *argv], cwd=tree, env=env,
+                             stdout=f, stderr=subprocess.STDOUT)
+        if hasattr(os, "wait4"):
+            _, status, ru = os.wait4(p.pid, 0)
+            p.returncode = os.waitstatus_to_exitcode(status)
+            rss_mb: Optional[float] = ru.ru_maxrss / 1024   # KiB on Linux
+        else:
+            p.wait()
+            rss_mb = None
+        secs = time.perf_counter() - t
+    res = dict(seconds=round(secs, 2), rc=p.returncode, peak_rss_mb=rss_mb and round(rss_mb, 1), **_processed(stage, tree))
+    res["nb_per_sec"] = round(res["notebooks"] / secs, 2) if secs else 0.0
+    res["disk_bytes"] = _disk(tree)
+    if p.returncode:
+        res["log_tail"] = log.read_text(errors="replace")[-2000:]
+    return res
+
+
+def _commit() -> str:
+    try:
+        sha = subprocess.run(["git", "-C", str(HERE), "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip()
+        dirty = subprocess.run(["git", "-C", str(HERE), "status", "--porcelain", "--untracked-files=no"],
+                               capture_output=True, text=True).stdout.strip()
+        return (sha or "unknown") + ("-dirty" if dirty else "")
+    except OSError:
+        return "unknown"
+
+
+def _link_tree(src: pathlib.Path, dst: pathlib.Path):
+    """Copy of src made of hardlinks where possible: new wheels land in dst, src is only read."""
+    dst.mkdir(parents=True, exist_ok=True)
+    if not src.is_dir():
+        return
+
+    def link(a, b):
+        try:
+            os.link(a, b)
+        except OSError:
+            shutil.copy2(a, b)
+
+    shutil.copytree(src, dst, copy_function=link, dirs_exist_ok=True)
+
+
+def _scratch_env(root: pathlib.Path, tree: pathlib.Path) -> Dict[str, str]:
+    """
+    os.environ pointed away from everything outside the scratch dir:
+    HOME/XDG dirs (ipykernel install --user writes kernelspecs there),
+    JUPYTER_DATA_DIR, pip/uv caches, and no inherited NB_* or GitHub settings.
+    User-site packages stay importable through PYTHONUSERBASE.
+    """
+    home = root / "home"
+    env = {k: v for k, v in os.environ.items()
+           if not k.startswith(("NB_", "GITHUB_", "JUPYTER_", "XDG_", "PIP_", "UV_"))}
+    env.update(HOME=str(home), XDG_DATA_HOME=str(home / ".local" / "share"), XDG_CACHE_HOME=str(home / ".cache"),
+               XDG_CONFIG_HOME=str(home / ".config"), JUPYTER_DATA_DIR=str(home / "jupyter"),
+               PYTHONUSERBASE=os.environ.get("PYTHONUSERBASE") or site.getuserbase(),
+               PIP_CACHE_DIR=str(tree / "cache" / "pip"), UV_CACHE_DIR=str(tree / "cache" / "uv"),
+               PIP_NO_INDEX="1", UV_OFFLINE="1", PYTHONUNBUFFERED="1", GITHUB_TOKEN="")
+    home.mkdir(parents=True, exist_ok=True)
+    return env
+
+
+def bench(args) -> Dict[str, Any]:
+    stages = [s for s in args.stages.split(",") if s]
+    with tempfile.TemporaryDirectory(prefix="nb-bench-") as tmp:
+        root = pathlib.Path(tmp)
+        t = time.perf_counter()
+        repos = synth_corpus(root, args.repos, args.nbs_per_repo, seed=args.seed, max_cells=args.max_cells,
+                             image_kb=args.image_kb, slow_seconds=args.slow_seconds)
+        corpus = dict(repos=len(repos), notebooks=len(repos) * args.nbs_per_repo, bytes=_du(root / "remotes"),
+                      seconds=round(time.perf_counter() - t, 2))
+        tree = root / "tree"
+        tree.mkdir()
+        for p in list(HERE.glob("*.py")) + [HERE / "dataset_schema.csv"]:
+            shutil.copy2(p, tree / p.name)
+        wheels = tree / "cache" / "wheels"
+        _link_tree(pathlib.Path(os.environ.get("NB_WHEELHOUSE", HERE / "cache" / "wheels")), wheels)
+        stub = StubGitHub(repos)
+        env = _scratch_env(root, tree)
+        env.update(GITHUB_API_URL=stub.url, NB_GIT_REMOTE_BASE=(root / "remotes").as_uri(),
+                   NB_WHEELHOUSE=str(wheels), NB_MIRROR_CACHE=str(tree / "cache" / "mirrors"))
+        if args.base_pkgs:
+            env["NB_BASE_PKGS"] = args.base_pkgs
+        argv = {
+            "search": ["--query", "bench", "--max-repos", str(args.repos), "--max-nbs-per-repo", str(args.nbs_per_repo)],
+            "triage": ["--jobs", str(args.jobs)],
+            "run": ["--per-notebook-seconds", str(args.per_notebook_seconds), "--max-total-seconds", str(args.max_total_seconds),
+                    "--workers", str(args.workers), "--engine", args.engine, "--schedule", "fifo"],
+        }
+        results = {}
+        try:
+            for s in stages:
+                results[s] = r = run_stage(s, argv[s], tree, env)
+                print(f"{s:<7} {r['seconds']:8.1f}s  {r['notebooks']:5d} nb  {r['nb_per_sec']:7.2f} nb/s  "
+                      f"rss {r['peak_rss_mb'] or 0:6.0f} MB  disk {sum(r['disk_bytes'].values()) / 1e6:7.1f} MB"
+                      + (f"  rc={r['rc']}" if r["rc"] else ""))
+                if r["rc"]:
+                    print(r["log_tail"])
+                    break
+        finally:
+            stub.close()
+            if args.keep:
+                keep = pathlib.Path(args.keep)
+                shutil.copytree(root, keep, dirs_exist_ok=True, ignore=shutil.ignore_patterns("envs"))
+                print(f"Scratch tree copied to {keep}")
+    return dict(commit=_commit(), at=int(time.time()), python=sys.version.split()[0], platform=sys.platform,
+                params={k: v for k, v in vars(args).items() if k not in ("compare", "out", "keep")},
+                corpus=corpus, stages=results)
+
+
+def compare(a_path: str, b_path: str):
+    a, b = (json.loads(pathlib.Path(p).read_text()) for p in (a_path, b_path))
+    if a["params"] != b["params"]:
+        print("⚠️ parameters differ; the numbers are not directly comparable")
+    print(f"{a['commit'][:12]} -> {b['commit'][:12]}")
+    for s in STAGES:
+        if s not in a["stages"] or s not in b["stages"]:
+            continue
+        print(s)
+        for k, fmt in (("seconds", "{:.1f}"), ("nb_per_sec", "{:.2f}"), ("peak_rss_mb", "{:.0f}")):
+            x, y = a["stages"][s].get(k), b["stages"][s].get(k)
+            if x is None or y is None:
+                continue
+            pct = f"{(y - x) / x * 100:+.1f}%" if x else "n/a"
+            print(f"  {k:<12} {fmt.format(x):>10} -> {fmt.format(y):>10}  {pct}")
+        x, y = (sum(r["stages"][s]["disk_bytes"].values()) / 1e6 for r in (a, b))
+        print(f"  {'disk_mb':<12} {x:>10.1f} -> {y:>10.1f}  " + (f"{(y - x) / x * 100:+.1f}%" if x else "n/a"))
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Offline end-to-end benchmark of build_dataset.py")
+    ap.add_argument("--repos", type=int, default=12)
+    ap.add_argument("--nbs-per-repo", type=int, default=4)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--max-cells", type=int, default=30)
+    ap.add_argument("--image-kb", type=int, default=50, help="Size of image outputs stored in the source notebooks")
+    ap.add_argument("--slow-seconds", type=float, default=3.0, help="Sleep in the slow notebooks' extra cell")
+    ap.add_argument("--stages", default=",".join(STAGES), help="Comma-separated subset of search,triage,run (in order)")
+    ap.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="triage --jobs")
+    ap.add_argument("--workers", type=int, default=1, help="run --workers")
+    ap.add_argument("--engine", choices=["pool", "papermill"], default="pool")
+    ap.add_argument("--per-notebook-seconds", type=int, default=60)
+    ap.add_argument("--max-total-seconds", type=int, default=3600)
+    ap.add_argument("--base-pkgs", default="", help="Space-separated base env packages (NB_BASE_PKGS) for a small offline wheelhouse")
+    ap.add_argument("--out", default="", help="Result JSON (default artifacts/bench/<commit>-<time>.json)")
+    ap.add_argument("--keep", default="", help="Copy the scratch corpus and tree here (envs excluded)")
+    ap.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="Compare two result files and exit")
+    args = ap.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    res = bench(args)
+    out = pathlib.Path(args.out) if args.out else RESULTS / f"{res['commit'][:12]}-{res['at']}.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(res, indent=2))
+    print(f"Wrote {out}")
+    sys.exit(1 if any(r["rc"] for r in res["stages"].values()) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""
+Micro-benchmarks for triage internals.
+
+    python bench_triage.py                     # synthetic corpus
+    python bench_triage.py --corpus work/      # every .ipynb under a directory
+
+`scan` times utils.scan_notebook against the per-cell functions it replaces
+(detect_libs + find_relative_paths + CUDA_PAT + code-cell count) and checks
+both give the same answers.
+
+`parse` runs triage_notebook with the streaming reader and with nbformat on
+notebooks carrying image outputs, reporting wall time and peak Python heap
+(tracemalloc) per notebook; the mmap'd file itself is page cache, not heap.
+
+Exits 1 on any mismatch.
+"""
+import sys, time, random, pathlib, argparse, tempfile, tracemalloc, warnings
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+warnings.filterwarnings("ignore", category=UserWarning, module="nbformat")
+
+import nbformat
+from utils import detect_libs, find_relative_paths, scan_notebook, CUDA_PAT
+from triage import _concat_code_from_cells, triage_notebook
+
+SNIPPETS = [
+    "import numpy as np", "x = 1", "for i in range(10):\n    print(i)", "import pandas as pd",
+    "from sklearn.linear_model import LinearRegression", "df = pd.read_csv('data/train.csv')",
+    "img = Image.open(\"imgs/a.png\")", "model.to('cuda')", "import torch", "import torchvision",
+    "with open('out.txt') as f:\n    f.read()", "np.load('w.npy')", "import seaborn as sns",
+    "plt.plot(x)", "# open('x')", "pd.read_csv('https://a/b.csv')", "from matplotlib import pyplot as plt",
+    "import xgboost as xgb", "from transformers import AutoModel", "s = 'long string ' * 10",
+    "def f(a, b):\n    return a + b  # " + "z" * 60,
+]
+
+
+def synth_notebook(rng: random.Random, max_cells: int = 80, image_kb: int = 0,
+                   snippets: Sequence[str] = SNIPPETS, max_lines: int = 15):
+    """Markdown and code cells drawn from `snippets`, some with `image_kb` image outputs."""
+    nb = nbformat.v4.new_notebook()
+    for _ in range(rng.randint(1, max_cells)):
+        if rng.random() < 0.3:
+            nb.cells.append(nbformat.v4.new_markdown_cell("Some prose. " * rng.randint(1, 40)))
+            continue
+        src = "\n".join(rng.choice(snippets) for _ in range(rng.randint(1, max_lines)))
+        cell = nbformat.v4.new_code_cell(src.splitlines(True) if rng.random() < 0.5 else src)
+        if image_kb and rng.random() < 0.2:
+            png = "iVBORw0KGgo" + "A" * (image_kb * 1024)
+            cell.outputs = [nbformat.v4.new_output("display_data", data={"image/png": png, "text/plain": "<Figure>"})]
+        nb.cells.append(cell)
+    return nb
+
+
+def synth_corpus(dest: pathlib.Path, n: int, seed: int = 0, image_kb: int = 0,
+                 make: Optional[Callable[[random.Random], Tuple[Any, str]]] = None) -> List[pathlib.Path]:
+    """n notebooks in dest; make(rng) -> (notebook, name tag) replaces synth_notebook."""
+    rng = random.Random(seed)
+    dest.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for i in range(n):
+        nb, tag = make(rng) if make else (synth_notebook(rng, image_kb=image_kb), "")
+        p = dest / (f"nb_{i:05d}" + (f"_{tag}" if tag else "") + ".ipynb")
+        nbformat.write(nb, str(p))
+        paths.append(p)
+    return paths
+
+
+def _per_cell(nb) -> Dict[str, Any]:
+    return dict(
+        libs=detect_libs(nb),
+        rel_paths=find_relative_paths(nb),
+        suspect_cuda=bool(CUDA_PAT.search(_concat_code_from_cells(nb))),
+        n_code_cells=sum(1 for c in nb.get("cells", []) if c.get("cell_type") == "code"),
+    )
+
+
+def bench_scan(paths: List[pathlib.Path], repeat: int) -> bool:
+    nbs = [nbformat.read(str(p), as_version=4) for p in paths]
+    bad = [p for p, nb in zip(paths, nbs) if _per_cell(nb) != scan_notebook(nb)]
+    timings = {}
+    for name, fn in (("per-cell", _per_cell), ("scan_notebook", scan_notebook)):
+        t = time.perf_counter()
+        for _ in range(repeat):
+            for nb in nbs:
+                fn(nb)
+        timings[name] = (time.perf_counter() - t) / repeat
+    n_cells = sum(len(nb.cells) for nb in nbs)
+    print(f"scan: {len(nbs)} notebooks, {n_cells} cells, mean of {repeat} runs")
+    for name, secs in timings.items():
+        print(f"  {name:<14} {secs*1e3:9.1f} ms  {len(nbs)/secs:9.0f} nb/s")
+    print(f"  speedup        {timings['per-cell']/timings['scan_notebook']:9.2f}x")
+    for p in bad[:10]:
+        print(f"  MISMATCH {p}")
+    print(f"  outputs match: {'yes' if not bad else f'NO ({len(bad)} notebooks)'}")
+    return not bad
+
+
+def _broken_notebooks(dest: pathlib.Path) -> List[pathlib.Path]:
+    """Inputs the streaming reader must hand to nbformat (or reject the same way)."""
+    good = nbformat.writes(synth_notebook(random.Random(1), max_cells=5))
+    cases = {
+        "truncated.ipynb": good[: len(good) // 2],
+        "no_metadata.ipynb": '{"cells": [], "nbformat": 4, "nbformat_minor": 5}',
+        "v3.ipynb": nbformat.writes(nbformat.v3.new_notebook(worksheets=[nbformat.v3.new_worksheet(
+            cells=[nbformat.v3.new_code_cell("import pandas")])]), version=3),
+        "trailing.ipynb": good + "}",
+    }
+    paths = []
+    for name, text in cases.items():
+        p = dest / name
+        p.write_text(text)
+        paths.append(p)
+    return paths
+
+
+def bench_parse(paths: List[pathlib.Path]) -> bool:
+    root = str(paths[0].parent)
+    stats = {}
+    bad = []
+    for stream in (False, True):
+        secs, peaks, parsers = [], [], {}
+        for p in paths:
+            t = time.perf_counter()
+            res = triage_notebook(str(p), root, stream=stream)
+            secs.append(time.perf_counter() - t)
+            # Separate pass: tracemalloc slows allocation-heavy code a lot.
+            tracemalloc.start()
+            triage_notebook(str(p), root, stream=stream)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            parsers[res["parser"]] = parsers.get(res["parser"], 0) + 1
+            if stream:
+                ref = triage_notebook(str(p), root, stream=False)
+                drop = ("parser", "parse_ms")
+                if {k: v for k, v in res.items() if k not in drop} != {k: v for k, v in ref.items() if k not in drop}:
+                    bad.append(p)
+        stats["stream" if stream else "nbformat"] = (secs, peaks, parsers)
+    mb = sum(p.stat().st_size for p in paths) / 1e6
+    print(f"parse: {len(paths)} notebooks, {mb:.1f} MB, per-notebook triage_notebook")
+    for name, (secs, peaks, parsers) in stats.items():
+        print(f"  {name:<9} wall mean {sum(secs)/len(secs)*1e3:7.1f} ms  max {max(secs)*1e3:7.1f} ms | "
+              f"peak heap mean {sum(peaks)/len(peaks)/1e6:6.2f} MB  max {max(peaks)/1e6:6.2f} MB | {parsers}")
+    (s0, p0, _), (s1, p1, _) = stats["nbformat"], stats["stream"]
+    print(f"  speedup {sum(s0)/sum(s1):.2f}x, peak heap {max(p0)/max(p1):.1f}x lower (max)")
+    for p in bad[:10]:
+        print(f"  MISMATCH {p}")
+    print(f"  triage results match: {'yes' if not bad else f'NO ({len(bad)} notebooks)'}")
+    return not bad
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Triage micro-benchmarks")
+    ap.add_argument("--corpus", help="Directory searched recursively for .ipynb (default: synthetic)")
+    ap.add_argument("-n", type=int, default=500, help="Synthetic notebooks to generate")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--image-kb", type=int, default=200, help="Size of synthetic image outputs for `parse`")
+    ap.add_argument("--bench", choices=["scan", "parse", "all"], default="all")
+    args = ap.parse_args()
+
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = pathlib.Path(tmp)
+        if args.bench in ("scan", "all"):
+            if args.corpus:
+                paths = sorted(pathlib.Path(args.corpus).rglob("*.ipynb"))
+            else:
+                paths = synth_corpus(tmp / "scan", args.n)
+            readable = []
+            for p in paths:
+                try:
+                    nbformat.read(str(p), as_version=4)
+                    readable.append(p)
+                except Exception:
+                    pass
+            ok &= bench_scan(readable, args.repeat)
+        if args.bench in ("parse", "all"):
+            if args.corpus:
+                paths = sorted(pathlib.Path(args.corpus).rglob("*.ipynb"))
+            else:
+                paths = synth_corpus(tmp / "parse", max(1, args.n // 5), image_kb=args.image_kb)
+                paths += _broken_notebooks(tmp / "parse")
+            ok &= bench_parse(paths)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
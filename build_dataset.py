@@ -1,242 +1,543 @@
-import os, csv, sys, json, shutil, pathlib, argparse
-from typing import Dict, Any, List
+import os, sys, time, signal, socket, pathlib, argparse, threading
+from collections import Counter
+from typing import Dict, Any, List, Tuple, Optional
 import warnings
+from tqdm import tqdm
 
 warnings.filterwarnings("ignore", category=UserWarning, module="nbformat")
 
-from gh_search import search_repos, list_ipynb_in_repo
-from triage import triage_notebook
-from execute_nb import execute_notebook, infer_installs
-from utils import ART, slug
-from envs import ensure_repo_env, prune_envs
+from gh_search import search_repos, get_repo_trees, notebooks_in_tree, tree_bytes, client
+from triage import triage_parallel, TriageCache
+from execute_nb import execute_notebook, execute_notebook_pooled, infer_installs
+from utils import slug
+from envs import ensure_repo_env, prune_envs, base_provided
+from scheduler import BudgetScheduler, Prefetcher
+from limits import Limits, kill_running
+from predict import plan_jobs
+from runstore import run_store, RECORD_SUFFIX
+from workqueue import WorkQueue, Heartbeat, QUEUE_PATH, LEASE_SECONDS, MAX_ATTEMPTS
+from store import DatasetStore, CandidateLog, COLUMNS, schema_columns
+from repos import (ensure_repo_checked_out, clone_all, repo_dir_for, report_sparse_savings,
+                   head_sha, blob_shas)
 
 HERE = pathlib.Path(__file__).resolve().parent
 WORK = HERE / "work"; WORK.mkdir(exist_ok=True)
 DATASET_CSV = HERE / "notebook_dataset.csv"
 RUNS = HERE / "artifacts" / "nb_runs"; RUNS.mkdir(parents=True, exist_ok=True)
 
+FIELDNAMES = list(COLUMNS)
+# Per-cell summary execute_nb returns for a run; the detail is in its cells record.
+CELL_STAT_FIELDS = ("overhead_seconds", "slowest_cell", "slowest_cell_seconds", "peak_rss_mb", "first_error_seconds")
+# Columns owned by `run`; triage keeps them when the notebook is unchanged.
+RUN_FIELDS = ["runtime_seconds", "status", "error_type", "error_message", *CELL_STAT_FIELDS, "predicted_seconds"]
 
-def clone_repo(full_name: str, dest: pathlib.Path):
-    import git
-    return git.Repo.clone_from(f"https://github.com/{full_name}.git", dest, depth=1)
 
-
-def ensure_repo_checked_out(full_name: str, dest: pathlib.Path):
-    if dest.exists():
-        if (dest / ".git").exists() and any(dest.iterdir()):
-            print(f"✅ Using existing repo: {dest}")
-            return
-        else:
-            print(f"🌀 Found folder without .git; refreshing: {dest}")
-            shutil.rmtree(dest)
-    print(f"⬇️ Cloning https://github.com/{full_name}.git into {dest}")
-    clone_repo(full_name, dest)
+def _append_candidates(new_items: List[Dict[str, Any]]):
+    log = CandidateLog()
+    n = log.extend(new_items)
+    print(f"Appended {n} new candidates ({len(new_items) - n} already known); total {len(log)} now at {log.path}")
 
 
-def _append_candidates(new_items: List[Dict[str, Any]]):
-    out_json = HERE / "artifacts" / "candidates.json"
-    existing = []
-    if out_json.exists():
-        try:
-            existing = json.loads(out_json.read_text())
-        except Exception:
-            existing = []
-    merged = existing + new_items
-    out_json.write_text(json.dumps(merged, indent=2))
-    print(f"Appended {len(new_items)} candidates; total {len(merged)} now at {out_json}")
+def repo_candidates(r: Dict[str, Any], tree: List[Dict[str, Any]], max_files: int) -> List[Dict[str, Any]]:
+    repo_tree_bytes = tree_bytes(tree)
+    return [{
+        "repo_full_name": r["full_name"],
+        "repo_html_url": r["html_url"],
+        "repo_stars": r.get("stargazers_count", 0),
+        "repo_pushed_at": r.get("pushed_at", ""),
+        "notebook_path": nb["path"],
+        "notebook_url": f'{r["html_url"]}/blob/{r.get("default_branch", "master")}/{nb["path"]}',
+        "size_kb": int(nb.get("size", 0) / 1024),
+        "repo_tree_bytes": repo_tree_bytes,
+    } for nb in notebooks_in_tree(tree, max_files=max_files)]
 
 
 def do_search(args):
     repos = search_repos(args.query, max_repos=args.max_repos)
+    trees = get_repo_trees(repos, workers=args.gh_workers)
     candidates = []
     for r in repos:
-        nbs = list_ipynb_in_repo(r["full_name"], max_files=args.max_nbs_per_repo)
-        for nb in nbs:
-            candidates.append({
-                "repo_full_name": r["full_name"],
-                "repo_html_url": r["html_url"],
-                "repo_stars": r.get("stargazers_count", 0),
-                "repo_pushed_at": r.get("pushed_at", ""),
-                "notebook_path": nb["path"],
-                "notebook_url": f'{r["html_url"]}/blob/{r.get("default_branch", "master")}/{nb["path"]}',
-                "size_kb": int(nb.get("size", 0) / 1024),
-            })
+        got = trees.get(r["full_name"])
+        if isinstance(got, Exception) or got is None:
+            print(f"⚠️ Tree listing failed, skipping {r['full_name']}: {got}")
+            continue
+        candidates.extend(repo_candidates(r, got[1], args.max_nbs_per_repo))
+    st = client().stats
+    print(f"GitHub API: {st['requests']} requests, {st['not_modified']} cached (304), {st['retries']} retries")
     _append_candidates(candidates)
 
 
-def do_triage(args):
-    cand_path = HERE / "artifacts" / "candidates.json"
-    if not cand_path.exists():
-        print("No candidates.json. Run `search` first.", file=sys.stderr); sys.exit(1)
-    cands = json.loads(cand_path.read_text())
-
-    # Prepare writer
-    fieldnames = [
-        "repo_url","repo_stars","repo_pushed_at","notebook_path","notebook_url",
-        "size_kb","n_cells","libs_detected","has_relative_data_paths","missing_paths",
-        "suspect_cuda","has_heavy_libs","keep_candidate","runtime_seconds",
-        "status","error_type","error_message"
-    ]
-    out_rows: List[Dict[str, Any]] = []
+def open_store(wal: bool = True) -> DatasetStore:
+    """The dataset store; seeded once from an existing notebook_dataset.csv."""
+    store = DatasetStore(wal=wal)
+    if not store.count() and DATASET_CSV.exists():
+        n = store.import_csv(DATASET_CSV)
+        print(f"Imported {n} rows from {DATASET_CSV.name} into {store.path.name}.")
+    return store
+
+
+def keep_run_fields(row: Dict[str, Any], prev: Optional[Dict[str, Any]]):
+    """
+    Carry execution results over from the previous dataset unless the notebook
+    blob changed. Otherwise the row clears them: upserts only write the
+    columns a row has, so a stale run would survive the re-triage.
+    """
+    keep = bool(prev) and str(prev.get("runtime_seconds") or "").strip() not in ("", "nan") \
+        and not (prev.get("blob_sha") and prev.get("blob_sha") != row.get("blob_sha"))
+    for k in RUN_FIELDS:
+        if keep:
+            row[k] = prev.get(k, "")
+        else:
+            row.setdefault(k, None)
+
+
+def triage_row(c: Dict[str, Any], tri: Dict[str, Any], key: Tuple[str, str, str, str]) -> Dict[str, Any]:
+    return dict(
+        repo_url=c["repo_html_url"],
+        repo_stars=c.get("repo_stars",""),
+        repo_pushed_at=c.get("repo_pushed_at",""),
+        notebook_path=c["notebook_path"],
+        notebook_url=c.get("notebook_url",""),
+        size_kb=tri.get("size_kb", c.get("size_kb", 0)),
+        n_cells=tri.get("n_cells", 0),
+        libs_detected=tri.get("libs_detected",""),
+        has_relative_data_paths=tri.get("has_relative_data_paths", False),
+        missing_paths=tri.get("missing_paths",""),
+        data_elsewhere=tri.get("data_elsewhere",""),
+        suspect_cuda=tri.get("suspect_cuda", False),
+        has_heavy_libs=tri.get("has_heavy_libs", False),
+        install_pkgs=tri.get("install_pkgs", ""),
+        blocked_imports=tri.get("blocked_imports", ""),
+        unknown_imports=tri.get("unknown_imports", ""),
+        keep_candidate=tri.get("keep_candidate", False),
+        runtime_seconds="",
+        status=tri.get("status","ok") if tri.get("status") in {"ok","invalid","bad_json","skip_missing","skip_empty","skip_lfs_pointer","skip_html_notebook"} else "triaged",
+        error_type=tri.get("error_type",""),
+        error_message=tri.get("error_message",""),
+        commit_sha=key[1],
+        blob_sha=key[3],
+        parser=tri.get("parser", ""),
+        parse_ms=tri.get("parse_ms"),
+        parse_peak_kb=tri.get("parse_peak_kb"),
+    )
+
+
+def untriaged_row(c: Dict[str, Any], status: str, e: Optional[Exception] = None) -> Dict[str, Any]:
+    """Row for a candidate that never reached triage: its repo failed to check out, or the notebook is gone."""
+    return {
+        "repo_url": c["repo_html_url"],
+        "repo_stars": c.get("repo_stars",""),
+        "repo_pushed_at": c.get("repo_pushed_at",""),
+        "notebook_path": c.get("notebook_path",""),
+        "notebook_url": c.get("notebook_url",""),
+        "size_kb": 0 if e is not None else c.get("size_kb", 0),
+        "n_cells": 0,
+        "libs_detected": "",
+        "has_relative_data_paths": False,
+        "missing_paths": "",
+        "data_elsewhere": "",
+        "suspect_cuda": False,
+        "has_heavy_libs": False,
+        "keep_candidate": False,
+        "runtime_seconds": "",
+        "status": status,
+        "error_type": type(e).__name__ if e is not None else "",
+        "error_message": str(e)[:500] if e is not None else "",
+    }
+
 
+def do_triage(args):
+    cands = CandidateLog()
+    if not len(cands):
+        print("No candidates. Run `search` first.", file=sys.stderr); sys.exit(1)
+
+    # First pass over the log: which repos (and, for sparse checkouts, which paths) to fetch.
+    sparse = args.checkout == "sparse"
+    sparse_paths: Optional[Dict[str, List[str]]] = {} if sparse else None
+    repo_bytes: Dict[str, int] = {}
     for c in cands:
+        repo_bytes[c["repo_full_name"]] = c.get("repo_tree_bytes", 0)
+        if sparse:
+            sparse_paths.setdefault(c["repo_full_name"], []).append(c["notebook_path"])
+    clone_seconds: Dict[str, float] = {}
+    clone_errors = clone_all(repo_bytes,
+                             workers=args.clone_workers, use_mirror=not args.no_mirror,
+                             sparse_paths=sparse_paths, timings=clone_seconds)
+    repo_shas: Dict[str, Tuple[str, Dict[str, str]]] = {}
+    cache = TriageCache()
+    n_cached = 0
+    out_rows: List[Optional[Dict[str, Any]]] = []
+    keys: Dict[int, Tuple[str, str, str, str]] = {}
+    pending: Dict[int, Dict[str, Any]] = {}
+    todo: List[Tuple[int, str, str]] = []
+
+    for i, c in enumerate(cands):
+        out_rows.append(None)
         repo_full = c["repo_full_name"]
         repo_url = c["repo_html_url"]
-        repo_dir = WORK / slug(repo_full)
+        repo_dir = repo_dir_for(repo_full)
 
-        try:
-            ensure_repo_checked_out(repo_full, repo_dir)
-        except Exception as e:
-            out_rows.append({
-                "repo_url": repo_url,
-                "repo_stars": c.get("repo_stars",""),
-                "repo_pushed_at": c.get("repo_pushed_at",""),
-                "notebook_path": c.get("notebook_path",""),
-                "notebook_url": c.get("notebook_url",""),
-                "size_kb": 0,
-                "n_cells": 0,
-                "libs_detected": "",
-                "has_relative_data_paths": False,
-                "missing_paths": "",
-                "suspect_cuda": False,
-                "has_heavy_libs": False,
-                "keep_candidate": False,
-                "runtime_seconds": "",
-                "status": "error",
-                "error_type": type(e).__name__,
-                "error_message": str(e)[:500],
-            })
+        e = clone_errors.get(repo_full)
+        if e is not None:
+            out_rows[i] = untriaged_row(c, "error", e)
             print(f"⚠️ Repo clone/checkout failed, skipping {repo_url}: {e}")
             continue
 
         nb_rel = c["notebook_path"]
         nb_abs = (repo_dir / nb_rel).resolve()
         if not nb_abs.exists():
-            out_rows.append({
-                "repo_url": repo_url,
-                "repo_stars": c.get("repo_stars",""),
-                "repo_pushed_at": c.get("repo_pushed_at",""),
-                "notebook_path": nb_rel,
-                "notebook_url": c.get("notebook_url",""),
-                "size_kb": c.get("size_kb", 0),
-                "n_cells": 0,
-                "libs_detected": "",
-                "has_relative_data_paths": False,
-                "missing_paths": "",
-                "suspect_cuda": False,
-                "has_heavy_libs": False,
-                "keep_candidate": False,
-                "runtime_seconds": "",
-                "status": "skip_missing",
-                "error_type": "",
-                "error_message": "",
-            })
+            out_rows[i] = untriaged_row(c, "skip_missing")
             continue
 
-        tri = triage_notebook(str(nb_abs), str(repo_dir))
-        row = dict(
-            repo_url=repo_url,
-            repo_stars=c.get("repo_stars",""),
-            repo_pushed_at=c.get("repo_pushed_at",""),
-            notebook_path=nb_rel,
-            notebook_url=c.get("notebook_url",""),
-            size_kb=tri.get("size_kb", c.get("size_kb", 0)),
-            n_cells=tri.get("n_cells", 0),
-            libs_detected=tri.get("libs_detected",""),
-            has_relative_data_paths=tri.get("has_relative_data_paths", False),
-            missing_paths=tri.get("missing_paths",""),
-            suspect_cuda=tri.get("suspect_cuda", False),
-            has_heavy_libs=tri.get("has_heavy_libs", False),
-            keep_candidate=tri.get("keep_candidate", False),
-            runtime_seconds="",
-            status=tri.get("status","ok") if tri.get("status") in {"ok","invalid","bad_json","skip_missing","skip_empty","skip_lfs_pointer","skip_html_notebook"} else "triaged",
-            error_type=tri.get("error_type",""),
-            error_message=tri.get("error_message",""),
-        )
-        out_rows.append(row)
-
-    with open(DATASET_CSV, "w", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=fieldnames)
-        w.writeheader()
-        for r in out_rows:
-            w.writerow({k: r.get(k, "") for k in fieldnames})
-    print(f"Wrote {DATASET_CSV} with {len(out_rows)} triaged entries.")
+        if repo_full not in repo_shas:
+            try:
+                repo_shas[repo_full] = (head_sha(repo_dir), blob_shas(repo_dir))
+            except Exception:
+                repo_shas[repo_full] = ("", {})
+        commit, blobs = repo_shas[repo_full]
+        keys[i] = key = (repo_full, commit, nb_rel, blobs.get(nb_rel, ""))
+
+        tri = None if (args.force or not key[1] or not key[3]) else cache.get(key)
+        if tri is not None:
+            n_cached += 1
+            out_rows[i] = triage_row(c, tri, key)
+        else:
+            pending[i] = c
+            todo.append((i, str(nb_abs), str(repo_dir)))
+
+    # Rows settled without triage go in at once; triaged ones stream into the
+    # cache and the store as they finish, so an interrupted triage keeps them
+    # even when they have no commit/blob SHA to cache under.
+    store = open_store()
+    prev_rows = store.by_key()
+
+    def settle(r: Dict[str, Any]) -> Dict[str, Any]:
+        keep_run_fields(r, prev_rows.get((r["repo_url"], r["notebook_path"])))
+        return r
+
+    try:
+        store.upsert_many(settle(r) for r in out_rows if r is not None)
+        # Triage is pure CPU once repos are on disk: fan it out.
+        results = triage_parallel(todo, jobs=args.jobs, sparse=sparse, chunk_size=args.chunk_size,
+                                   trace_mem=args.trace_parse_mem)
+        for i, tri in tqdm(results, total=len(todo), desc="triage", unit="nb", disable=not todo):
+            key = keys[i]
+            if key[1] and key[3]:
+                cache.put(key, tri)
+            out_rows[i] = settle(triage_row(pending.pop(i), tri, key))
+            store.upsert(out_rows[i])
+    finally:
+        cache.close()
+        store.close()
+    print(f"Upserted {len(out_rows)} triaged entries into {store.path.name} ({n_cached} unchanged, reused from {cache.path.name}).")
+    if sparse:
+        report_sparse_savings(repo_bytes, clone_seconds)
+
+
+def _failed(status: str, e: Optional[Exception] = None) -> Dict[str, Any]:
+    return {"runtime_seconds": 0, "status": status,
+            "error_type": type(e).__name__ if e is not None else "",
+            "error_message": str(e)[:500] if e is not None else ""}
+
+
+Prepared = Tuple[Optional[pathlib.Path], Optional[pathlib.Path], Dict[str, Any]]
+
+
+def _prepare(row: Dict[str, Any], layered: bool = True) -> Prepared:
+    """
+    Check out the row's repo and build its env: (notebook, env python, {}),
+    or (None, None, the row fields recording why not).
+    """
+    repo_full_from_url = row["repo_url"].split("github.com/")[-1].strip("/")
+    repo_dir = repo_dir_for(repo_full_from_url)
+
+    try:
+        ensure_repo_checked_out(repo_full_from_url, repo_dir)
+    except Exception as e:
+        print(f"⚠️ Repo checkout failed in run: {row['repo_url']} :: {e}")
+        return None, None, _failed("error", e)
+
+    nb_abs = (repo_dir / row["notebook_path"]).resolve()
+    if not nb_abs.exists():
+        return None, None, _failed("skip_missing")
+
+    try:
+        extra = infer_installs(str(nb_abs), str(repo_dir), provided=base_provided())
+    except Exception:
+        extra = []
+
+    try:
+        return nb_abs, ensure_repo_env(row["repo_url"], repo_dir, extra_pkgs=extra, layered=layered), {}
+    except Exception as e:
+        return None, None, _failed("error", e)
+
+
+def run_one(row: Dict[str, Any], per_nb: int, layered: bool = True, pool=None,
+             refill: bool = True, limits: Optional[Limits] = None,
+             prepared: Optional[Prepared] = None) -> Tuple[Dict[str, Any], int]:
+    """
+    Check out, build the env for and execute one dataset row. Returns (row, seconds to charge).
+    With a kernels.KernelPool the notebook runs in-process on a warm kernel, else via papermill.
+    `prepared` is a _prepare result computed ahead of time (see scheduler.Prefetcher).
+    """
+    spent = 0
+    nb_abs, py_in_env, failure = prepared if prepared is not None else _prepare(row, layered)
+    if failure:
+        row.update(failure)
+        return row, spent
+
+    try:
+        out_nb = RUNS / (slug(row["repo_url"]) + "_" + slug(row["notebook_path"]) + ".ipynb")
+        if pool is not None:
+            res = execute_notebook_pooled(str(nb_abs), str(out_nb), per_nb, str(py_in_env), pool,
+                                          refill=refill, limits=limits)
+        else:
+            res = execute_notebook(
+                str(nb_abs), str(out_nb),
+                allow_installs=False,
+                per_notebook_seconds=per_nb,
+                python_exe=str(py_in_env),
+                limits=limits
+            )
+        spent = min(per_nb, int(res.get("runtime_seconds", 0)))
+        row["runtime_seconds"] = res.get("runtime_seconds", 0)
+        row["status"] = res.get("status", "error")
+        row["error_type"] = res.get("error_type", "")
+        row["error_message"] = res.get("error_message", "")
+        # Per-cell detail is in res["cells_path"]; the dataset keeps the summary.
+        for k in CELL_STAT_FIELDS:
+            row[k] = res.get(k, "")
+    except Exception as e:
+        row.update(_failed("error", e))
 
+    return row, spent
 
-def do_run(args):
-    if not DATASET_CSV.exists():
-        print("No notebook_dataset.csv. Run `triage` first.", file=sys.stderr); sys.exit(1)
-    import pandas as pd
-    df = pd.read_csv(DATASET_CSV)
 
-    df = df[(df["keep_candidate"] == True)]
-    df = df[(~df["has_relative_data_paths"]) | (df["missing_paths"].astype(str)=="")]
+def do_run(args):
+    store = open_store()
+    if not store.count():
+        print("Dataset is empty. Run `triage` first.", file=sys.stderr); sys.exit(1)
+    history = store.rows()
+    rows = store.candidates()
 
     total_budget = int(args.max_total_seconds)
     per_nb = int(args.per_notebook_seconds)
-    spent = 0
-
-    out_rows: List[Dict[str, Any]] = []
-    for _, row in df.iterrows():
-        if spent + per_nb > total_budget:
-            break
 
-        repo_full_from_url = row["repo_url"].split("github.com/")[-1].strip("/")
-        repo_dir = WORK / slug(repo_full_from_url)
-
-        try:
-            ensure_repo_checked_out(repo_full_from_url, repo_dir)
-        except Exception as e:
-            row["runtime_seconds"] = 0
-            row["status"] = "error"
-            row["error_type"] = type(e).__name__
-            row["error_message"] = str(e)[:500]
-            out_rows.append(row.to_dict())
-            print(f"⚠️ Repo checkout failed in run: {row['repo_url']} :: {e}")
-            continue
+    if args.schedule == "predict":
+        # Shortest predicted first, each reserving an adaptive timeout instead of per_nb.
+        jobs = plan_jobs(rows, history, per_nb, factor=args.timeout_factor, floor=args.min_timeout)
+    else:
+        jobs = [{"repo": row["repo_url"], "cost": per_nb, "row": row} for row in rows]
+
+    limits = Limits(mem_mb=args.mem_limit_mb, cpu_seconds=args.cpu_limit_seconds,
+                    max_procs=args.max_procs, cpus=args.cpus)
+    pool = None
+    if args.engine == "pool":
+        from kernels import KernelPool
+        pool = KernelPool(max_idle=args.workers, limits=limits)
+    # A warm replacement kernel is only worth starting if the repo has notebooks left.
+    left = Counter(job["repo"] for job in jobs)
+    left_lock = threading.Lock()
+
+    sched = BudgetScheduler(total_budget, workers=args.workers, per_repo=args.max_per_repo)
+    layered = not args.no_base_env
+    prefetch = Prefetcher(lambda job: _prepare(job["row"], layered), workers=args.prefetch) if args.prefetch else None
+
+    def run_job(job):
+        with left_lock:
+            left[job["repo"]] -= 1
+            more = left[job["repo"]] > 0
+        prepared = None
+        if prefetch is not None:
+            # Build the next repos' envs while this notebook runs; drop queued builds that can no longer fit the budget.
+            prefetch.ahead(sched.upcoming(args.prefetch))
+            prefetch.retain(sched.may_run)
+            prepared = prefetch.get(job)
+        row, spent = run_one(job["row"], job["cost"], layered=layered, pool=pool, refill=more, limits=limits,
+                              prepared=prepared)
+        row["predicted_seconds"] = job.get("pred", "")
+        store.upsert(row)   # written as each notebook finishes; a crash loses only the ones in flight
+        return row, spent
+
+    try:
+        out_rows = sched.run(jobs, run_job)
+        # Budget saved by short timeouts goes to notebooks those timeouts cut off: rerun them with the full per_nb.
+        ran = {id(r) for r in out_rows}
+        retry = [dict(j, cost=per_nb) for j in jobs
+                 if id(j["row"]) in ran and j["cost"] < per_nb and j["row"].get("status") == "timeout"]
+        if retry:
+            left.update(j["repo"] for j in retry)
+            rerun = sched.run(retry, run_job)
+            print(f"Re-ran {len(rerun)}/{len(retry)} notebooks that hit their adaptive timeout with the full {per_nb}s.")
+    finally:
+        if prefetch is not None:
+            prefetch.close()
+        if pool is not None:
+            pool.close()
+        store.close()
+    if prefetch is not None:
+        print(f"Env prefetch: {prefetch.hits} notebooks started on a prefetched env, {prefetch.cancelled} queued builds cancelled.")
+    print(f"Budget used: {sched.spent}/{total_budget}s across {sched.workers} worker(s).")
+    overheads = [float(r["overhead_seconds"]) for r in out_rows if r.get("overhead_seconds") not in ("", None)]
+    if overheads:
+        print(f"Per-notebook overhead ({args.engine}): mean {sum(overheads)/len(overheads):.1f}s over {len(overheads)} notebooks.")
+    print(run_store().summary())
 
-        nb_abs = (repo_dir / row["notebook_path"]).resolve()
-        if not nb_abs.exists():
-            row["runtime_seconds"] = 0
-            row["status"] = "skip_missing"
-            row["error_type"] = ""
-            row["error_message"] = ""
-            out_rows.append(row.to_dict())
-            continue
+    if out_rows:
+        print(f"Updated {store.path.name} with execution results for {len(out_rows)} notebooks.")
+    else:
+        print("No notebooks executed under current filters/budget.")
 
-        try:
-            extra = infer_installs(str(nb_abs))
-        except Exception:
-            extra = []
 
+def do_enqueue(args):
+    store = open_store()
+    rows = store.candidates()
+    if args.only_new:
+        rows = [r for r in rows if r.get("runtime_seconds") is None]
+    per_nb = int(args.per_notebook_seconds)
+    if args.schedule == "predict":
+        jobs = plan_jobs(rows, store.rows(), per_nb, factor=args.timeout_factor, floor=args.min_timeout)
+    else:
+        jobs = [{"cost": per_nb, "row": row} for row in rows]
+    store.close()
+    queue = WorkQueue(pathlib.Path(args.queue))
+    n = queue.enqueue(jobs, requeue=args.requeue)
+    print(f"Queued {n} of {len(jobs)} runnable notebooks in {queue.path.name}: {queue.counts()}")
+    queue.close()
+
+
+def do_worker(args):
+    """
+    Lease notebooks from the shared queue until it is empty or this worker's
+    budget is spent; any number of these can run on any number of hosts,
+    so the store is opened with the rollback journal, like the queue.
+    SIGTERM/SIGINT stop it: running notebooks are killed and their leases
+    handed back once every worker thread has exited.
+    """
+    store = open_store(wal=False)
+    queue = WorkQueue(pathlib.Path(args.queue), lease_seconds=args.lease_seconds, max_attempts=args.max_attempts)
+    limits = Limits(mem_mb=args.mem_limit_mb, cpu_seconds=args.cpu_limit_seconds,
+                    max_procs=args.max_procs, cpus=args.cpus)
+    pool = None
+    if args.engine == "pool":
+        from kernels import KernelPool
+        pool = KernelPool(max_idle=args.workers, limits=limits)
+    layered = not args.no_base_env
+    beat = Heartbeat(queue).start()
+    total = int(args.max_total_seconds)
+    acct = {"spent": 0, "reserved": 0, "ran": 0}
+    acct_lock = threading.Lock()
+    name = f"{socket.gethostname()}:{os.getpid()}"
+    stop = threading.Event()
+
+    def take(job) -> bool:
+        # Called inside the lease transaction, so checking and reserving can't interleave with another thread.
+        with acct_lock:
+            if acct["spent"] + acct["reserved"] + int(job["cost"]) > total:
+                return False
+            acct["reserved"] += int(job["cost"])
+            return True
+
+    def work(i: int):
+        wid = f"{name}:{i}"
+        while not stop.is_set():
+            job = queue.lease(wid, per_repo=args.max_per_repo, fits=take)
+            if job is None:
+                n, min_cost = queue.remaining()
+                live = queue.counts().get("leased", 0)
+                with acct_lock:
+                    broke = min_cost is not None and acct["spent"] + int(min_cost) > total
+                if broke or (not n and not live):
+                    return
+                stop.wait(args.poll_seconds)   # wait for running jobs: they finish or their leases expire
+                continue
+            key, cost = (job["repo_url"], job["notebook_path"]), int(job["cost"])
+            beat.hold(key, wid)
+            used, done = 0, False
+            try:
+                row = store.get(*key)
+                if row is None:
+                    queue.complete(key, wid, "missing")
+                    done = True
+                    continue
+                if stop.is_set():
+                    continue
+                row, used = run_one(row, cost, layered=layered, pool=pool, refill=queue.pending(key[0]) > 0,
+                                     limits=limits)
+                if stop.is_set():
+                    continue   # killed by the shutdown, not a result: the lease is handed back
+                row["predicted_seconds"] = job.get("pred") if job.get("pred") is not None else ""
+                store.upsert(row)
+                if not queue.complete(key, wid, row.get("status", "")):
+                    print(f"⚠️ {key[1]} finished after its lease was lost; result kept")
+                done = True
+                with acct_lock:
+                    acct["ran"] += 1
+            finally:
+                if done or not stop.is_set():
+                    beat.drop(key)
+                with acct_lock:
+                    acct["reserved"] -= cost
+                    acct["spent"] += max(0, min(cost, int(used)))
+
+    def _stop(signum, frame):
+        stop.set()
+
+    threads = [threading.Thread(target=work, args=(i,), name=f"worker-{i}", daemon=True) for i in range(args.workers)]
+    handlers = {sig: signal.signal(sig, _stop) for sig in (signal.SIGTERM, signal.SIGINT)}
+    try:
+        for t in threads:
+            t.start()
+        while any(t.is_alive() for t in threads) and not stop.wait(0.5):
+            pass
+    finally:
+        stop.set()
+        # Kill what is still running until every thread is out: one may start a process after a pass.
+        killed = 0
+        while any(t.is_alive() for t in threads):
+            killed = max(killed, kill_running() + (pool.kill_busy() if pool is not None else 0))
+            for t in threads:
+                t.join(timeout=0.5)
+        if killed:
+            print(f"🛑 Stopped: killed {killed} running processes/kernels")
+        for sig, h in handlers.items():
+            signal.signal(sig, h)
+        beat.stop()
+        # Interrupted mid-run: hand the notebooks back now rather than when their leases expire.
+        for key, wid in beat.holding():
+            queue.release(key, wid)
+            print(f"↩️ Released {key[0]} :: {key[1]}")
+        if pool is not None:
+            pool.close()
+        store.close()
+    print(f"Worker {name}: ran {acct['ran']} notebooks, budget used {acct['spent']}/{total}s"
+          + (f", {beat.lost} leases lost" if beat.lost else "") + f". Queue: {queue.counts()}")
+    print(run_store().summary())
+    queue.close()
+
+
+def do_export(args):
+    store = open_store()
+    cols = FIELDNAMES if args.layout == "full" else schema_columns()
+    out = pathlib.Path(args.out)
+    n = store.export_csv(out, cols)
+    store.close()
+    print(f"Wrote {out} with {n} rows ({args.layout} layout).")
+
+
+def do_materialize(args):
+    rs = run_store()
+    records = sorted(rs.root.glob(f"{args.pattern}{RECORD_SUFFIX}"))
+    out_dir = pathlib.Path(args.out) if args.out else None
+    if out_dir is not None:
+        out_dir.mkdir(parents=True, exist_ok=True)
+    for rec in records:
+        dest = out_dir / (rec.name[:-len(RECORD_SUFFIX)] + ".ipynb") if out_dir is not None else None
         try:
-            py_in_env = ensure_repo_env(row["repo_url"], repo_dir, extra_pkgs=extra)
-            out_nb = RUNS / (slug(row["repo_url"]) + "_" + slug(row["notebook_path"]) + ".ipynb")
-            res = execute_notebook(
-                str(nb_abs), str(out_nb),
-                allow_installs=False,
-                per_notebook_seconds=per_nb,
-                python_exe=str(py_in_env)
-            )
-            spent += min(per_nb, int(res.get("runtime_seconds", 0)))
-            row["runtime_seconds"] = res.get("runtime_seconds", 0)
-            row["status"] = res.get("status", "error")
-            row["error_type"] = res.get("error_type", "")
-            row["error_message"] = res.get("error_message", "")
+            rs.materialize(rec, dest)
         except Exception as e:
-            row["runtime_seconds"] = 0
-            row["status"] = "error"
-            row["error_type"] = type(e).__name__
-            row["error_message"] = str(e)[:500]
-
-        out_rows.append(row.to_dict())
-
-    import pandas as pd
-    if out_rows:
-        pd.DataFrame(out_rows).to_csv(DATASET_CSV, index=False)
-        print(f"Updated {DATASET_CSV} with execution results for {len(out_rows)} notebooks.")
-    else:
-        print("No notebooks executed under current filters/budget.")
+            print(f"⚠️ Could not rebuild {rec.name}: {e}")
+    print(f"Materialized {len(records)} executed notebooks into {out_dir or rs.root}.")
 
 
 def do_envclean(args):
@@ -252,16 +553,81 @@ def main():
     s.add_argument("--query", required=True, help="GitHub repository search query")
     s.add_argument("--max-repos", type=int, default=50)
     s.add_argument("--max-nbs-per-repo", type=int, default=3)
+    s.add_argument("--gh-workers", type=int, default=8, help="Concurrent GitHub tree requests")
     s.set_defaults(func=do_search)
 
     t = sub.add_parser("triage", help="Clone and triage candidates for data deps & simplicity")
+    t.add_argument("--clone-workers", type=int, default=8, help="Repos cloned/fetched concurrently")
+    t.add_argument("--no-mirror", action="store_true", help="Clone straight from the remote, skipping the bare-mirror cache")
+    t.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Triage worker processes")
+    t.add_argument("--chunk-size", type=int, default=16, help="Notebooks per worker task (a repo's notebooks stay together)")
+    t.add_argument("--force", action="store_true", help="Re-triage every notebook, ignoring the triage cache")
+    t.add_argument("--trace-parse-mem", action="store_true",
+                   help="Record each parse's peak heap in parse_peak_kb (tracemalloc; slows triage)")
+    t.add_argument("--checkout", choices=["full", "sparse"], default="full",
+                   help="sparse: blobless clone of just the candidate notebooks + manifests; data paths fetched on demand")
     t.set_defaults(func=do_triage)
 
     r = sub.add_parser("run", help="Execute triaged notebooks under a time budget (per-repo venv)")
     r.add_argument("--per-notebook-seconds", type=int, default=480)
     r.add_argument("--max-total-seconds", type=int, default=3600)
+    r.add_argument("--workers", type=int, default=1, help="Notebooks executed concurrently")
+    r.add_argument("--max-per-repo", type=int, default=1, help="Concurrent notebooks per repo (shared checkout/venv)")
+    r.add_argument("--no-base-env", action="store_true",
+                   help="Install base packages into every repo env instead of layering on the shared base env")
+    r.add_argument("--prefetch", type=int, default=2,
+                   help="Check out and build envs for the next N repos in the background (0: build inline)")
+    r.add_argument("--engine", choices=["pool", "papermill"], default="pool",
+                   help="pool: nbclient in-process on pre-warmed kernels; papermill: one subprocess per notebook")
+    r.add_argument("--schedule", choices=["predict", "fifo"], default="predict",
+                   help="predict: shortest predicted runtime first with adaptive timeouts; fifo: CSV order, per-notebook-seconds each")
+    r.add_argument("--timeout-factor", type=float, default=3.0, help="Adaptive timeout = factor x predicted runtime")
+    r.add_argument("--min-timeout", type=int, default=60, help="Lower bound for adaptive timeouts")
+    r.add_argument("--mem-limit-mb", type=int, default=0, help="Kill a notebook whose process tree RSS exceeds this (status oom)")
+    r.add_argument("--cpu-limit-seconds", type=int, default=0, help="Kill a notebook after this much CPU time (status cpu_limit)")
+    r.add_argument("--max-procs", type=int, default=0, help="Kill a notebook spawning more processes than this (status proc_limit)")
+    r.add_argument("--cpus", type=int, default=0, help="Pin each notebook to this many cores")
     r.set_defaults(func=do_run)
 
+    q = sub.add_parser("enqueue", help="Put runnable notebooks on the shared work queue for `worker`")
+    q.add_argument("--queue", default=str(QUEUE_PATH))
+    q.add_argument("--per-notebook-seconds", type=int, default=480)
+    q.add_argument("--schedule", choices=["predict", "fifo"], default="predict",
+                   help="predict: shortest predicted runtime first with adaptive timeouts; fifo: dataset order")
+    q.add_argument("--timeout-factor", type=float, default=3.0)
+    q.add_argument("--min-timeout", type=int, default=60)
+    q.add_argument("--only-new", action="store_true", help="Skip notebooks that already have execution results")
+    q.add_argument("--requeue", action="store_true", help="Put finished and failed notebooks back on the queue")
+    q.set_defaults(func=do_enqueue)
+
+    w = sub.add_parser("worker", help="Execute notebooks leased from the shared work queue (run one per host or more)")
+    w.add_argument("--queue", default=str(QUEUE_PATH))
+    w.add_argument("--max-total-seconds", type=int, default=3600, help="This worker's budget")
+    w.add_argument("--workers", type=int, default=1, help="Notebooks this worker executes concurrently")
+    w.add_argument("--max-per-repo", type=int, default=1, help="Concurrent notebooks per repo across all workers")
+    w.add_argument("--lease-seconds", type=int, default=LEASE_SECONDS,
+                   help="A lease not renewed for this long (crashed worker) goes back to the queue")
+    w.add_argument("--max-attempts", type=int, default=MAX_ATTEMPTS, help="Leases per notebook before it is marked failed")
+    w.add_argument("--poll-seconds", type=float, default=5.0, help="Wait between polls while others hold the remaining jobs")
+    w.add_argument("--no-base-env", action="store_true")
+    w.add_argument("--engine", choices=["pool", "papermill"], default="pool")
+    w.add_argument("--mem-limit-mb", type=int, default=0)
+    w.add_argument("--cpu-limit-seconds", type=int, default=0)
+    w.add_argument("--max-procs", type=int, default=0)
+    w.add_argument("--cpus", type=int, default=0)
+    w.set_defaults(func=do_worker)
+
+    e = sub.add_parser("export", help="Export the dataset store as CSV")
+    e.add_argument("--out", default=str(DATASET_CSV))
+    e.add_argument("--layout", choices=["schema", "full"], default="schema",
+                   help="schema: the columns of dataset_schema.csv; full: every stored column")
+    e.set_defaults(func=do_export)
+
+    m = sub.add_parser("materialize", help="Rebuild executed .ipynb files from the run records in artifacts/nb_runs")
+    m.add_argument("--pattern", default="*", help="Glob on record names (without .run.jsonl)")
+    m.add_argument("--out", default="", help="Directory for the notebooks (default: next to the records)")
+    m.set_defaults(func=do_materialize)
+
     c = sub.add_parser("envclean", help="Remove cached per-repo envs older than N days (default 14)")
     c.add_argument("--days", type=int, default=14)
     c.set_defaults(func=do_envclean)
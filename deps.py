@@ -0,0 +1,240 @@
+"""
+Which packages a notebook needs: imports from the AST of its code cells
+(plus %pip / !pip magics), mapped from module to PyPI distribution by a
+local table, minus the stdlib, repo-local modules and what the env already
+provides. Imports the table doesn't know are reported, never installed: a
+module that only looks missing (namespace package, sys.path tweak, src/
+layout) could otherwise pull a same-named package off PyPI.
+"""
+import re, ast, sys, pathlib, sysconfig
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+# Import name -> distribution, where they differ or the module is common
+# enough to be worth pinning down. None: only exists on a hosted platform
+# (Colab, Kaggle) or another OS, so the notebook can't be installed here.
+# Dotted keys match that module and its submodules; the longest match wins.
+MODULE_DISTS: Dict[str, Optional[str]] = {
+    "sklearn": "scikit-learn", "skimage": "scikit-image", "cv2": "opencv-python", "PIL": "pillow",
+    "bs4": "beautifulsoup4", "yaml": "pyyaml", "dateutil": "python-dateutil", "dotenv": "python-dotenv",
+    "Bio": "biopython", "Crypto": "pycryptodome", "OpenSSL": "pyopenssl", "jwt": "pyjwt", "serial": "pyserial",
+    "usb": "pyusb", "magic": "python-magic", "docx": "python-docx", "pptx": "python-pptx", "fitz": "pymupdf",
+    "attr": "attrs", "google.protobuf": "protobuf", "google.cloud.storage": "google-cloud-storage",
+    "google.cloud.bigquery": "google-cloud-bigquery", "google.generativeai": "google-generativeai",
+    "googleapiclient": "google-api-python-client", "tensorflow_datasets": "tensorflow-datasets",
+    "tensorflow_hub": "tensorflow-hub", "tf_keras": "tf-keras", "umap": "umap-learn", "hdbscan": "hdbscan",
+    "Levenshtein": "python-levenshtein", "mpl_toolkits.basemap": "basemap", "osgeo": "gdal",
+    "MySQLdb": "mysqlclient", "psycopg2": "psycopg2-binary", "sqlalchemy": "sqlalchemy", "zmq": "pyzmq",
+    "wx": "wxpython", "gi": "pygobject", "lxml": "lxml", "nltk": "nltk", "spacy": "spacy", "gensim": "gensim",
+    "plotly": "plotly", "seaborn": "seaborn", "statsmodels": "statsmodels", "scipy": "scipy", "sympy": "sympy",
+    "numpy": "numpy", "pandas": "pandas", "matplotlib": "matplotlib", "tqdm": "tqdm", "requests": "requests",
+    "xgboost": "xgboost", "lightgbm": "lightgbm", "catboost": "catboost", "torch": "torch",
+    "torchvision": "torchvision", "torchaudio": "torchaudio", "tensorflow": "tensorflow", "keras": "keras",
+    "transformers": "transformers", "datasets": "datasets", "tokenizers": "tokenizers", "jax": "jax",
+    "flax": "flax", "optuna": "optuna", "shap": "shap", "imblearn": "imbalanced-learn", "mlxtend": "mlxtend",
+    "networkx": "networkx", "folium": "folium", "geopandas": "geopandas", "shapely": "shapely",
+    "pyproj": "pyproj", "altair": "altair", "bokeh": "bokeh", "dash": "dash", "ipywidgets": "ipywidgets",
+    "IPython": "ipython", "tabulate": "tabulate", "wordcloud": "wordcloud", "joblib": "joblib",
+    "h5py": "h5py", "tables": "tables", "pyarrow": "pyarrow", "openpyxl": "openpyxl", "xlrd": "xlrd",
+    "pydot": "pydot", "graphviz": "graphviz", "sentence_transformers": "sentence-transformers",
+    "lime": "lime", "eli5": "eli5", "prophet": "prophet", "pmdarima": "pmdarima", "yfinance": "yfinance",
+    "gym": "gym", "gymnasium": "gymnasium", "pygame": "pygame", "librosa": "librosa", "soundfile": "soundfile",
+    "pydub": "pydub", "emoji": "emoji", "textblob": "textblob", "unidecode": "unidecode",
+    "google.colab": None, "kaggle_secrets": None, "kaggle_datasets": None, "kaggle_environments": None,
+    "win32api": None, "win32com": None, "win32con": None, "pythoncom": None, "winreg": None, "msvcrt": None,
+}
+
+# Cell magics whose body is still Python.
+_PY_CELL_MAGICS = {"time", "timeit", "capture", "prun", "debug", "memit", "skip"}
+_MAGIC_LINE = re.compile(r"^(\s*)(?:[!%]|\w+\s*=\s*[!%])")
+_PIP_MAGIC = re.compile(r"^\s*[!%]\s*(?:python3?\s+-m\s+)?(?:pip3?|conda|mamba)\s+install\s+(.*)$", re.M)
+_IMPORT_LINE = re.compile(r"^\s*(?:from\s+([\w.]+)\s+import|import\s+([\w.]+))", re.M)
+_IMPORT_ERRORS = {"ImportError", "ModuleNotFoundError", "Exception", "BaseException"}
+
+
+def _stdlib() -> Set[str]:
+    names = getattr(sys, "stdlib_module_names", None)
+    if names:
+        return set(names)
+    out = set(sys.builtin_module_names)
+    for p in pathlib.Path(sysconfig.get_paths()["stdlib"]).iterdir():
+        out.add(p.name[:-3] if p.suffix == ".py" else p.name)
+    return out
+
+STDLIB = _stdlib() | {"__future__"}
+
+
+def _cell_python(src: str) -> Optional[str]:
+    """The cell with IPython magics/shell lines blanked out; None for non-Python cell magics (%%bash...)."""
+    lines = src.splitlines()
+    if lines and lines[0].lstrip().startswith("%%"):
+        if lines[0].lstrip()[2:].split(" ")[0] not in _PY_CELL_MAGICS:
+            return None
+        lines = lines[1:]
+    out = []
+    for line in lines:
+        m = _MAGIC_LINE.match(line)
+        if m or line.rstrip().endswith("?"):
+            out.append((m.group(1) if m else "") + "pass")
+        else:
+            out.append(line)
+    return "\n".join(out)
+
+
+def _optional_imports(tree: ast.AST) -> Set[int]:
+    """ids of import nodes inside `try:` blocks that catch ImportError (the code copes without them)."""
+    ids: Set[int] = set()
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Try):
+            continue
+        caught = set()
+        for h in node.handlers:
+            if h.type is None:
+                caught.add("Exception")
+            for n in ast.walk(h.type) if h.type is not None else ():
+                if isinstance(n, ast.Name):
+                    caught.add(n.id)
+        if caught & _IMPORT_ERRORS:
+            for stmt in node.body:
+                ids.update(id(n) for n in ast.walk(stmt) if isinstance(n, (ast.Import, ast.ImportFrom)))
+    return ids
+
+
+def extract_imports(sources: Iterable[str]) -> Tuple[Dict[str, bool], List[str]]:
+    """
+    ({dotted module: required}, pip-magic requirements) over a notebook's
+    code cells. required is False for imports guarded by try/except
+    ImportError. Cells that don't parse fall back to a line regex.
+    """
+    mods: Dict[str, bool] = {}
+    pips: List[str] = []
+    for src in sources:
+        for m in _PIP_MAGIC.finditer(src):
+            pips.extend(_pip_args(m.group(1)))
+        code = _cell_python(src)
+        if code is None:
+            continue
+        try:
+            tree = ast.parse(code)
+        except (SyntaxError, ValueError):
+            for m in _IMPORT_LINE.finditer(code):
+                mods.setdefault(m.group(1) or m.group(2), True)
+            continue
+        optional = _optional_imports(tree)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [a.name for a in node.names]
+            elif isinstance(node, ast.ImportFrom) and not node.level and node.module:
+                names = [node.module]
+            else:
+                continue
+            for n in names:
+                mods[n] = mods.get(n, False) or id(node) not in optional
+    return mods, pips
+
+
+def _pip_args(argstr: str) -> List[str]:
+    out, skip = [], False
+    for tok in argstr.split():
+        tok = tok.strip("'\"")
+        if skip:
+            skip = False
+            continue
+        if tok in ("-r", "--requirement", "-c", "--constraint", "-e", "--editable", "-i", "--index-url",
+                   "--extra-index-url", "-f", "--find-links", "--target", "-t", "--channel"):
+            skip = True
+            continue
+        if not tok or tok.startswith(("-", "#")) or any(ch in tok for ch in "$/{\\") or tok in (".", ".."):
+            if tok.startswith("#"):
+                break
+            continue
+        out.append(tok)
+    return out
+
+
+def dist_for(module: str) -> Tuple[bool, Optional[str]]:
+    """(known, distribution) for a dotted module; for unknown modules the dist is a guess: their top-level name."""
+    parts = module.split(".")
+    for i in range(len(parts), 0, -1):
+        key = ".".join(parts[:i])
+        if key in MODULE_DISTS:
+            return True, MODULE_DISTS[key]
+    return False, parts[0]
+
+
+def _norm(name: str) -> str:
+    return re.sub(r"[-_.]+", "-", name.strip().lower())
+
+
+def _req_name(spec: str) -> str:
+    return _norm(re.split(r"[\s\[<>=!~;@]", spec.strip(), 1)[0])
+
+
+def provided_dists(pkgs: Iterable[str]) -> Set[str]:
+    """Normalized names of requirement specs (e.g. base env lockfile, requirements.txt lines; `name @ url` too)."""
+    out = set()
+    for p in pkgs:
+        p = p.split(" #")[0].strip()
+        if p and not p.startswith(("-", "#", ".", "/")) and not re.match(r"^[\w+.-]+://", p):
+            out.add(_req_name(p))
+    return out
+
+
+def _is_local(top: str, dirs: List[pathlib.Path], exists: Callable[[pathlib.Path], bool]) -> bool:
+    return any(exists(d / f"{top}.py") or exists(d / top / "__init__.py") for d in dirs)
+
+
+def analyze(sources: Iterable[str], search_dirs: Iterable[pathlib.Path] = (),
+            provided: Iterable[str] = (), exists: Optional[Callable[[pathlib.Path], bool]] = None) -> Dict[str, Any]:
+    """
+    Dependencies of a notebook from its code-cell sources.
+
+    search_dirs: where repo-local modules live (notebook dir, repo root).
+    provided: requirement specs the env already installs (base packages,
+    requirements.txt); their dists are not repeated in `install`.
+
+    Returns imports (third-party top-level modules), install (MODULE_DISTS
+    dists to add, plus %pip magics), blocked (required imports that exist
+    only on a hosted platform / other OS), unknown (required imports that
+    are neither in MODULE_DISTS nor provided; not installed) and installable
+    (no blocked imports).
+    """
+    exists = exists or pathlib.Path.exists
+    dirs = list(search_dirs)
+    have = provided_dists(provided)
+    mods, pips = extract_imports(sources)
+    imports, install, blocked, unknown = set(), set(), set(), set()
+    for mod, required in mods.items():
+        top = mod.split(".")[0]
+        if top in STDLIB or _is_local(top, dirs, exists):
+            continue
+        known, dist = dist_for(mod)
+        if dist is None:
+            if required:
+                blocked.add(mod)
+            continue
+        imports.add(top)
+        if required and _norm(dist) not in have:
+            (install if known else unknown).add(dist if known else top)
+    for spec in pips:
+        if _req_name(spec) not in have:
+            install.add(spec)
+    return dict(imports=sorted(imports), install=sorted(install), blocked=sorted(blocked), unknown=sorted(unknown),
+                installable=not blocked)
+
+
+def notebook_sources(nb: Any) -> List[str]:
+    """Code-cell sources of a notebook dict / NotebookNode / nbstream doc."""
+    out = []
+    for c in (nb.get("cells", []) if isinstance(nb, dict) else getattr(nb, "cells", [])):
+        if c.get("cell_type") == "code":
+            src = c.get("source", "")
+            out.append(src if isinstance(src, str) else "".join(src))
+    return out
+
+
+def requirements_lines(repo_dir: pathlib.Path) -> List[str]:
+    req = pathlib.Path(repo_dir) / "requirements.txt"
+    try:
+        return req.read_text(errors="ignore").splitlines() if req.exists() else []
+    except OSError:
+        return []
@@ -1,18 +1,60 @@
-import os, sys, subprocess, shutil, pathlib, hashlib, time
-from typing import Optional, List
+import os, re, sys, json, shutil, pathlib, hashlib, time, threading
+from contextlib import contextmanager
+from typing import Optional, List, Tuple, Dict
+try:
+    import fcntl
+except ImportError:   # Windows: in-process locking only
+    fcntl = None
+
+from limits import run_limited, TAIL_BYTES
 
 HERE = pathlib.Path(__file__).resolve().parent
 WORK = HERE / "work"; WORK.mkdir(exist_ok=True)
 ENVS = WORK / "envs"; ENVS.mkdir(parents=True, exist_ok=True)
+# Local wheelhouse shared by every env build; kept outside work/ like the git mirrors.
+WHEELS = pathlib.Path(os.environ.get("NB_WHEELHOUSE", HERE / "cache" / "wheels"))
+ENV_BUILDS = HERE / "artifacts" / "env_builds.jsonl"
+# Resolved package sets per env key; outlive the envs so a rebuild skips resolution.
+LOCKS = ENVS / ".locks"
+# Full output of venv/pip/uv/ipykernel runs, <env key>.<step>.out.gz / .err.gz, from the env's latest build.
+LOGS = ENVS / ".logs"
+# Installer backend: auto (uv when on PATH, else pip), uv or pip.
+INSTALLER = os.environ.get("NB_INSTALLER", "auto")
 
-def _run(cmd, cwd=None, timeout=None):
-    p = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    try:
-        out, err = p.communicate(timeout=timeout)
-    except subprocess.TimeoutExpired:
-        p.kill(); out, err = p.communicate()
-        return 124, out, err
-    return p.returncode, out, err
+# NB_BASE_PKGS (space-separated) replaces the list, e.g. for a small offline wheelhouse.
+BASE_PKGS = os.environ.get("NB_BASE_PKGS", "").split() or \
+    ["pip", "wheel", "setuptools","numpy", "pandas", "matplotlib", "scikit-learn","papermill", "nbclient", "ipykernel", "jupyter"]
+
+_key_locks: Dict[str, threading.Lock] = {}
+_key_locks_guard = threading.Lock()
+
+@contextmanager
+def _env_lock(key: str):
+    """Serialize builds of one env across threads and, via flock, across processes."""
+    with _key_locks_guard:
+        lk = _key_locks.setdefault(key, threading.Lock())
+    with lk:
+        if fcntl is None:
+            yield
+            return
+        with open(ENVS / f".{key}.lock", "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+def _run(cmd, cwd=None, timeout=None, tail: Optional[int] = TAIL_BYTES, log: Optional[str] = None):
+    """
+    Installs can print megabytes; only the tail (where pip puts its error) is
+    kept in memory unless tail=None. With `log`, all of it goes to LOGS/<log>.
+    """
+    log_path = None
+    if log:
+        LOGS.mkdir(parents=True, exist_ok=True)
+        log_path = LOGS / log
+    rc, out, err, _ = run_limited(cmd, timeout=timeout, cwd=cwd, tail=tail, log_path=log_path)
+    return rc, out, err
 
 def _slug(s: str) -> str:
     return "".join(ch if ch.isalnum() or ch in "._-+" else "-" for ch in s)[:200]
@@ -20,66 +62,323 @@ def _slug(s: str) -> str:
 def _hash_text(txt: str) -> str:
     return hashlib.sha256(txt.encode("utf-8")).hexdigest()[:16]
 
-def _reqs_fingerprint(repo_dir: pathlib.Path) -> str:
-    parts = []
-    for fn in ("requirements.txt", "pyproject.toml", "setup.cfg", "environment.yml", ".python-version", "runtime.txt"):
-        p = repo_dir / fn
-        if p.exists():
-            try:
-                parts.append(fn + ":" + p.read_text(errors="ignore"))
-            except Exception:
-                pass
-    return _hash_text("\n---\n".join(parts)) if parts else "no-reqs"
+# Dependency manifests that shape a repo env (also kept in sparse checkouts).
+REQ_FILES = ("requirements.txt", "pyproject.toml", "setup.cfg", "environment.yml", ".python-version", "runtime.txt")
+
+# Lines that pull in repo-local files: such an env can't be shared with other repos.
+_LOCAL_REQ = re.compile(r"^\s*(-r|--requirement|-c|--constraint|-e|--editable)\b|^\s*(\.|file:)", re.M)
+
+def _norm_pkg(spec: str) -> str:
+    return re.sub(r"[-_.]+", "-", spec.strip().lower())
+
+def env_key(repo_url: str, repo_dir: pathlib.Path, extra_pkgs: List[str], base_pkgs: List[str], layered: bool) -> str:
+    """
+    Content address of an env: everything that decides what gets installed
+    (normalized requirements.txt, extras, base layer, interpreter), not which
+    repo asked. Repos with the same inputs share one env.
+    """
+    parts = [sys.version, "layered" if layered else "full", "base:" + ",".join(sorted(_norm_pkg(p) for p in base_pkgs)),
+             "extra:" + ",".join(sorted({_norm_pkg(p) for p in extra_pkgs}))]
+    req = repo_dir / "requirements.txt"
+    if req.exists():
+        txt = req.read_text(errors="ignore")
+        lines = sorted({l.split(" #")[0].strip() for l in txt.splitlines() if l.strip() and not l.lstrip().startswith("#")})
+        parts.append("req:" + "\n".join(lines))
+        if _LOCAL_REQ.search(txt):
+            parts.append("repo:" + repo_url)
+    return "env-" + _hash_text("\n---\n".join(parts))
+
+def _add_ref(env_dir: pathlib.Path, repo_url: str):
+    """
+    Record that repo_url uses env_dir. Refs are per (repo, env) pair: one repo
+    uses several envs at once (extras differ per notebook), so its refs to
+    other envs stay and only expire by age in prune_envs.
+    """
+    name = _slug(repo_url.split("github.com/")[-1])
+    refs = env_dir / ".refs"; refs.mkdir(exist_ok=True)
+    (refs / name).write_text(str(int(time.time())))
 
 def _venv_python(env_dir: pathlib.Path) -> pathlib.Path:
     if os.name == "nt":
         return env_dir / "Scripts" / "python.exe"
     return env_dir / "bin" / "python"
 
+def _site_packages(py: pathlib.Path) -> pathlib.Path:
+    rc, out, err = _run([str(py), "-c", "import sysconfig; print(sysconfig.get_paths()['purelib'])"], timeout=60)
+    if rc != 0: raise RuntimeError(f"cannot locate site-packages of {py}: {err or out}")
+    return pathlib.Path(out.strip())
+
+def _du(root: pathlib.Path) -> int:
+    """Bytes under root, counting each hardlinked inode once."""
+    seen, total = set(), 0
+    for dirpath, _, filenames in os.walk(root):
+        for fn in filenames:
+            try:
+                st = os.lstat(os.path.join(dirpath, fn))
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) not in seen:
+                seen.add((st.st_dev, st.st_ino))
+                total += st.st_size
+    return total
+
+class PipInstaller:
+    """
+    pip install offline from the wheelhouse; on a miss, build/download the
+    wheels into it and retry offline, then fall back to a plain index install.
+    """
+    name = "pip"
+
+    def _install_cmd(self, py: pathlib.Path) -> List[str]:
+        return [str(py), "-m", "pip", "install"]
+
+    def _fill_wheelhouse(self, py: pathlib.Path, args: List[str], timeout: int, cwd=None, log: Optional[str] = None) -> int:
+        wheel_args = [a for a in args if a not in ("--upgrade", "--no-deps")]
+        rc, _, _ = _run([str(py), "-m", "pip", "wheel", "--wheel-dir", str(WHEELS), "--find-links", str(WHEELS)] + wheel_args,
+                        cwd=cwd, timeout=timeout, log=log and f"{log}.wheel")
+        return rc
+
+    def install(self, py: pathlib.Path, args: List[str], timeout: int, cwd=None,
+                log: Optional[str] = None) -> Tuple[int, str, str]:
+        """`log` names the attempts' log files (<log>.offline, .wheel, .offline-retry, .index)."""
+        WHEELS.mkdir(parents=True, exist_ok=True)
+        offline = self._install_cmd(py) + ["--no-index", "--find-links", str(WHEELS)] + args
+        rc, out, err = _run(offline, cwd=cwd, timeout=timeout, log=log and f"{log}.offline")
+        if rc == 0: return rc, out, err
+        if self._fill_wheelhouse(py, args, timeout, cwd, log) == 0:
+            rc, out, err = _run(offline, cwd=cwd, timeout=timeout, log=log and f"{log}.offline-retry")
+            if rc == 0: return rc, out, err
+        return _run(self._install_cmd(py) + ["--find-links", str(WHEELS)] + args, cwd=cwd, timeout=timeout,
+                    log=log and f"{log}.index")
+
+    def freeze(self, py: pathlib.Path) -> Optional[str]:
+        """Pinned packages installed in the env itself (not the base it layers on); None on failure."""
+        rc, out, _ = _run([str(py), "-m", "pip", "freeze", "--path", str(_site_packages(py))], timeout=300, tail=None)
+        return out if rc == 0 else None
+
+class UvInstaller(PipInstaller):
+    """uv's resolver/installer with the same wheelhouse flow; the wheelhouse is still filled by pip wheel."""
+    name = "uv"
+
+    def __init__(self, exe: str):
+        self.exe = exe
+
+    def _install_cmd(self, py: pathlib.Path) -> List[str]:
+        return [self.exe, "pip", "install", "--python", str(py)]
+
+    def freeze(self, py: pathlib.Path) -> Optional[str]:
+        rc, out, _ = _run([self.exe, "pip", "freeze", "--python", str(py)], timeout=300, tail=None)
+        return out if rc == 0 else None
+
+def installer(name: Optional[str] = None) -> PipInstaller:
+    name = name or INSTALLER
+    uv = shutil.which("uv") if name in ("auto", "uv") else None
+    if uv:
+        return UvInstaller(uv)
+    if name == "uv":
+        print("[WARN] uv not found on PATH; installing with pip")
+    return PipInstaller()
+
+def _install_locked(inst: PipInstaller, py: pathlib.Path, key: str, args: List[str], timeout: int,
+                    cwd=None) -> Tuple[int, str, str, bool]:
+    """
+    Install `args` into the env in one resolve and record the result as the
+    key's lockfile; when a lockfile exists, install exactly that with
+    --no-deps instead (no resolution). Returns (rc, out, err, from_lock).
+    """
+    lock = LOCKS / f"{key}.txt"
+    if lock.exists():
+        rc, out, err = inst.install(py, ["--no-deps", "-r", str(lock)], timeout, cwd, log=f"{key}.lock")
+        if rc == 0: return rc, out, err, True
+        print(f"[WARN] install from {lock.name} failed; resolving again")
+    rc, out, err = inst.install(py, args, timeout, cwd, log=f"{key}.resolve")
+    if rc == 0:
+        pins = inst.freeze(py)
+        if pins is not None:
+            LOCKS.mkdir(parents=True, exist_ok=True)
+            tmp = lock.with_suffix(".tmp")
+            tmp.write_text(pins)
+            os.replace(tmp, lock)
+    return rc, out, err, False
+
+def base_env_dir(base_pkgs: Optional[List[str]] = None) -> pathlib.Path:
+    base_pkgs = base_pkgs or BASE_PKGS
+    return ENVS / ("_base-" + _hash_text(sys.version + "\n" + "\n".join(sorted(base_pkgs))))
+
+_provided: Dict[str, List[str]] = {}
+_provided_lock = threading.Lock()
+
+def base_provided(base_pkgs: Optional[List[str]] = None) -> List[str]:
+    """
+    Requirement specs for everything the base env installs, dependencies
+    included (ipykernel brings IPython, scikit-learn scipy and joblib): its
+    lockfile, else the distributions its python reports. Just base_pkgs
+    until the base env is built.
+    """
+    base_pkgs = base_pkgs or BASE_PKGS
+    base = base_env_dir(base_pkgs)
+    with _provided_lock:
+        if base.name in _provided:
+            return _provided[base.name]
+    specs = None
+    for lock in (base / "requirements.lock", LOCKS / f"{base.name}.txt"):
+        if lock.exists():
+            specs = lock.read_text(errors="ignore").splitlines()
+            break
+    py = _venv_python(base)
+    if specs is None and (base / ".ready").exists() and py.exists():
+        rc, out, _ = _run([str(py), "-c", "import importlib.metadata as m\n"
+                           "print('\\n'.join(d.metadata['Name'] or '' for d in m.distributions()))"], timeout=120)
+        if rc == 0:
+            specs = out.split()
+    if specs is None:
+        return list(base_pkgs)
+    specs = list(base_pkgs) + specs
+    with _provided_lock:
+        _provided[base.name] = specs
+    return specs
+
+def ensure_base_env(base_pkgs: Optional[List[str]] = None) -> pathlib.Path:
+    """
+    Shared venv holding base_pkgs, built once per (python, package list).
+    Repo envs layer on top of it through a .pth file instead of reinstalling.
+    """
+    base_pkgs = base_pkgs or BASE_PKGS
+    base = base_env_dir(base_pkgs)
+    py = _venv_python(base)
+    with _env_lock(base.name):
+        if not (base / ".ready").exists():
+            started = time.time()
+            if base.exists(): shutil.rmtree(base, ignore_errors=True)
+            rc, out, err = _run([sys.executable, "-m", "venv", str(base)], log=f"{base.name}.venv")
+            if rc != 0: raise RuntimeError(f"venv create failed: {err or out}")
+            inst = installer()
+            t0 = time.time()
+            rc, out, err, locked = _install_locked(inst, py, base.name, ["--upgrade"] + base_pkgs, timeout=1200)
+            if rc != 0: raise RuntimeError(f"{inst.name} base install failed: {err or out}")
+            if (LOCKS / f"{base.name}.txt").exists():
+                shutil.copyfile(LOCKS / f"{base.name}.txt", base / "requirements.lock")
+            (base / ".ready").write_text(str(_site_packages(py)))
+            _record_build(base.name, "base", time.time() - started, _du(base), backend=inst.name,
+                          install_seconds=round(time.time() - t0, 1), from_lock=locked, install_ok=True)
+        (base / ".last_used").write_text(str(int(time.time())))
+    return base
+
+def _record_build(key: str, kind: str, seconds: float, nbytes: int, **extra):
+    ENV_BUILDS.parent.mkdir(parents=True, exist_ok=True)
+    with open(ENV_BUILDS, "a", encoding="utf-8") as f:
+        f.write(json.dumps(dict(key=key, kind=kind, seconds=round(seconds, 1), bytes=nbytes, at=int(time.time()), **extra)) + "\n")
+    how = f" with {extra['backend']}" + (" from lockfile" if extra.get("from_lock") else "") if extra.get("backend") else ""
+    print(f"🧱 Built {kind} env {key}{how} in {seconds:.0f}s, {nbytes/1e6:.0f} MB")
+
+def _base_ok(env_dir: pathlib.Path) -> bool:
+    """A layered env is only usable while the base it points at still exists."""
+    link = env_dir / ".base"
+    return not link.exists() or (pathlib.Path(link.read_text().strip()) / ".ready").exists()
+
 def ensure_repo_env(repo_url: str, repo_dir: pathlib.Path,
                     extra_pkgs: Optional[List[str]] = None,
-                    base_pkgs: Optional[List[str]] = None) -> pathlib.Path:
+                    base_pkgs: Optional[List[str]] = None,
+                    layered: bool = True) -> pathlib.Path:
+    """
+    Venv for a repo. layered=True creates it pip-less on top of the shared base
+    env (repo installs shadow base packages); layered=False installs
+    base_pkgs into the repo env itself, as before.
+    """
     extra_pkgs = extra_pkgs or []
-    base_pkgs = base_pkgs or ["pip", "wheel", "setuptools","numpy", "pandas", "matplotlib", "scikit-learn","papermill", "nbclient", "ipykernel", "jupyter"]
+    base_pkgs = base_pkgs or BASE_PKGS
 
-    fp = _reqs_fingerprint(repo_dir)
-    key = _slug(repo_url.split("github.com/")[-1]) + "-" + fp
+    key = env_key(repo_url, repo_dir, extra_pkgs, base_pkgs, layered)
     env_dir = ENVS / key
     py = _venv_python(env_dir)
 
-    if not py.exists():
-        if env_dir.exists(): shutil.rmtree(env_dir, ignore_errors=True)
-        rc, out, err = _run([sys.executable, "-m", "venv", str(env_dir)])
-        if rc != 0: raise RuntimeError(f"venv create failed: {err or out}")
-        rc, out, err = _run([str(py), "-m", "pip", "install", "--upgrade"] + base_pkgs, timeout=1200)
-        if rc != 0: raise RuntimeError(f"pip base install failed: {err or out}")
+    with _env_lock(key):
+        _build_env(key, env_dir, py, repo_url, repo_dir, extra_pkgs, base_pkgs, layered)
+        _add_ref(env_dir, repo_url)
+        (env_dir / ".last_used").write_text(str(int(time.time())))
+    return py
 
-        req = repo_dir / "requirements.txt"
-        if req.exists():
-            rc, out, err = _run([str(py), "-m", "pip", "install", "-r", str(req)], timeout=1800)
-            if rc != 0:
-                print(f"[WARN] requirements.txt install had issues for {repo_url}: {err or out}")
+def _build_env(key: str, env_dir: pathlib.Path, py: pathlib.Path, repo_url: str, repo_dir: pathlib.Path,
+               extra_pkgs: List[str], base_pkgs: List[str], layered: bool):
+    if (env_dir / ".ready").exists() and _base_ok(env_dir):
+        return
+    started = time.time()
+    if env_dir.exists(): shutil.rmtree(env_dir, ignore_errors=True)
+    if layered:
+        base = ensure_base_env(base_pkgs)
+        rc, out, err = _run([sys.executable, "-m", "venv", "--without-pip", str(env_dir)], log=f"{key}.venv")
+        if rc != 0: raise RuntimeError(f"venv create failed: {err or out}")
+        # addsitedir (not a bare path) so the base's own .pth files are processed too.
+        base_site = (base / ".ready").read_text().strip()
+        (_site_packages(py) / "_nb_base.pth").write_text(f"import site; site.addsitedir({base_site!r})\n")
+        (env_dir / ".base").write_text(str(base))
+    else:
+        rc, out, err = _run([sys.executable, "-m", "venv", str(env_dir)], log=f"{key}.venv")
+        if rc != 0: raise RuntimeError(f"venv create failed: {err or out}")
 
-        if extra_pkgs:
-            rc, out, err = _run([str(py), "-m", "pip", "install"] + extra_pkgs, timeout=900)
-            if rc != 0:
-                print(f"[WARN] extra packages failed for {repo_url}: {err or out}")
+    # Base (standalone envs only), requirements.txt and extras in a single resolve.
+    inst = installer()
+    req = (repo_dir / "requirements.txt").resolve()
+    args = ([] if layered else ["--upgrade"] + base_pkgs) + (["-r", str(req)] if req.exists() else []) + extra_pkgs
+    t0 = time.time()
+    ok, locked = True, False
+    if args:
+        rc, out, err, locked = _install_locked(inst, py, key, args, timeout=1800, cwd=repo_dir)
+        if rc != 0:
+            # Something in the combined set doesn't resolve: install what does, in stages as before.
+            print(f"[WARN] combined install failed for {repo_url}; installing base/requirements/extras separately: {(err or out)[-500:]}")
+            ok = False
+            if not layered:
+                rc, out, err = inst.install(py, ["--upgrade"] + base_pkgs, timeout=1200, log=f"{key}.base")
+                if rc != 0: raise RuntimeError(f"{inst.name} base install failed: {err or out}")
+            for step, part, timeout in (("requirements", ["-r", str(req)] if req.exists() else [], 1800),
+                                        ("extras", extra_pkgs, 900)):
+                if part:
+                    rc, out, err = inst.install(py, part, timeout, cwd=repo_dir, log=f"{key}.{step}")
+                    if rc != 0:
+                        print(f"[WARN] {' '.join(part)[:80]} failed for {repo_url}: {err or out}")
+    install_seconds = time.time() - t0
 
-        kern_name = f"nb-{key}"
-        _run([str(py), "-m", "ipykernel", "install", "--user", "--name", kern_name], timeout=300)
+    kern_name = f"nb-{key}"
+    _run([str(py), "-m", "ipykernel", "install", "--user", "--name", kern_name], timeout=300, log=f"{key}.kernel")
+    if (LOCKS / f"{key}.txt").exists():
+        shutil.copyfile(LOCKS / f"{key}.txt", env_dir / "requirements.lock")
+    (env_dir / ".ready").write_text(repo_url)
+    _record_build(key, "layered" if layered else "full", time.time() - started, _du(env_dir), backend=inst.name,
+                  install_seconds=round(install_seconds, 1), from_lock=locked, install_ok=ok)
 
-    (env_dir / ".last_used").write_text(str(int(time.time())))
-    return py
+def _stamp(p: pathlib.Path, fallback: pathlib.Path) -> float:
+    try:
+        return int(p.read_text())
+    except Exception:
+        return fallback.stat().st_mtime
 
 def prune_envs(older_than_days: int = 14):
+    """
+    Drop repo refs unused for N days, then delete envs that no repo refers to
+    and that were themselves unused for N days (.last_used), and base envs no
+    remaining env is layered on.
+    """
     cutoff = time.time() - older_than_days * 86400
-    for d in ENVS.glob("*"):
-        if not d.is_dir(): continue
-        stamp = d / ".last_used"
-        try:
-            t = int(stamp.read_text())
-        except Exception:
-            t = d.stat().st_mtime
-        if t < cutoff:
-            shutil.rmtree(d, ignore_errors=True)
-
+    dirs = [d for d in ENVS.glob("*") if d.is_dir() and not d.name.startswith(".")]
+    live_bases = set()
+    for d in dirs:
+        if d.name.startswith("_base-"): continue
+        with _env_lock(d.name):
+            refs = d / ".refs"
+            if refs.is_dir():
+                for r in list(refs.iterdir()):
+                    if _stamp(r, r) < cutoff: r.unlink(missing_ok=True)
+            dead = not (refs.is_dir() and any(refs.iterdir())) and _stamp(d / ".last_used", d) < cutoff
+            if dead:
+                shutil.rmtree(d, ignore_errors=True)
+                for f in LOGS.glob(f"{d.name}.*"):
+                    f.unlink(missing_ok=True)
+            elif (d / ".base").exists():
+                live_bases.add(pathlib.Path((d / ".base").read_text().strip()).name)
+    for d in dirs:
+        if d.name.startswith("_base-") and d.name not in live_bases and _stamp(d / ".last_used", d) < cutoff:
+            with _env_lock(d.name):
+                shutil.rmtree(d, ignore_errors=True)
+                for f in LOGS.glob(f"{d.name}.*"):
+                    f.unlink(missing_ok=True)
@@ -1,50 +1,254 @@
-import sys, time, pathlib, re
+import os, sys, json, time, pathlib, re
+from datetime import datetime
 from typing import Dict, Any, List, Tuple, Optional
-from utils import run, slug, ART
+import nbformat
+from utils import slug, ART
+from nbstream import read_code_cells
+from deps import analyze, notebook_sources, requirements_lines
+from limits import Limits, Watchdog, BREACHES, TAIL_BYTES, run_limited
+from runstore import RunStore, run_store
 
 HERE = pathlib.Path(__file__).resolve().parent
 WORK = HERE / "work"; WORK.mkdir(exist_ok=True)
 RUNS = HERE / "artifacts" / "nb_runs"; RUNS.mkdir(parents=True, exist_ok=True)
 
 BASE_DEPS = ["numpy","pandas","matplotlib","scikit-learn"]
+_ANSI = re.compile(r"\x1b\[[0-9;]*m")
 
-def infer_installs(nb_path: str) -> List[str]:
-    txt = pathlib.Path(nb_path).read_text(errors="ignore")
-    pkgs = set()
-    for pat, name in [
-        (r"\bimport\s+torch\b", "torch"),
-        (r"\bimport\s+tensorflow\b", "tensorflow"),
-        (r"\bimport\s+xgboost\b", "xgboost"),
-        (r"\bimport\s+lightgbm\b", "lightgbm"),
-        (r"\bfrom\s+transformers\b|\bimport\s+transformers\b", "transformers"),
-        (r"\bimport\s+seaborn\b", "seaborn"),
-        (r"\bimport\s+statsmodels\b", "statsmodels"),
-    ]:
-        if re.search(pat, txt): pkgs.add(name)
-    return sorted(pkgs)
+def infer_installs(nb_path: str, repo_dir: Optional[str] = None, provided: Optional[List[str]] = None) -> List[str]:
+    """
+    Distributions a notebook imports (or %pip installs) beyond the stdlib,
+    repo-local modules, `provided` specs (the base packages) and the repo's
+    requirements.txt. See deps.analyze.
+    """
+    p = pathlib.Path(nb_path).resolve()
+    nb = read_code_cells(str(p)) or nbformat.read(str(p), as_version=4)
+    dirs = [p.parent] + ([pathlib.Path(repo_dir).resolve()] if repo_dir else [])
+    reqs = requirements_lines(pathlib.Path(repo_dir)) if repo_dir else []
+    return analyze(notebook_sources(nb), dirs, provided=list(provided or []) + reqs)["install"]
 
 def execute_notebook(nb_path: str, out_path: str, allow_installs: bool, per_notebook_seconds: int,
-                     python_exe: Optional[str] = None) -> Dict[str, Any]:
+                     python_exe: Optional[str] = None, limits: Optional[Limits] = None,
+                     store: Optional[RunStore] = None) -> Dict[str, Any]:
+    """
+    Run the notebook with papermill in a subprocess. papermill writes
+    out_path once, at the end, which is then compacted into the run store and
+    removed: a run killed at its timeout leaves no record or cell stats.
+    Per-cell records need the pool engine. Output goes to
+    <slug>.log.out.gz / .err.gz.
+    """
+    store = store or run_store()
     log_path = RUNS / (slug(nb_path) + ".log")
+    out_log, err_log = pathlib.Path(f"{log_path}.out.gz"), pathlib.Path(f"{log_path}.err.gz")
+    for stale in (out_log, err_log, pathlib.Path(out_path)):
+        stale.unlink(missing_ok=True)
     started = time.time()
     status, err_type, err_msg = "unknown", "", ""
+    cells: List[Dict[str, Any]] = []
+    out_nb, rec_path = None, None
     try:
         py = python_exe or sys.executable
         cmd = [
             str(py), "-m", "papermill", nb_path, out_path,
             "--cwd", str(pathlib.Path(nb_path).parent.resolve()),
-            "--request-save-on-cell-execute",
+            "--no-request-save-on-cell-execute",
             "--log-output",
             "--kernel", "python3",
         ]
-        rc, out, err = run(cmd, timeout=per_notebook_seconds)
-        log_path.write_text((out or "") + "\n---ERR---\n" + (err or ""))
+        # --log-output echoes every cell's output: stream it to <log>.out.gz/.err.gz, keep only the tail.
+        rc, out, err, dog = run_limited(cmd, timeout=per_notebook_seconds, limits=limits,
+                                        log_path=log_path, tail=TAIL_BYTES)
         status = "ok" if rc == 0 else ("timeout" if rc == 124 else "error")
         if rc != 0:
             err_type = "Timeout" if rc == 124 else "ExecutionError"
             err_msg = (err or out)[-1200:] if (err or out) else ""
+        if dog is not None and dog.breach:
+            status, err_type, err_msg = dog.breach, BREACHES[dog.breach], dog.detail
+        try:
+            out_nb = nbformat.read(out_path, as_version=4)
+            cells = cell_records_from_nb(out_nb, killed=status if status in ("timeout", *BREACHES) else "")
+        except Exception:
+            cells = []
     except Exception as e:
         status, err_type, err_msg = "error", e.__class__.__name__, str(e)[:1200]
     finally:
-        dur = int(time.time() - started)
-    return dict(runtime_seconds=dur, status=status, error_type=err_type, error_message=err_msg, log_path=str(log_path))
+        dur = time.time() - started
+    if out_nb is not None:
+        rec_path = store.ingest(out_path, out_nb)
+        pathlib.Path(out_path).unlink(missing_ok=True)
+    return dict(runtime_seconds=int(dur), status=status, error_type=err_type, error_message=err_msg,
+                log_path=str(out_log) if out_log.exists() else "", err_log_path=str(err_log) if err_log.exists() else "",
+                record_path=str(rec_path or ""), overhead_seconds=_overhead(cells, dur, status), **write_cell_stats(nb_path, cells))
+
+
+def _ts(s: str) -> float:
+    return datetime.fromisoformat(s.replace("Z", "+00:00")).timestamp()
+
+
+def _overhead(cells: List[Dict[str, Any]], wall: float, status: str) -> Optional[float]:
+    """
+    Wall time not spent in cells: interpreter/kernel startup, imports, teardown.
+    None for a killed run whose running cell has no record, since its time
+    would be counted as overhead.
+    """
+    if status in ("timeout", *BREACHES) and not any(r["status"] == status for r in cells):
+        return None
+    return round(max(0.0, wall - sum(r["wall_seconds"] for r in cells)), 2)
+
+
+def _first_line(cell) -> str:
+    src = cell.get("source", "")
+    src = "".join(src) if isinstance(src, list) else src
+    return next((l.strip() for l in src.splitlines() if l.strip()), "")[:120]
+
+
+def _proc_cpu_rss(pid: Optional[int]) -> Tuple[Optional[float], Optional[int]]:
+    """(CPU seconds incl. reaped children, peak RSS bytes) of a live process, from /proc (Linux only)."""
+    if not pid:
+        return None, None
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        cpu = sum(int(x) for x in fields[11:15]) / os.sysconf("SC_CLK_TCK")
+        with open(f"/proc/{pid}/status") as f:
+            hwm = next((int(l.split()[1]) * 1024 for l in f if l.startswith("VmHWM:")), None)
+        return cpu, hwm
+    except (OSError, ValueError, IndexError):
+        return None, None
+
+
+class CellProbe:
+    """
+    nbclient hooks recording per-cell wall time, kernel CPU time and peak
+    RSS. The kernel's peak-RSS counter is reset before each cell (clear_refs),
+    so peak_rss is per cell where the kernel allows it, else peak so far.
+    """
+
+    def __init__(self, pid: Optional[int], started: float):
+        self.pid, self.started = pid, started
+        self.cells: List[Dict[str, Any]] = []
+        self._open: Optional[Dict[str, Any]] = None
+
+    def before(self, cell, cell_index, **kw):
+        if self.pid:
+            try:
+                with open(f"/proc/{self.pid}/clear_refs", "w") as f:
+                    f.write("5")
+            except OSError:
+                pass
+        cpu, _ = _proc_cpu_rss(self.pid)
+        self._open = dict(cell_index=cell_index, first_line=_first_line(cell), _t=time.time(), _cpu=cpu)
+
+    def after(self, cell, cell_index, execute_reply=None, **kw):
+        status = (execute_reply or {}).get("content", {}).get("status", "ok")
+        self._close(status, cell.get("execution_count"))
+
+    def finish(self, status: str):
+        """Close a cell that never replied (timeout, dead kernel); call before the kernel is killed."""
+        if self._open is not None:
+            self._close(status, None)
+
+    def _close(self, status: str, execution_count):
+        rec, self._open = self._open, None
+        if rec is None:
+            return
+        now = time.time()
+        cpu, rss = _proc_cpu_rss(self.pid)
+        t, cpu0 = rec.pop("_t"), rec.pop("_cpu")
+        rec.update(execution_count=execution_count, status=status, wall_seconds=round(now - t, 3),
+                   cpu_seconds=round(cpu - cpu0, 3) if cpu is not None and cpu0 is not None else None,
+                   peak_rss_mb=round(rss / 2**20, 1) if rss else None, end_offset=round(now - self.started, 3))
+        self.cells.append(rec)
+
+
+def cell_records_from_nb(nb, killed: str = "") -> List[Dict[str, Any]]:
+    """
+    Per-cell records from papermill metadata (wall time only; no CPU/RSS).
+    `killed` is the status for a cell still running when the run was killed.
+    """
+    # papermill prepends an error-banner cell on failure; skip it to keep source cell indices.
+    cells = [c for c in nb.get("cells", []) if "papermill-error-cell-tag" not in c.get("metadata", {}).get("tags", [])]
+    out, t0 = [], None
+    for i, c in enumerate(cells):
+        pm = c.get("metadata", {}).get("papermill", {})
+        if c.get("cell_type") != "code" or not pm.get("start_time"):
+            continue
+        start = _ts(pm["start_time"])
+        t0 = start if t0 is None else t0
+        end = _ts(pm["end_time"]) if pm.get("end_time") else (time.time() if killed else start)
+        status = {"completed": "ok", "failed": "error"}.get(pm.get("status"), killed or pm.get("status", ""))
+        out.append(dict(cell_index=i, first_line=_first_line(c), execution_count=c.get("execution_count"), status=status,
+                        wall_seconds=round(end - start, 3), cpu_seconds=None, peak_rss_mb=None, end_offset=round(end - t0, 3)))
+    return out
+
+
+def write_cell_stats(nb_path: str, cells: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Write the per-cell sidecar (JSONL) and return the dataset summary columns."""
+    path = RUNS / (slug(nb_path) + ".cells.jsonl")
+    with open(path, "w", encoding="utf-8") as f:
+        for rec in cells:
+            f.write(json.dumps(rec) + "\n")
+    slow = max(cells, key=lambda r: r["wall_seconds"], default=None)
+    rss = [r["peak_rss_mb"] for r in cells if r.get("peak_rss_mb") is not None]
+    err = next((r for r in cells if r["status"] != "ok"), None)
+    return dict(cells_path=str(path),
+                slowest_cell=slow["cell_index"] if slow else "",
+                slowest_cell_seconds=slow["wall_seconds"] if slow else "",
+                peak_rss_mb=max(rss) if rss else "",
+                first_error_seconds=err["end_offset"] if err else "")
+
+
+def execute_notebook_pooled(nb_path: str, out_path: str, per_notebook_seconds: int, python_exe: str,
+                            pool, refill: bool = True, limits: Optional[Limits] = None,
+                            store: Optional[RunStore] = None) -> Dict[str, Any]:
+    """
+    Execute in-process with nbclient on a warm kernel from `pool` (kernels.KernelPool).
+    Same result dict as execute_notebook; the kernel is killed afterwards.
+    With `limits`, a Watchdog kills the kernel's process tree on a breach.
+    Each executed cell is appended to the run record as it completes.
+    """
+    store = store or run_store()
+    from nbclient import NotebookClient
+    from nbclient.exceptions import CellExecutionError, CellTimeoutError, DeadKernelError
+    log_path = RUNS / (slug(nb_path) + ".log")
+    started = time.time()
+    deadline = started + per_notebook_seconds
+    status, err_type, err_msg = "unknown", "", ""
+    nb, km, probe, dog, rec = None, None, None, None, None
+    try:
+        cwd = str(pathlib.Path(nb_path).parent.resolve())
+        nb = nbformat.read(nb_path, as_version=4)
+        rec = store.begin(out_path, nb)
+        km, _ = pool.acquire(python_exe, cwd, refill=refill)
+        pid = getattr(km.provisioner, "pid", None)
+        if limits and pid:
+            dog = Watchdog(pid, limits).start()
+        probe = CellProbe(pid, time.time())
+        client = NotebookClient(nb, km=km, resources={"metadata": {"path": cwd}},
+                                timeout_func=lambda cell: max(1, int(deadline - time.time())),
+                                on_cell_execute=probe.before, on_cell_executed=lambda **kw: (probe.after(**kw), rec.cell(kw["cell"], kw["cell_index"])))
+        client.execute()
+        status = "ok"
+    except CellTimeoutError as e:
+        status, err_type, err_msg = "timeout", "Timeout", _ANSI.sub("", str(e))[-1200:]
+    except (CellExecutionError, DeadKernelError) as e:
+        status, err_type, err_msg = "error", "ExecutionError", _ANSI.sub("", str(e))[-1200:]
+    except Exception as e:
+        status, err_type, err_msg = "error", e.__class__.__name__, str(e)[:1200]
+    finally:
+        if dog is not None:
+            dog.stop()
+            if dog.breach:
+                status, err_type, err_msg = dog.breach, BREACHES[dog.breach], dog.detail
+        if probe is not None:
+            probe.finish(status if status != "unknown" else "error")
+        if km is not None:
+            pool.release(km)
+        if rec is not None:
+            rec.finish(nb)
+        dur = time.time() - started
+    log_path.write_text(f"engine=pool status={status}\n" + err_msg)
+    cells = probe.cells if probe else []
+    return dict(runtime_seconds=int(dur), status=status, error_type=err_type, error_message=err_msg,
+                log_path=str(log_path), record_path=str(rec.path) if rec else "", overhead_seconds=_overhead(cells, dur, status),
+                **write_cell_stats(nb_path, cells))
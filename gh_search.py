@@ -1,12 +1,18 @@
-import os, requests, pathlib
-from typing import List, Dict, Any
+import os, json, time, random, hashlib, requests, pathlib, threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Dict, Any, Tuple, Optional, Iterable, Union
 from urllib.parse import quote_plus
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
 
 HERE = pathlib.Path(__file__).resolve().parent
 ART = HERE / "artifacts"
 ART.mkdir(exist_ok=True)
+GH_CACHE = ART / "gh_cache"
 
-GH = "https://api.github.com"
+# GITHUB_API_URL lets the client talk to a local stub server.
+GH = os.environ.get("GITHUB_API_URL", "https://api.github.com").rstrip("/")
 TOKEN = os.environ.get("GITHUB_TOKEN", "")
 
 def _headers():
@@ -15,25 +21,230 @@ def _headers():
         h["Authorization"] = f"Bearer {TOKEN}"
     return h
 
+
+class GitHubClient:
+    """
+    Thread-safe GitHub REST client on one pooled requests.Session.
+
+    - Conditional requests: ETag/Last-Modified + body are cached on disk, so
+      repeated searches get 304s (which don't count against the rate limit).
+    - Pacing: once a rate-limit resource (core/search) drops below `reserve`
+      calls, requests are spread evenly until X-RateLimit-Reset; at 0 we wait.
+    - Retries with exponential backoff on network errors, 5xx, 429 and
+      rate-limit 403s (honouring Retry-After).
+    """
+
+    def __init__(self, base: str = GH, cache_dir: Optional[pathlib.Path] = GH_CACHE,
+                 pool_size: int = 16, max_retries: int = 5, reserve: int = 50):
+        self.base = base.rstrip("/")
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_retries = max_retries
+        self.reserve = reserve
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.stats: Counter = Counter()
+        self._lock = threading.Lock()
+        self._limits: Dict[str, Tuple[int, float]] = {}   # resource -> (remaining, reset epoch)
+        self._next_slot: Dict[str, float] = {}
+
+    # -- cache -------------------------------------------------------------
+    def _cache_file(self, url: str) -> Optional[pathlib.Path]:
+        if self.cache_dir is None:
+            return None
+        return self.cache_dir / (hashlib.sha256(url.encode("utf-8")).hexdigest()[:32] + ".json")
+
+    def _cache_load(self, url: str) -> Optional[Dict[str, Any]]:
+        f = self._cache_file(url)
+        if f is None or not f.exists():
+            return None
+        try:
+            return json.loads(f.read_text())
+        except Exception:
+            return None
+
+    def _cache_store(self, url: str, r: requests.Response, body: Any):
+        f = self._cache_file(url)
+        if f is None or not (r.headers.get("ETag") or r.headers.get("Last-Modified")):
+            return
+        entry = dict(url=url, etag=r.headers.get("ETag", ""), last_modified=r.headers.get("Last-Modified", ""),
+                     link=r.headers.get("Link", ""), body=body)
+        tmp = f.with_suffix(f".{threading.get_ident()}.tmp")
+        tmp.write_text(json.dumps(entry))
+        os.replace(tmp, f)
+
+    def _count(self, key: str, n: int = 1):
+        with self._lock:
+            self.stats[key] += n
+
+    # -- rate limits -------------------------------------------------------
+    @staticmethod
+    def _resource(url: str) -> str:
+        return "search" if "/search/" in url else "core"
+
+    def _note_limits(self, url: str, r: requests.Response):
+        rem, reset = r.headers.get("X-RateLimit-Remaining"), r.headers.get("X-RateLimit-Reset")
+        if rem is None or reset is None:
+            return
+        res = r.headers.get("X-RateLimit-Resource") or self._resource(url)
+        with self._lock:
+            self._limits[res] = (int(rem), float(reset))
+
+    def _pace(self, url: str):
+        res = self._resource(url)
+        with self._lock:
+            rem, reset = self._limits.get(res, (None, 0.0))
+            now = time.time()
+            if rem is None or reset <= now or rem > self.reserve:
+                return
+            if rem <= 0:
+                wait_until = reset + 1
+            else:
+                slot = max(now, self._next_slot.get(res, now))
+                self._next_slot[res] = slot + (reset - now) / rem
+                wait_until = slot
+        if wait_until > now:
+            self._count("paced_seconds", int(wait_until - now))
+            time.sleep(wait_until - now)
+
+    def _backoff(self, attempt: int, r: Optional[requests.Response]) -> float:
+        if r is not None:
+            ra = r.headers.get("Retry-After")
+            if ra:
+                # Either delay-seconds or an HTTP-date (RFC 9110).
+                try:
+                    return max(0.0, float(ra))
+                except ValueError:
+                    pass
+                try:
+                    return max(0.0, parsedate_to_datetime(ra).timestamp() - time.time())
+                except (TypeError, ValueError):
+                    pass
+            if r.headers.get("X-RateLimit-Remaining") == "0" and r.headers.get("X-RateLimit-Reset"):
+                return max(1.0, float(r.headers["X-RateLimit-Reset"]) - time.time() + 1)
+        return min(60.0, 2 ** attempt) + random.random()
+
+    # -- requests ----------------------------------------------------------
+    def get(self, url: str) -> Tuple[Any, str]:
+        """GET a JSON resource; returns (body, Link header)."""
+        if not url.startswith("http"):
+            url = self.base + url
+        cached = self._cache_load(url)
+        for attempt in range(self.max_retries + 1):
+            headers = _headers()
+            if cached:
+                if cached.get("etag"):
+                    headers["If-None-Match"] = cached["etag"]
+                if cached.get("last_modified"):
+                    headers["If-Modified-Since"] = cached["last_modified"]
+            self._pace(url)
+            r = None
+            try:
+                r = self.session.get(url, headers=headers, timeout=60)
+                self._count("requests")
+                self._note_limits(url, r)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+            if r is not None:
+                if r.status_code == 304 and cached:
+                    self._count("not_modified")
+                    return cached["body"], cached.get("link", "")
+                limited = r.status_code == 429 or (r.status_code == 403 and (
+                    r.headers.get("X-RateLimit-Remaining") == "0" or r.headers.get("Retry-After")))
+                if not (limited or r.status_code >= 500):
+                    r.raise_for_status()
+                    body = r.json()
+                    self._cache_store(url, r, body)
+                    return body, r.headers.get("Link", "")
+                if attempt == self.max_retries:
+                    r.raise_for_status()
+            self._count("retries")
+            time.sleep(self._backoff(attempt, r))
+        raise RuntimeError(f"GET {url} failed after {self.max_retries} retries")
+
+    def paginate(self, url: str, max_items: int, key: str = "items") -> List[Dict[str, Any]]:
+        """Follow `Link: rel="next"` until `max_items` items are collected."""
+        out: List[Dict[str, Any]] = []
+        while url and len(out) < max_items:
+            body, link = self.get(url)
+            items = body.get(key, []) if isinstance(body, dict) else body
+            if not items: break
+            out.extend(items)
+            url = _next_link(link)
+        return out[:max_items]
+
+
+def _next_link(link: str) -> str:
+    for part in (link or "").split(","):
+        seg = part.split(";")
+        if len(seg) >= 2 and 'rel="next"' in seg[1]:
+            return seg[0].strip().strip("<>")
+    return ""
+
+
+_default: Optional[GitHubClient] = None
+_default_lock = threading.Lock()
+
+def client() -> GitHubClient:
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = GitHubClient()
+        return _default
+
+
 def search_repos(query: str, max_repos: int = 50) -> List[Dict[str, Any]]:
-    out = []
-    page, per_page = 1, 30
-    while len(out) < max_repos:
-        q = quote_plus(query)
-        url = f"{GH}/search/repositories?q={q}&sort=stars&order=desc&per_page={per_page}&page={page}"
-        r = requests.get(url, headers=_headers(), timeout=60); r.raise_for_status()
-        items = r.json().get("items", [])
-        if not items: break
-        out.extend(items)
-        if len(items) < per_page: break
-        page += 1
-    return out[:max_repos]
+    per_page = min(100, max(1, max_repos))
+    q = quote_plus(query)
+    url = f"{client().base}/search/repositories?q={q}&sort=stars&order=desc&per_page={per_page}&page=1"
+    return client().paginate(url, max_repos, key="items")
 
-def list_ipynb_in_repo(full_name: str, max_files: int = 5) -> List[Dict[str, Any]]:
-    r = requests.get(f"{GH}/repos/{full_name}", headers=_headers(), timeout=60); r.raise_for_status()
-    repo = r.json(); branch = repo["default_branch"]
-    r = requests.get(f"{GH}/repos/{full_name}/git/trees/{branch}?recursive=1", headers=_headers(), timeout=60); r.raise_for_status()
-    tree = r.json().get("tree", [])
+def get_repo_tree(full_name: str, branch: Optional[str] = None) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """Repo metadata and recursive tree. Pass `branch` (e.g. from search results) to skip the metadata call."""
+    repo: Dict[str, Any] = {"full_name": full_name, "default_branch": branch}
+    if not branch:
+        repo, _ = client().get(f"/repos/{full_name}")
+        branch = repo["default_branch"]
+    body, _ = client().get(f"/repos/{full_name}/git/trees/{branch}?recursive=1")
+    return repo, body.get("tree", [])
+
+def get_repo_trees(repos: Iterable[Union[str, Dict[str, Any]]], workers: int = 8
+                   ) -> Dict[str, Union[Tuple[Dict[str, Any], List[Dict[str, Any]]], Exception]]:
+    """
+    Fetch trees for many repos concurrently. `repos` are full names or search
+    result dicts (whose default_branch saves a round-trip).
+    Returns {full_name: (repo, tree) or the exception}.
+    """
+    todo = {}
+    for r in repos:
+        if isinstance(r, str):
+            todo[r] = None
+        else:
+            todo[r["full_name"]] = r.get("default_branch")
+    out: Dict[str, Any] = {}
+    if not todo:
+        return out
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(todo))), thread_name_prefix="gh") as ex:
+        futs = {ex.submit(get_repo_tree, name, branch): name for name, branch in todo.items()}
+        for f in as_completed(futs):
+            try:
+                out[futs[f]] = f.result()
+            except Exception as e:
+                out[futs[f]] = e
+    return out
+
+def notebooks_in_tree(tree: List[Dict[str, Any]], max_files: int = 5) -> List[Dict[str, Any]]:
     nbs = [t for t in tree if t.get("path","").endswith(".ipynb") and t.get("type")=="blob"]
     nbs = [t for t in nbs if t.get("size", 0) <= 2_500_000]  # ~2.5MB cap
     return nbs[:max_files]
+
+def tree_bytes(tree: List[Dict[str, Any]]) -> int:
+    return sum(int(t.get("size", 0)) for t in tree if t.get("type") == "blob")
+
+def list_ipynb_in_repo(full_name: str, max_files: int = 5) -> List[Dict[str, Any]]:
+    _, tree = get_repo_tree(full_name)
+    return notebooks_in_tree(tree, max_files)
@@ -0,0 +1,150 @@
+import time, threading, subprocess
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional, Set, Tuple
+
+from jupyter_client import AsyncKernelManager
+from jupyter_client.kernelspec import KernelSpec
+from jupyter_core.utils import run_sync
+
+from limits import Limits, kill_tree
+
+# Run in each kernel before it is handed out, so notebooks don't pay for these imports.
+WARM_CODE = """
+import importlib as _il
+for _m in ("numpy", "pandas", "matplotlib"):
+    try:
+        _il.import_module(_m)
+    except Exception:
+        pass
+del _il, _m
+"""
+
+
+class EnvKernelManager(AsyncKernelManager):
+    """
+    Kernel manager for a given env python; no kernelspec install needed.
+    Async because nbclient's sync-client path blocks on iopub and never
+    enforces cell timeouts.
+    """
+
+    def __init__(self, python_exe: str, **kwargs):
+        super().__init__(**kwargs)
+        self._kernel_spec = KernelSpec(argv=[python_exe, "-m", "ipykernel_launcher", "-f", "{connection_file}"],
+                                       display_name=python_exe, language="python")
+
+
+@run_sync
+async def _run_code(km: AsyncKernelManager, code: str, timeout: float):
+    kc = km.client()
+    kc.start_channels()
+    try:
+        await kc.wait_for_ready(timeout=timeout)
+        if code:
+            reply = await kc.execute_interactive(code, store_history=False, timeout=timeout, output_hook=lambda msg: None)
+            if reply["content"].get("status") != "ok":
+                raise RuntimeError(f"kernel setup failed: {reply['content'].get('ename', '')}")
+    finally:
+        kc.stop_channels()
+
+
+class KernelPool:
+    """
+    Pre-started, pre-warmed kernels per env python.
+
+    A kernel runs exactly one notebook and is then killed, so nothing leaks
+    between notebooks; `acquire(refill=True)` starts the replacement for the
+    same env right away, so it warms up while the current notebook runs.
+    At most `max_idle` spare kernels are kept; the oldest are shut down first.
+    `limits` (core affinity, CPU rlimit) are applied to each kernel at start.
+    """
+
+    def __init__(self, max_idle: int = 2, warm_code: str = WARM_CODE, startup_timeout: int = 120,
+                 limits: Optional[Limits] = None):
+        self.max_idle = max(0, int(max_idle))
+        self.limits = limits
+        self.warm_code = warm_code
+        self.startup_timeout = startup_timeout
+        self._lock = threading.Lock()
+        self._idle: List[Tuple[str, Future]] = []
+        self._busy: Set[AsyncKernelManager] = set()
+        self._ex = ThreadPoolExecutor(max_workers=max(2, self.max_idle), thread_name_prefix="kwarm")
+
+    def _start(self, python_exe: str) -> AsyncKernelManager:
+        km = EnvKernelManager(python_exe)
+        # Kernel output reaches us over iopub; its own stdout/stderr is just launcher noise.
+        run_sync(km.start_kernel)(stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if self.limits and getattr(km.provisioner, "pid", None):
+            self.limits.apply(km.provisioner.pid)
+        try:
+            _run_code(km, self.warm_code, self.startup_timeout)
+        except Exception:
+            self.release(km)
+            raise
+        return km
+
+    def _discard(self, fut: Future):
+        def stop(f: Future):
+            if f.exception() is None:
+                self.release(f.result())
+        fut.add_done_callback(stop)
+
+    def acquire(self, python_exe: str, cwd: str, refill: bool = True) -> Tuple[AsyncKernelManager, float]:
+        """A ready kernel for `python_exe`, chdir'ed to `cwd`. Returns (km, seconds waited)."""
+        started = time.time()
+        python_exe = str(python_exe)
+        fut: Optional[Future] = None
+        with self._lock:
+            for i, (py, f) in enumerate(self._idle):
+                if py == python_exe:
+                    fut = self._idle.pop(i)[1]
+                    break
+            if refill and self.max_idle:
+                self._idle.append((python_exe, self._ex.submit(self._start, python_exe)))
+            while len(self._idle) > self.max_idle:
+                self._discard(self._idle.pop(0)[1])
+        km = None
+        if fut is not None:
+            try:
+                km = fut.result()
+            except Exception:
+                km = None
+        if km is None or not run_sync(km.is_alive)():
+            if km is not None:
+                self.release(km)
+            km = self._start(python_exe)
+        try:
+            _run_code(km, f"import os as _os; _os.chdir({cwd!r}); del _os", self.startup_timeout)
+        except Exception:
+            self.release(km)
+            raise
+        with self._lock:
+            self._busy.add(km)
+        return km, time.time() - started
+
+    def kill_busy(self) -> int:
+        """Kill the process tree of every kernel handed out and not yet released; returns how many."""
+        with self._lock:
+            busy = list(self._busy)
+        for km in busy:
+            pid = getattr(km.provisioner, "pid", None)
+            if pid:
+                kill_tree(pid)
+        return len(busy)
+
+    def release(self, km: AsyncKernelManager):
+        with self._lock:
+            self._busy.discard(km)
+        try:
+            run_sync(km.shutdown_kernel)(now=True)
+        except Exception:
+            pass
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for _, f in idle:
+            try:
+                self.release(f.result())
+            except Exception:
+                pass
+        self._ex.shutdown(wait=True)
@@ -0,0 +1,273 @@
+import os, gzip, signal, subprocess, threading
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import resource
+except ImportError:   # Windows
+    resource = None
+
+_CLK = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+# Bytes of each output stream kept in memory by run_limited when bounded; the rest is only in the log file.
+TAIL_BYTES = 64 * 1024
+
+# status / error_type recorded for each kind of breach
+BREACHES = {"oom": "MemoryLimit", "cpu_limit": "CPULimit", "proc_limit": "ProcessLimit"}
+
+
+class Limits:
+    """
+    Resource limits for one notebook execution; 0 disables a limit.
+
+    mem_mb: memory of the process tree (summed PSS); cpu_seconds: CPU time
+    of the tree; max_procs: live processes in the tree; cpus: cores the
+    tree may be scheduled on.
+    """
+
+    def __init__(self, mem_mb: int = 0, cpu_seconds: int = 0, max_procs: int = 0, cpus: int = 0):
+        self.mem_mb, self.cpu_seconds, self.max_procs, self.cpus = int(mem_mb), int(cpu_seconds), int(max_procs), int(cpus)
+
+    def __bool__(self) -> bool:
+        return bool(self.mem_mb or self.cpu_seconds or self.max_procs or self.cpus)
+
+    def apply(self, pid: int):
+        """
+        Pin `pid` to `cpus` cores and give it a per-process RLIMIT_CPU backstop.
+        Applied from the parent (prlimit) rather than via preexec_fn, which
+        is unsafe with the run threads; children forked later inherit both.
+        """
+        if self.cpus and hasattr(os, "sched_setaffinity"):
+            try:
+                os.sched_setaffinity(pid, sorted(os.sched_getaffinity(0))[:self.cpus])
+            except OSError:
+                pass
+        if self.cpu_seconds and resource is not None and hasattr(resource, "prlimit"):
+            soft = self.cpu_seconds + 30   # the watchdog normally fires first
+            try:
+                resource.prlimit(pid, resource.RLIMIT_CPU, (soft, soft + 10))
+            except (OSError, ValueError):
+                pass
+
+
+def _children_map() -> Dict[int, List[int]]:
+    kids: Dict[int, List[int]] = {}
+    for d in os.listdir("/proc"):
+        if not d.isdigit():
+            continue
+        try:
+            with open(f"/proc/{d}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        kids.setdefault(ppid, []).append(int(d))
+    return kids
+
+
+def process_tree(pid: int) -> List[int]:
+    """pid and all its live descendants (Linux /proc; just [pid] elsewhere)."""
+    if not os.path.isdir("/proc"):
+        return [pid]
+    kids, out, todo = _children_map(), [], [pid]
+    while todo:
+        p = todo.pop()
+        out.append(p)
+        todo.extend(kids.get(p, []))
+    return out
+
+
+def _pss(pid: int) -> Optional[int]:
+    """Proportional set size: shared pages split between sharers, so forked workers aren't double-counted."""
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _usage(pid: int) -> Tuple[int, float]:
+    """(memory bytes, CPU seconds incl. reaped children) of one process; memory is PSS, else RSS."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        cpu = sum(int(x) for x in fields[11:15]) / _CLK
+        mem = _pss(pid)
+        return (int(fields[21]) * os.sysconf("SC_PAGE_SIZE") if mem is None else mem), cpu
+    except (OSError, ValueError, IndexError):
+        return 0, 0.0
+
+
+def tree_usage(pid: int) -> Tuple[int, float, int]:
+    """(memory bytes, CPU seconds, process count) summed over the tree."""
+    mem, cpu, n = 0, 0.0, 0
+    for p in process_tree(pid):
+        m, c = _usage(p)
+        mem, cpu, n = mem + m, cpu + c, n + 1
+    return mem, cpu, n
+
+
+def kill_tree(pid: int, sig: int = signal.SIGKILL):
+    """Kill pid and every descendant. Kernels run in their own session, so killpg would miss them."""
+    for p in reversed(process_tree(pid)):
+        try:
+            os.kill(p, sig)
+        except OSError:
+            pass
+
+
+class Watchdog:
+    """
+    Samples a process tree every `interval` seconds and kills the whole tree
+    on the first limit it exceeds. `breach` is then one of BREACHES and
+    `detail` says by how much.
+    """
+
+    def __init__(self, pid: int, limits: Limits, interval: float = 0.5):
+        self.pid, self.limits, self.interval = pid, limits, interval
+        self.breach, self.detail = "", ""
+        self.peak_mem = 0
+        self._stop = threading.Event()
+        self._cpu0 = tree_usage(pid)[1]   # e.g. a warm kernel's start-up imports
+        self._thread = threading.Thread(target=self._loop, name=f"watchdog-{pid}", daemon=True)
+
+    def _check(self) -> bool:
+        lim = self.limits
+        mem, cpu, n = tree_usage(self.pid)
+        self.peak_mem = max(self.peak_mem, mem)
+        cpu -= self._cpu0
+        if lim.mem_mb and mem > lim.mem_mb * 2**20:
+            self.breach, self.detail = "oom", f"memory {mem / 2**20:.0f} MB > limit {lim.mem_mb} MB"
+        elif lim.cpu_seconds and cpu > lim.cpu_seconds:
+            self.breach, self.detail = "cpu_limit", f"CPU {cpu:.0f}s > limit {lim.cpu_seconds}s"
+        elif lim.max_procs and n > lim.max_procs:
+            self.breach, self.detail = "proc_limit", f"{n} processes > limit {lim.max_procs}"
+        return bool(self.breach)
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            if self._check():
+                kill_tree(self.pid)
+                return
+
+    def start(self) -> "Watchdog":
+        if self.limits.mem_mb or self.limits.cpu_seconds or self.limits.max_procs:
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+
+class _Pump(threading.Thread):
+    """Copies one pipe to an optional gzip log, keeping the last `tail` bytes (everything if tail is None)."""
+
+    def __init__(self, pipe, log_path=None, tail: Optional[int] = None):
+        super().__init__(daemon=True)
+        self.pipe, self.log_path, self.tail = pipe, log_path, tail
+        self.chunks: deque = deque()
+        self.kept = self.total = 0
+        self._lock = threading.Lock()   # text() may run while a timed-out join left the pump appending
+
+    def run(self):
+        sink = gzip.open(self.log_path, "wb", compresslevel=3) if self.log_path else None
+        try:
+            while True:
+                b = self.pipe.read1(1 << 16)
+                if not b:
+                    break
+                if sink is not None:
+                    sink.write(b)
+                with self._lock:
+                    self.total += len(b)
+                    self.chunks.append(b)
+                    self.kept += len(b)
+                    while self.tail is not None and self.kept - len(self.chunks[0]) >= self.tail:
+                        self.kept -= len(self.chunks.popleft())
+        except (OSError, ValueError):
+            pass
+        finally:
+            if sink is not None:
+                sink.close()
+
+    def text(self) -> str:
+        with self._lock:
+            data, total = b"".join(self.chunks), self.total
+        if self.tail is not None and len(data) > self.tail:
+            data = data[-self.tail:]
+        s = data.decode("utf-8", errors="replace")
+        if total > len(data):
+            s = f"[... {total - len(data)} earlier bytes" + (f" in {self.log_path}" if self.log_path else "") + "]\n" + s
+        return s
+
+
+# Roots of the process trees run_limited is waiting on, for kill_running().
+_running: Dict[int, subprocess.Popen] = {}
+_running_lock = threading.Lock()
+
+
+def kill_running() -> int:
+    """Kill every process tree run_limited is waiting on, e.g. on shutdown; returns how many."""
+    with _running_lock:
+        procs = list(_running.values())
+    for p in procs:
+        _kill_all(p)
+    return len(procs)
+
+
+def _kill_all(p: subprocess.Popen):
+    """The process tree, then whatever is left in the process group (children already reparented away)."""
+    kill_tree(p.pid)
+    try:
+        os.killpg(p.pid, signal.SIGKILL)
+    except (OSError, AttributeError):
+        pass
+
+
+def run_limited(cmd: List[str], timeout: Optional[int] = None, limits: Optional[Limits] = None,
+                cwd=None, env=None, log_path=None, tail: Optional[int] = None) -> Tuple[int, str, str, Optional[Watchdog]]:
+    """
+    utils.run with resource limits. The whole process tree is killed on a
+    breach, on timeout (rc 124) or if the caller is interrupted. Returns
+    (rc, out, err, watchdog).
+
+    stdout/stderr are read by two threads as they are produced instead of
+    piling up in communicate(). With `log_path`, both are streamed to
+    <log_path>.out.gz / .err.gz; with `tail`, only their last `tail` bytes
+    are kept in memory and returned.
+    """
+    p = subprocess.Popen(cmd, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         start_new_session=os.name == "posix")
+    with _running_lock:
+        _running[p.pid] = p
+    pumps = [_Pump(p.stdout, f"{log_path}.out.gz" if log_path else None, tail),
+             _Pump(p.stderr, f"{log_path}.err.gz" if log_path else None, tail)]
+    for t in pumps:
+        t.start()
+    dog = None
+    if limits:
+        limits.apply(p.pid)
+        dog = Watchdog(p.pid, limits).start()
+    try:
+        rc = p.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        _kill_all(p)
+        p.wait()
+        rc = 124
+    except BaseException:
+        _kill_all(p)
+        raise
+    finally:
+        with _running_lock:
+            _running.pop(p.pid, None)
+        if dog is not None:
+            dog.stop()
+        for t, pipe in zip(pumps, (p.stdout, p.stderr)):
+            t.join(timeout=10)   # a detached grandchild may still hold the pipe open
+            if not t.is_alive():
+                pipe.close()
+    return rc, pumps[0].text(), pumps[1].text(), dog
@@ -0,0 +1,186 @@
+"""
+Streaming .ipynb reader for triage.
+
+Only files of at least STREAM_MIN_BYTES (1 MB) are streamed; smaller ones,
+most notebooks, are read whole with json.loads and trimmed afterwards.
+Streamed notebooks: scans the memory-mapped file and decodes only what triage looks at: the
+top-level nbformat/metadata keys and each cell's cell_type and source.
+Everything else (outputs, attachments, cell metadata) is skipped by bracket
+depth, jumping over strings with mmap.find (memchr), so base64 image payloads
+are never copied or decoded. Skipped values are checked for balanced
+brackets only, not validated as JSON.
+"""
+import os, re, json, mmap
+from typing import Any, Callable, Dict, Optional
+
+_WS = re.compile(rb"[ \t\r\n]*")
+_STRUCT = re.compile(rb'[\[\]{}"]')
+_SCALAR = re.compile(rb"-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?|true|false|null")
+_OPEN = {0x5B: 0x5D, 0x7B: 0x7D}   # [ -> ], { -> }
+_KEEP_CELL_KEYS = ("cell_type", "source")
+
+
+class StreamParseError(ValueError):
+    pass
+
+
+def _ws(buf, pos: int) -> int:
+    return _WS.match(buf, pos).end()
+
+
+def _expect(buf, pos: int, ch: bytes) -> int:
+    if buf[pos:pos + 1] != ch:
+        raise StreamParseError(f"expected {ch!r} at {pos}")
+    return pos + 1
+
+
+def _str_end(buf, pos: int) -> int:
+    """End offset of the string whose opening quote is at `pos`."""
+    j = pos + 1
+    while True:
+        j = buf.find(b'"', j)
+        if j < 0:
+            raise StreamParseError(f"unterminated string at {pos}")
+        k = j - 1
+        while buf[k] == 0x5C:   # backslash
+            k -= 1
+        if (j - 1 - k) % 2 == 0:
+            return j + 1
+        j += 1
+
+
+def _skip(buf, pos: int) -> int:
+    """End offset of the JSON value starting at `pos`, without decoding it."""
+    c = buf[pos:pos + 1]
+    if c == b'"':
+        return _str_end(buf, pos)
+    if c in (b"[", b"{"):
+        stack = []
+        j = pos
+        while True:
+            m = _STRUCT.search(buf, j)
+            if not m:
+                raise StreamParseError(f"unterminated container at {pos}")
+            i = m.start()
+            ch = buf[i]
+            if ch == 0x22:
+                j = _str_end(buf, i)
+                continue
+            if ch in _OPEN:
+                stack.append(_OPEN[ch])
+            elif not stack or stack.pop() != ch:
+                raise StreamParseError(f"unbalanced bracket at {i}")
+            elif not stack:
+                return i + 1
+            j = i + 1
+    m = _SCALAR.match(buf, pos)
+    if not m:
+        raise StreamParseError(f"bad value at {pos}")
+    return m.end()
+
+
+def _members(buf, pos: int, on_member: Callable[[str, int], int]) -> int:
+    """Walk an object; on_member(key, value_pos) returns the value's end offset."""
+    pos = _ws(buf, _expect(buf, _ws(buf, pos), b"{"))
+    if buf[pos:pos + 1] == b"}":
+        return pos + 1
+    while True:
+        if buf[pos:pos + 1] != b'"':
+            raise StreamParseError(f"expected key at {pos}")
+        end = _str_end(buf, pos)
+        raw = buf[pos + 1:end - 1]
+        key = json.loads(buf[pos:end]) if b"\\" in raw else raw.decode("utf-8")
+        pos = _ws(buf, _expect(buf, _ws(buf, end), b":"))
+        pos = _ws(buf, on_member(key, pos))
+        if buf[pos:pos + 1] == b",":
+            pos = _ws(buf, pos + 1)
+            continue
+        return _expect(buf, pos, b"}")
+
+
+def _items(buf, pos: int, on_item: Callable[[int], int]) -> int:
+    pos = _ws(buf, _expect(buf, _ws(buf, pos), b"["))
+    if buf[pos:pos + 1] == b"]":
+        return pos + 1
+    while True:
+        pos = _ws(buf, on_item(pos))
+        if buf[pos:pos + 1] == b",":
+            pos = _ws(buf, pos + 1)
+            continue
+        return _expect(buf, pos, b"]")
+
+
+def parse_code_cells(buf) -> Dict[str, Any]:
+    """
+    Parse a notebook buffer into {"nbformat", "nbformat_minor", "metadata": True,
+    "cells": [{"cell_type", "source"}]}. Raises StreamParseError on bad input.
+    """
+    doc: Dict[str, Any] = {}
+
+    def on_cell(pos: int) -> int:
+        cell: Dict[str, Any] = {}
+
+        def on_field(key: str, vpos: int) -> int:
+            end = _skip(buf, vpos)
+            if key in _KEEP_CELL_KEYS:
+                cell[key] = json.loads(buf[vpos:end].decode("utf-8"))
+            return end
+
+        end = _members(buf, pos, on_field)
+        doc["cells"].append(cell)
+        return end
+
+    def on_top(key: str, vpos: int) -> int:
+        if key == "cells":
+            doc["cells"] = []
+            return _items(buf, vpos, on_cell)
+        end = _skip(buf, vpos)
+        if key in ("nbformat", "nbformat_minor"):
+            doc[key] = json.loads(buf[vpos:end].decode("utf-8"))
+        elif key == "metadata":
+            doc[key] = True
+        return end
+
+    start = 3 if buf[:3] == b"\xef\xbb\xbf" else 0
+    end = _ws(buf, _members(buf, start, on_top))
+    if end != len(buf):
+        raise StreamParseError(f"trailing data at {end}")
+    return doc
+
+
+def _from_json(data: bytes) -> Dict[str, Any]:
+    nb = json.loads(data)
+    if not isinstance(nb, dict) or not isinstance(nb.get("cells"), list):
+        raise StreamParseError("no cells list")
+    doc: Dict[str, Any] = {k: nb[k] for k in ("nbformat", "nbformat_minor") if k in nb}
+    if "metadata" in nb:
+        doc["metadata"] = True
+    doc["cells"] = [{k: c[k] for k in _KEEP_CELL_KEYS if k in c} for c in nb["cells"] if isinstance(c, dict)]
+    return doc
+
+
+# Below this size json.loads in C beats walking tokens in Python, and the
+# outputs it decodes are small; above it the skip-scan wins on time and memory.
+STREAM_MIN_BYTES = 1024 * 1024
+
+
+def read_code_cells(path: str, stream_min_bytes: int = STREAM_MIN_BYTES) -> Optional[Dict[str, Any]]:
+    """
+    Read just the cells of a v4 notebook file: json.loads for small files,
+    the mmap skip-scan for large ones. Returns None when the file isn't a
+    well-formed v4 notebook, so callers can fall back to nbformat.
+    """
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < stream_min_bytes:
+                data = f.read()
+                doc = _from_json(data[3:] if data[:3] == b"\xef\xbb\xbf" else data)
+            else:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    doc = parse_code_cells(mm)
+    except (OSError, ValueError, UnicodeDecodeError):
+        return None
+    if doc.get("nbformat") != 4 or "metadata" not in doc or "cells" not in doc:
+        return None
+    return doc
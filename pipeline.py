@@ -0,0 +1,288 @@
+"""
+search -> trees -> clone -> triage -> run as one streaming pipeline.
+
+Each stage is a few threads reading a bounded queue, so a notebook can be
+executing while later repos are still being listed, cloned and triaged,
+and a slow stage holds back the ones feeding it instead of letting work
+pile up in memory. Every finished item is written where the standalone
+commands keep it (candidates.jsonl, the triage cache, the dataset store),
+so after a crash a rerun skips straight past everything already done.
+"""
+import os, sys, queue, argparse, threading
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from gh_search import search_repos, get_repo_tree, client
+from triage import triage_batch, TriageCache
+from repos import ensure_repo_checked_out, repo_dir_for, head_sha, blob_shas
+from limits import Limits
+from predict import RuntimePredictor, adaptive_timeout
+from store import CandidateLog, is_candidate
+from runstore import run_store
+from build_dataset import repo_candidates, triage_row, untriaged_row, keep_run_fields, run_one, open_store
+
+_DONE = object()
+
+
+class Stage:
+    """
+    `workers` threads applying fn(item) -> iterable of outputs to everything
+    on `inbox` and putting the outputs on `outbox`. A failing item is logged
+    and counted, not fatal. The _DONE sentinel is passed on once the last
+    worker has drained the inbox. Once `stop` is set, items are drained
+    without being processed, so the stages feeding this one don't block.
+    """
+
+    def __init__(self, name: str, fn: Callable[[Any], Iterable[Any]], workers: int,
+                 inbox: "queue.Queue", outbox: Optional["queue.Queue"] = None,
+                 stop: Optional[threading.Event] = None):
+        self.name, self.fn, self.inbox, self.outbox, self.stop = name, fn, inbox, outbox, stop
+        self.workers = max(1, int(workers))
+        self.done = self.failed = self.skipped = 0
+        self._alive = self.workers
+        self._lock = threading.Lock()
+        self._threads = [threading.Thread(target=self._loop, name=f"{name}-{i}", daemon=True)
+                         for i in range(self.workers)]
+
+    def start(self) -> "Stage":
+        for t in self._threads:
+            t.start()
+        return self
+
+    def _loop(self):
+        while True:
+            item = self.inbox.get()
+            if item is _DONE:
+                self.inbox.put(_DONE)   # for the sibling workers
+                break
+            if self.stop is not None and self.stop.is_set():
+                with self._lock:
+                    self.skipped += 1
+                continue
+            try:
+                outs = list(self.fn(item) or ())
+                ok = True
+            except Exception as e:
+                print(f"⚠️ {self.name} failed: {type(e).__name__}: {e}")
+                outs, ok = [], False
+            with self._lock:
+                self.done += ok
+                self.failed += not ok
+            if self.outbox is not None:
+                for o in outs:
+                    self.outbox.put(o)   # blocks while the next stage is behind
+        with self._lock:
+            self._alive -= 1
+            last = self._alive == 0
+        if last and self.outbox is not None:
+            self.outbox.put(_DONE)
+
+    def join(self):
+        for t in self._threads:
+            t.join()
+
+
+class _Budget:
+    """BudgetScheduler's accounting for a stream: reserve a job's cost before it starts, settle it after."""
+
+    def __init__(self, total: int):
+        self.total, self.spent, self.reserved = int(total), 0, 0
+        self._cond = threading.Condition()
+
+    def reserve(self, cost: int) -> bool:
+        with self._cond:
+            while self.spent + self.reserved + cost > self.total:
+                if self.reserved == 0:
+                    return False   # nothing in flight can hand budget back
+                self._cond.wait()
+            self.reserved += cost
+            return True
+
+    def left(self) -> int:
+        with self._cond:
+            return self.total - self.spent - self.reserved
+
+    def settle(self, cost: int, used: int):
+        with self._cond:
+            self.reserved -= cost
+            self.spent += max(0, min(cost, int(used)))
+            self._cond.notify_all()
+
+
+def run_pipeline(args) -> Dict[str, Stage]:
+    store = open_store()
+    log = CandidateLog()
+    cache = TriageCache()
+    io_lock = threading.Lock()   # CandidateLog / TriageCache appends
+    model = RuntimePredictor().fit(store.rows())
+    budget = _Budget(args.max_total_seconds)
+    limits = Limits(mem_mb=args.mem_limit_mb, cpu_seconds=args.cpu_limit_seconds,
+                    max_procs=args.max_procs, cpus=args.cpus)
+    pool = None
+    if args.engine == "pool":
+        from kernels import KernelPool
+        pool = KernelPool(max_idle=args.workers, limits=limits)
+    procs = ProcessPoolExecutor(max_workers=args.jobs) if args.jobs > 1 else None
+    # Queued-but-not-run notebooks per repo, so the kernel pool only warms a replacement when one is needed.
+    left: Counter = Counter()
+    repo_slots: Dict[str, threading.Semaphore] = {}
+    state_lock = threading.Lock()
+    # Set once not even the cheapest notebook fits the budget; every stage then drains without working.
+    stop = threading.Event()
+    min_cost = min(args.per_notebook_seconds, args.min_timeout)
+
+    q_trees, q_clone, q_triage, q_run = (queue.Queue(maxsize=args.queue_size) for _ in range(4))
+
+    def tree_stage(r):
+        if isinstance(r, list):   # a repo's logged candidates, when resuming without a search
+            return [r]
+        _, tree = get_repo_tree(r["full_name"], r.get("default_branch"))
+        cands = repo_candidates(r, tree, args.max_nbs_per_repo)
+        with io_lock:
+            log.extend(cands)
+        return [cands] if cands else []
+
+    def clone_stage(cands: List[Dict[str, Any]]):
+        full = cands[0]["repo_full_name"]
+        try:
+            ensure_repo_checked_out(full, repo_dir_for(full), use_mirror=not args.no_mirror)
+        except Exception as e:
+            store.upsert_many(untriaged_row(c, "error", e) for c in cands)
+            raise
+        return [cands]
+
+    def triage_stage(cands: List[Dict[str, Any]]):
+        full = cands[0]["repo_full_name"]
+        repo_dir = repo_dir_for(full)
+        try:
+            commit, blobs = head_sha(repo_dir), blob_shas(repo_dir)
+        except Exception:
+            commit, blobs = "", {}
+        rows: Dict[int, Dict[str, Any]] = {}
+        keys, todo = {}, []
+        for i, c in enumerate(cands):
+            nb_abs = (repo_dir / c["notebook_path"]).resolve()
+            if not nb_abs.exists():
+                rows[i] = untriaged_row(c, "skip_missing")
+                continue
+            keys[i] = key = (full, commit, c["notebook_path"], blobs.get(c["notebook_path"], ""))
+            tri = None if not key[1] or not key[3] else cache.get(key)
+            if tri is not None:
+                rows[i] = triage_row(c, tri, key)
+            else:
+                todo.append((i, str(nb_abs), str(repo_dir)))
+        if todo:
+            done = procs.submit(triage_batch, todo).result() if procs is not None else triage_batch(todo)
+            for i, tri in done:
+                if keys[i][1] and keys[i][3]:
+                    with io_lock:
+                        cache.put(keys[i], tri)
+                rows[i] = triage_row(cands[i], tri, keys[i])
+        out = [rows[i] for i in sorted(rows)]
+        for r in out:
+            keep_run_fields(r, store.get(r["repo_url"], r["notebook_path"]))
+        store.upsert_many(out)
+        runnable = [r for r in out if is_candidate(r) and r.get("runtime_seconds") in ("", None)]
+        with state_lock:
+            left[full] += len(runnable)
+        return runnable
+
+    def run_stage(row: Dict[str, Any]):
+        repo = row["repo_url"]
+        pred = model.predict(row)
+        cost = adaptive_timeout(pred, args.per_notebook_seconds, args.timeout_factor, args.min_timeout)
+        # Budget before the repo slot: a run waiting for budget must not keep its repo's other notebooks waiting.
+        if not budget.reserve(cost):
+            with state_lock:
+                left[repo] -= 1
+            if budget.left() < min_cost and not stop.is_set():
+                stop.set()
+                print("💸 Budget exhausted; stopping search, clone and triage.")
+            return []
+        used = 0
+        try:
+            with state_lock:
+                slot = repo_slots.setdefault(repo, threading.Semaphore(args.max_per_repo))
+            with slot:
+                with state_lock:
+                    left[repo] -= 1
+                    more = left[repo] > 0
+                row, used = run_one(row, cost, layered=not args.no_base_env, pool=pool, refill=more, limits=limits)
+                row["predicted_seconds"] = round(pred, 1)
+                store.upsert(row)
+        finally:
+            budget.settle(cost, used)
+        return []
+
+    stages = {
+        "trees": Stage("trees", tree_stage, args.gh_workers, q_trees, q_clone, stop),
+        "clone": Stage("clone", clone_stage, args.clone_workers, q_clone, q_triage, stop),
+        "triage": Stage("triage", triage_stage, args.jobs, q_triage, q_run, stop),
+        "run": Stage("run", run_stage, args.workers, q_run, stop=stop),
+    }
+    for s in stages.values():
+        s.start()
+    try:
+        if args.query:
+            for r in search_repos(args.query, max_repos=args.max_repos):
+                if stop.is_set():
+                    break
+                q_trees.put(r)
+        else:
+            by_repo: Dict[str, List[Dict[str, Any]]] = {}
+            for c in log:
+                by_repo.setdefault(c["repo_full_name"], []).append(c)
+            for cands in by_repo.values():
+                if stop.is_set():
+                    break
+                q_trees.put(cands)
+        q_trees.put(_DONE)
+        for s in stages.values():
+            s.join()
+    finally:
+        if pool is not None:
+            pool.close()
+        if procs is not None:
+            procs.shutdown()
+        cache.close()
+        store.close()
+
+    if args.query:
+        st = client().stats
+        print(f"GitHub API: {st['requests']} requests, {st['not_modified']} cached (304), {st['retries']} retries")
+    print("Pipeline: " + " -> ".join(f"{n} {s.done} ok/{s.failed} failed" + (f"/{s.skipped} skipped" if s.skipped else "")
+                                     for n, s in stages.items()))
+    print(f"Budget used: {budget.spent}/{budget.total}s across {args.workers} worker(s).")
+    print(run_store().summary())
+    return stages
+
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(description="Search, clone, triage and run notebooks as one streaming pipeline.")
+    ap.add_argument("--query", default="", help="GitHub repository search query; omit to resume from candidates.jsonl")
+    ap.add_argument("--max-repos", type=int, default=50)
+    ap.add_argument("--max-nbs-per-repo", type=int, default=3)
+    ap.add_argument("--gh-workers", type=int, default=8, help="Concurrent GitHub tree requests")
+    ap.add_argument("--clone-workers", type=int, default=8, help="Repos cloned/fetched concurrently")
+    ap.add_argument("--no-mirror", action="store_true", help="Clone straight from the remote, skipping the bare-mirror cache")
+    ap.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Repos triaged concurrently (worker processes)")
+    ap.add_argument("--queue-size", type=int, default=64, help="Items buffered between two stages")
+    ap.add_argument("--per-notebook-seconds", type=int, default=480)
+    ap.add_argument("--max-total-seconds", type=int, default=3600)
+    ap.add_argument("--workers", type=int, default=1, help="Notebooks executed concurrently")
+    ap.add_argument("--max-per-repo", type=int, default=1, help="Concurrent notebooks per repo (shared checkout/venv)")
+    ap.add_argument("--no-base-env", action="store_true", help="Standalone repo envs instead of layering on the base env")
+    ap.add_argument("--engine", choices=["pool", "papermill"], default="pool")
+    ap.add_argument("--timeout-factor", type=float, default=3.0, help="Adaptive timeout = factor x predicted runtime")
+    ap.add_argument("--min-timeout", type=int, default=60, help="Lower bound for adaptive timeouts")
+    ap.add_argument("--mem-limit-mb", type=int, default=0)
+    ap.add_argument("--cpu-limit-seconds", type=int, default=0)
+    ap.add_argument("--max-procs", type=int, default=0)
+    ap.add_argument("--cpus", type=int, default=0)
+    args = ap.parse_args(argv)
+    run_pipeline(args)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
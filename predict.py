@@ -0,0 +1,101 @@
+import math
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from utils import LIB_PATS
+
+# Prior seconds per detected lib, used until there are enough past runs to fit.
+LIB_PRIOR = {"torch": 60, "tensorflow": 60, "transformers": 90, "xgboost": 20, "lightgbm": 20, "catboost": 20}
+LIBS = sorted(LIB_PATS)
+
+
+def _num(v: Any, default: float = 0.0) -> float:
+    try:
+        f = float(v)
+    except (TypeError, ValueError):
+        return default
+    return default if math.isnan(f) else f
+
+
+def _libs(row: Dict[str, Any]) -> List[str]:
+    v = row.get("libs_detected")
+    return [l for l in v.split(";") if l] if isinstance(v, str) else []
+
+
+class RuntimePredictor:
+    """
+    Predicts a notebook's runtime in seconds from triage features.
+
+    Log-linear least squares on n_cells, size_kb and the detected libs, fit
+    on past successful runs. A past runtime of the same notebook wins
+    outright; otherwise the prediction is averaged (in log space) with the
+    median runtime of the repo's other notebooks. With fewer than MIN_FIT
+    runs a fixed prior is used instead of the fit.
+    """
+
+    MIN_FIT = 20
+
+    def __init__(self):
+        self.w: Optional[np.ndarray] = None
+        self.repo_hist: Dict[str, List[float]] = {}
+        self.nb_hist: Dict[Tuple[str, str], float] = {}
+
+    @staticmethod
+    def _x(row: Dict[str, Any]) -> List[float]:
+        libs = set(_libs(row))
+        return [1.0, math.log1p(_num(row.get("n_cells"))), math.log1p(_num(row.get("size_kb")))] + \
+               [1.0 if l in libs else 0.0 for l in LIBS]
+
+    def fit(self, rows: Iterable[Dict[str, Any]]) -> "RuntimePredictor":
+        xs, ys = [], []
+        for r in rows:
+            secs = _num(r.get("runtime_seconds"), -1)
+            if r.get("status") != "ok" or secs < 0:
+                continue
+            xs.append(self._x(r))
+            ys.append(math.log1p(secs))
+            self.repo_hist.setdefault(r["repo_url"], []).append(secs)
+            self.nb_hist[(r["repo_url"], r["notebook_path"])] = secs
+        if len(ys) >= self.MIN_FIT:
+            # Small ridge term: lib indicators are often all-zero or collinear.
+            X, y = np.array(xs), np.array(ys)
+            self.w = np.linalg.solve(X.T @ X + 0.1 * np.eye(X.shape[1]), X.T @ y)
+        return self
+
+    def _prior(self, row: Dict[str, Any]) -> float:
+        return 10 + 2 * _num(row.get("n_cells")) + sum(LIB_PRIOR.get(l, 0) for l in _libs(row))
+
+    def predict(self, row: Dict[str, Any]) -> float:
+        past = self.nb_hist.get((row.get("repo_url"), row.get("notebook_path")))
+        if past is not None:
+            return max(1.0, past)
+        if self.w is not None:
+            est = float(np.expm1(np.dot(self._x(row), self.w)))
+        else:
+            est = self._prior(row)
+        hist = self.repo_hist.get(row.get("repo_url"))
+        if hist:
+            est = math.expm1((math.log1p(max(0.0, est)) + math.log1p(float(np.median(hist)))) / 2)
+        return max(1.0, est)
+
+
+def adaptive_timeout(pred: float, per_nb: int, factor: float = 3.0, floor: int = 60) -> int:
+    """Timeout for one notebook: `factor` x its prediction, at least `floor`, at most `per_nb`."""
+    return int(min(per_nb, max(floor, math.ceil(factor * pred))))
+
+
+def plan_jobs(rows: List[Dict[str, Any]], history: Iterable[Dict[str, Any]], per_nb: int,
+              factor: float = 3.0, floor: int = 60) -> List[Dict[str, Any]]:
+    """
+    BudgetScheduler jobs, shortest predicted first (maximizes how many fit
+    the budget), each reserving its adaptive timeout instead of per_nb.
+    """
+    model = RuntimePredictor().fit(history)
+    jobs = []
+    for row in rows:
+        pred = model.predict(row)
+        jobs.append({"repo": row["repo_url"], "cost": adaptive_timeout(pred, per_nb, factor, floor),
+                     "pred": round(pred, 1), "row": row})
+    jobs.sort(key=lambda j: j["pred"])
+    return jobs
@@ -0,0 +1,314 @@
+import os, re, json, time, shutil, pathlib, posixpath, threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Iterable, List, Optional
+
+from utils import run, slug, ART
+from limits import TAIL_BYTES
+from envs import REQ_FILES
+
+HERE = pathlib.Path(__file__).resolve().parent
+WORK = HERE / "work"; WORK.mkdir(exist_ok=True)
+# Kept outside work/ so wiping work/ only costs a local re-clone, not a download.
+MIRRORS = pathlib.Path(os.environ.get("NB_MIRROR_CACHE", HERE / "cache" / "mirrors"))
+
+# Point at e.g. file:///tmp/remotes to clone from local repos instead of GitHub.
+GIT_REMOTE_BASE = os.environ.get("NB_GIT_REMOTE_BASE", "https://github.com").rstrip("/")
+
+_locks: Dict[str, threading.Lock] = {}
+_locks_guard = threading.Lock()
+
+
+def _lock_for(full_name: str) -> threading.Lock:
+    with _locks_guard:
+        return _locks.setdefault(full_name, threading.Lock())
+
+
+def _git(args, cwd=None, timeout=900, tail: Optional[int] = TAIL_BYTES) -> str:
+    """stdout of a git command; pass tail=None when all of it is parsed (ls-tree)."""
+    rc, out, err = run(["git", *args], cwd=cwd, timeout=timeout, tail=tail)
+    if rc != 0:
+        raise RuntimeError(f"git {args[0]} failed ({rc}): {(err or out).strip()[-500:]}")
+    return out
+
+
+def remote_url(full_name: str) -> str:
+    return f"{GIT_REMOTE_BASE}/{full_name}.git"
+
+
+def repo_dir_for(full_name: str) -> pathlib.Path:
+    return WORK / slug(full_name)
+
+
+def update_mirror(full_name: str) -> pathlib.Path:
+    """Create or incrementally refresh the shallow bare mirror of a repo's default branch."""
+    mirror = MIRRORS / (slug(full_name) + ".git")
+    if (mirror / "HEAD").exists():
+        head = _git(["-C", str(mirror), "symbolic-ref", "HEAD"]).strip()
+        _git(["-C", str(mirror), "fetch", "--depth", "1", "origin", f"+HEAD:{head}"])
+        return mirror
+    if mirror.exists():
+        shutil.rmtree(mirror, ignore_errors=True)
+    mirror.parent.mkdir(parents=True, exist_ok=True)
+    tmp = mirror.with_name(mirror.name + ".tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    _git(["clone", "--bare", "--depth", "1", "--single-branch", remote_url(full_name), str(tmp)])
+    tmp.rename(mirror)
+    return mirror
+
+
+def clone_repo(full_name: str, dest: pathlib.Path, use_mirror: bool = True):
+    if not use_mirror:
+        _git(["clone", "--depth", "1", remote_url(full_name), str(dest)])
+        return
+    mirror = update_mirror(full_name)
+    # Local clone from the mirror hardlinks objects instead of copying them.
+    _git(["clone", str(mirror), str(dest)])
+    _git(["-C", str(dest), "remote", "set-url", "origin", remote_url(full_name)])
+
+
+def _sparse_pattern(rel: str, is_dir: bool = False) -> str:
+    rel = rel.strip("/")
+    for ch in "\\*?[":
+        rel = rel.replace(ch, "\\" + ch)
+    return "/" + rel + ("/" if is_dir else "")
+
+
+def sparse_clone(full_name: str, dest: pathlib.Path, paths: Iterable[str]):
+    """Blobless, no-checkout clone that only materializes `paths` plus the dependency manifests."""
+    pats = [_sparse_pattern(p) for p in dict.fromkeys([*paths, *REQ_FILES])]
+    _git(["clone", "--depth", "1", "--filter=blob:none", "--no-checkout", remote_url(full_name), str(dest)])
+    _git(["-C", str(dest), "sparse-checkout", "set", "--no-cone", *pats])
+    _git(["-C", str(dest), "checkout"])
+
+
+def is_sparse(dest: pathlib.Path) -> bool:
+    rc, out, _ = run(["git", "-C", str(dest), "config", "--bool", "core.sparseCheckout"])
+    return rc == 0 and out.strip() == "true"
+
+
+def ensure_repo_checked_out(full_name: str, dest: pathlib.Path, use_mirror: bool = True,
+                            sparse_paths: Optional[List[str]] = None) -> float:
+    """
+    Make sure `dest` holds a checkout of `full_name`; returns seconds spent cloning (0 if reused).
+    With `sparse_paths`, new clones are sparse; without, an existing sparse
+    checkout is widened to the full tree (execution needs the whole repo).
+    """
+    with _lock_for(full_name):
+        if dest.exists():
+            if (dest / ".git").exists() and any(dest.iterdir()):
+                if is_sparse(dest):
+                    if sparse_paths is None:
+                        print(f"🌿 Widening sparse checkout: {dest}")
+                        _git(["-C", str(dest), "sparse-checkout", "disable"])
+                    elif sparse_paths:
+                        _git(["-C", str(dest), "sparse-checkout", "add", *[_sparse_pattern(p) for p in sparse_paths]])
+                print(f"✅ Using existing repo: {dest}")
+                return 0.0
+            else:
+                print(f"🌀 Found folder without .git; refreshing: {dest}")
+                shutil.rmtree(dest)
+        started = time.time()
+        if sparse_paths is not None:
+            print(f"⬇️ Sparse-cloning {remote_url(full_name)} into {dest} ({len(sparse_paths)} paths)")
+            sparse_clone(full_name, dest, sparse_paths)
+        else:
+            print(f"⬇️ Cloning {remote_url(full_name)} into {dest}")
+            clone_repo(full_name, dest, use_mirror=use_mirror)
+        return time.time() - started
+
+
+class RepoIndex:
+    """
+    Every file and directory in a repo's HEAD tree, listed once and shared
+    by the triage of all its notebooks. Data paths become set lookups, both
+    relative to the notebook's directory (the cwd it runs in) and to the
+    repo root, instead of a resolve() and stat per path. `elsewhere`
+    finds the same file name under another directory. A directory that
+    isn't a git checkout is indexed by walking it.
+    """
+
+    def __init__(self, repo_dir: pathlib.Path):
+        self.root = pathlib.Path(repo_dir).resolve()
+        self.files, self.dirs = set(), set()
+        self.by_name: Dict[str, List[str]] = {}
+        try:
+            paths = [f for f in _git(["-C", str(self.root), "ls-tree", "-r", "-z", "--name-only", "HEAD"], tail=None).split("\0") if f]
+        except RuntimeError:
+            paths = []
+            for dirpath, dirnames, filenames in os.walk(self.root):
+                dirnames[:] = [d for d in dirnames if d not in (".git", ".venv")]
+                rel = pathlib.Path(dirpath).relative_to(self.root).as_posix()
+                paths.extend(fn if rel == "." else f"{rel}/{fn}" for fn in filenames)
+        for f in paths:
+            self.files.add(f)
+            self.by_name.setdefault(f.rsplit("/", 1)[-1], []).append(f)
+            parts = f.split("/")
+            for i in range(1, len(parts)):
+                d = "/".join(parts[:i])
+                if d not in self.dirs:
+                    self.dirs.add(d)
+                    self.by_name.setdefault(parts[i - 1], []).append(d)
+
+    def has(self, rel: str) -> bool:
+        return rel in self.files or rel in self.dirs or rel == ""
+
+    def rel(self, path) -> Optional[str]:
+        """Repo-relative posix path of an absolute path, None outside the repo."""
+        try:
+            rel = pathlib.Path(os.path.normpath(path)).relative_to(self.root).as_posix()
+        except ValueError:
+            return None
+        return "" if rel == "." else rel
+
+    def exists(self, path) -> bool:
+        """Path.exists for paths inside the repo (e.g. deps' local-module checks)."""
+        rel = self.rel(path)
+        return rel is not None and self.has(rel)
+
+    def find(self, ref: str, base: str = "") -> Optional[str]:
+        """The repo path `ref` names when read from directory `base` (repo-relative), or None."""
+        ref = ref.replace("\\", "/")
+        if ref.startswith(("/", "~")) or re.match(r"^[A-Za-z]:/", ref):
+            return None
+        rel = posixpath.normpath(posixpath.join(base, ref))
+        rel = "" if rel == "." else rel
+        if rel == ".." or rel.startswith("../"):
+            return None
+        return rel if self.has(rel) else None
+
+    def elsewhere(self, ref: str, limit: int = 3) -> List[str]:
+        """Repo paths with the file name of `ref`, those sharing the most trailing path components first."""
+        parts = [x for x in ref.replace("\\", "/").split("/") if x not in ("", ".", "..")]
+        if not parts:
+            return []
+
+        def shared(c: str) -> int:
+            n = 0
+            for a, b in zip(reversed(c.split("/")), reversed(parts)):
+                if a != b:
+                    break
+                n += 1
+            return n
+
+        cands = sorted(self.by_name.get(parts[-1], []), key=lambda c: (-shared(c), c))
+        return cands[:limit]
+
+
+class SparseCheckout(RepoIndex):
+    """
+    RepoIndex of a sparse clone (trees are present, blobs are not): paths
+    that do exist are added to the sparse set when looked up, so git
+    fetches their blobs on first use.
+    """
+
+    def __init__(self, repo_dir: pathlib.Path):
+        super().__init__(repo_dir)
+        self.materialized = 0
+
+    def _materialize(self, rel: str):
+        if (self.root / rel).exists():
+            return
+        _git(["-C", str(self.root), "sparse-checkout", "add", _sparse_pattern(rel, is_dir=rel in self.dirs)])
+        self.materialized += 1
+
+    def exists(self, path) -> bool:
+        if pathlib.Path(path).exists():
+            return True
+        if not super().exists(path):
+            return False
+        self._materialize(self.rel(path))
+        return True
+
+    def find(self, ref: str, base: str = "") -> Optional[str]:
+        rel = super().find(ref, base)
+        if rel:
+            self._materialize(rel)
+        return rel
+
+
+def head_sha(dest: pathlib.Path) -> str:
+    return _git(["-C", str(dest), "rev-parse", "HEAD"]).strip()
+
+
+def blob_shas(dest: pathlib.Path) -> Dict[str, str]:
+    """{path: blob SHA} for HEAD, read from tree objects (no blobs needed, so sparse clones work)."""
+    out = _git(["-C", str(dest), "ls-tree", "-r", "-z", "HEAD"], tail=None)
+    shas = {}
+    for entry in out.split("\0"):
+        if not entry:
+            continue
+        meta, _, path = entry.partition("\t")
+        parts = meta.split()
+        if len(parts) == 3 and parts[1] == "blob":
+            shas[path] = parts[2]
+    return shas
+
+
+def _dir_bytes(root: pathlib.Path, skip_git: bool) -> int:
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        if skip_git and ".git" in dirnames:
+            dirnames.remove(".git")
+        for fn in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, fn)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def report_sparse_savings(tree_bytes: Dict[str, int], clone_seconds: Dict[str, float]) -> Dict[str, float]:
+    """
+    Compare sparse checkouts with what a full clone would have materialized.
+    `tree_bytes` is the HEAD tree size per repo from the GitHub tree API.
+    Seconds saved is an estimate: the remaining bytes at each clone's observed rate.
+    """
+    per_repo, tot = [], dict(full_bytes=0, checked_out_bytes=0, git_bytes=0, bytes_saved=0, est_seconds_saved=0.0)
+    for name, full in tree_bytes.items():
+        dest = repo_dir_for(name)
+        if not full or not dest.exists() or not is_sparse(dest):
+            continue
+        wt = _dir_bytes(dest, skip_git=True)
+        gb = _dir_bytes(dest / ".git", skip_git=False)
+        secs = clone_seconds.get(name, 0.0)
+        saved = max(0, full - wt)
+        est = saved / (gb / secs) if secs > 0 and gb > 0 else 0.0
+        per_repo.append(dict(repo=name, full_bytes=full, checked_out_bytes=wt, git_bytes=gb,
+                             clone_seconds=round(secs, 2), bytes_saved=saved, est_seconds_saved=round(est, 2)))
+        for k, v in (("full_bytes", full), ("checked_out_bytes", wt), ("git_bytes", gb),
+                     ("bytes_saved", saved), ("est_seconds_saved", est)):
+            tot[k] += v
+    if per_repo:
+        (ART / "checkout_report.json").write_text(json.dumps(dict(total=tot, repos=per_repo), indent=2))
+        print(f"🌿 Sparse checkout: {tot['checked_out_bytes']/1e6:.1f} MB materialized of "
+              f"{tot['full_bytes']/1e6:.1f} MB tree ({tot['bytes_saved']/1e6:.1f} MB saved, "
+              f"~{tot['est_seconds_saved']:.0f}s est.) across {len(per_repo)} repos")
+    return tot
+
+
+def clone_all(full_names: Iterable[str], workers: int = 8, use_mirror: bool = True,
+              sparse_paths: Optional[Dict[str, List[str]]] = None,
+              timings: Optional[Dict[str, float]] = None) -> Dict[str, Optional[Exception]]:
+    """
+    Check out every distinct repo once on a bounded thread pool.
+    With `sparse_paths` ({full_name: [paths]}) repos are sparse-cloned.
+    Returns {full_name: None on success, else the exception}.
+    """
+    names = list(dict.fromkeys(full_names))
+    results: Dict[str, Optional[Exception]] = {}
+    if not names:
+        return results
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(names))), thread_name_prefix="clone") as ex:
+        futs = {ex.submit(ensure_repo_checked_out, n, repo_dir_for(n), use_mirror,
+                          None if sparse_paths is None else sparse_paths.get(n, [])): n for n in names}
+        for f in as_completed(futs):
+            n = futs[f]
+            try:
+                secs = f.result()
+                if timings is not None:
+                    timings[n] = secs
+                results[n] = None
+            except Exception as e:
+                results[n] = e
+    print(f"Checked out {sum(1 for e in results.values() if e is None)}/{len(names)} repos.")
+    return results
@@ -0,0 +1,213 @@
+"""
+Executed notebooks as compact run records instead of full .ipynb files.
+
+A record (<name>.run.jsonl next to where the .ipynb would have gone) starts
+with the notebook's skeleton (outputs stripped) and gets one line appended
+per executed cell, so saving after each cell costs the size of that cell,
+not of the whole notebook. Large outputs (images, long text) go to
+blobs/<sha256>.gz, content-addressed, so identical outputs across runs
+(the same plot, the same warning) are stored once. materialize() rebuilds
+a standard .ipynb on demand.
+"""
+import os, json, gzip, base64, hashlib, pathlib, tempfile, threading
+from typing import Any, Dict, Optional
+
+import nbformat
+
+HERE = pathlib.Path(__file__).resolve().parent
+RUNS = HERE / "artifacts" / "nb_runs"
+MIN_BLOB = 1024   # outputs smaller than this stay inline
+RECORD_SUFFIX = ".run.jsonl"
+
+
+def record_path(out_path) -> pathlib.Path:
+    p = pathlib.Path(out_path)
+    return p.with_name(p.name[:-len(".ipynb")] + RECORD_SUFFIX if p.name.endswith(".ipynb") else p.name + RECORD_SUFFIX)
+
+
+def _text(v) -> str:
+    return v if isinstance(v, str) else "".join(v)
+
+
+class RunStore:
+    """
+    Blob store + record writer shared by all runs of a batch. `stats` counts
+    what a batch wrote: output_bytes (outputs as they'd sit in an .ipynb),
+    written_bytes (records + new compressed blobs), blobs_new, blobs_deduped.
+    """
+
+    def __init__(self, root: pathlib.Path = RUNS, min_blob: int = MIN_BLOB):
+        self.root = pathlib.Path(root)
+        self.blobs = self.root / "blobs"
+        self.min_blob = min_blob
+        self._lock = threading.Lock()
+        self.stats = dict(output_bytes=0, written_bytes=0, blobs_new=0, blobs_deduped=0)
+
+    def _count(self, **kw):
+        with self._lock:
+            for k, v in kw.items():
+                self.stats[k] += v
+
+    def _blob_path(self, sha: str) -> pathlib.Path:
+        return self.blobs / sha[:2] / f"{sha[2:]}.gz"
+
+    def put_blob(self, data: bytes) -> str:
+        sha = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(sha)
+        if path.exists():
+            self._count(blobs_deduped=1)
+            return sha
+        path.parent.mkdir(parents=True, exist_ok=True)
+        packed = gzip.compress(data, compresslevel=6, mtime=0)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(packed)
+        os.replace(tmp, path)
+        self._count(blobs_new=1, written_bytes=len(packed))
+        return sha
+
+    def get_blob(self, sha: str) -> bytes:
+        return gzip.decompress(self._blob_path(sha).read_bytes())
+
+    # --- compacting -----------------------------------------------------
+
+    def _pack(self, value, b64: bool = False):
+        s = _text(value)
+        if b64:
+            try:
+                data = base64.b64decode(s, validate=True)
+            except ValueError:   # not clean base64 (line breaks, bad padding): keep it as text
+                data = None
+            if data is not None and base64.b64encode(data).decode("ascii") == s:
+                return {"$blob": self.put_blob(data), "b64": True} if len(data) >= self.min_blob else value
+        return {"$blob": self.put_blob(s.encode("utf-8"))} if len(s) >= self.min_blob else value
+
+    def compact_output(self, out: Dict[str, Any]) -> Dict[str, Any]:
+        out = dict(out)
+        if out.get("output_type") == "stream" and "text" in out:
+            out["text"] = self._pack(out["text"])
+        elif isinstance(out.get("data"), dict):
+            out["data"] = {mime: self._pack(v, b64=mime.startswith("image/") and mime != "image/svg+xml")
+                           if isinstance(v, (str, list)) else v
+                           for mime, v in out["data"].items()}
+        return out
+
+    def compact_cell(self, cell) -> Dict[str, Any]:
+        c = json.loads(json.dumps(cell))   # plain dict, detached from the NotebookNode
+        if c.get("outputs"):
+            self._count(output_bytes=len(json.dumps(c["outputs"])))
+            c["outputs"] = [self.compact_output(o) for o in c["outputs"]]
+        return c
+
+    def _inflate(self, value):
+        if isinstance(value, dict) and "$blob" in value:
+            data = self.get_blob(value["$blob"])
+            return base64.b64encode(data).decode("ascii") if value.get("b64") else data.decode("utf-8")
+        return value
+
+    def _inflate_cell(self, c: Dict[str, Any]) -> Dict[str, Any]:
+        for o in c.get("outputs", []):
+            if "text" in o:
+                o["text"] = self._inflate(o["text"])
+            if isinstance(o.get("data"), dict):
+                o["data"] = {m: self._inflate(v) for m, v in o["data"].items()}
+        return c
+
+    # --- records ----------------------------------------------------------
+
+    def begin(self, out_path, nb) -> "RunRecord":
+        """Start a record for `nb` (its outputs are not kept; executed cells are appended)."""
+        return RunRecord(self, record_path(out_path), nb)
+
+    def ingest(self, out_path, nb) -> pathlib.Path:
+        """Record an already executed notebook in one go (papermill engine)."""
+        rec = self.begin(out_path, nb)
+        for i, c in enumerate(nb.cells):
+            if c.get("outputs") or c.get("execution_count") is not None:
+                rec.cell(c, i)
+        rec.finish(nb)
+        return rec.path
+
+    def materialize(self, record, out_path=None) -> pathlib.Path:
+        """Rebuild the executed .ipynb from a record; defaults to the record's name with .ipynb."""
+        record = pathlib.Path(record)
+        nb: Optional[Dict[str, Any]] = None
+        with open(record, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    r = json.loads(line)
+                except ValueError:
+                    continue   # torn last line of an interrupted run
+                if "skeleton" in r:
+                    nb = r["skeleton"]
+                elif nb is not None and "cell" in r and r["i"] < len(nb["cells"]):
+                    nb["cells"][r["i"]] = r["cell"]
+                elif nb is not None and "metadata" in r:
+                    nb["metadata"] = r["metadata"]
+        if nb is None:
+            raise ValueError(f"{record} has no notebook header")
+        nb["cells"] = [self._inflate_cell(c) for c in nb["cells"]]
+        out_path = pathlib.Path(out_path) if out_path else record.with_name(record.name[:-len(RECORD_SUFFIX)] + ".ipynb")
+        nbformat.write(nbformat.from_dict(nb), str(out_path))
+        return out_path
+
+    def summary(self) -> str:
+        s = self.stats
+        return (f"Run outputs: {s['output_bytes'] / 1e6:.1f} MB produced, {s['written_bytes'] / 1e6:.1f} MB written "
+                f"({s['blobs_new']} new blobs, {s['blobs_deduped']} deduped); "
+                f"{self.root.name} holds {self.footprint() / 1e6:.1f} MB.")
+
+    def footprint(self) -> int:
+        """Bytes on disk of all records and blobs."""
+        total = 0
+        for p in list(self.root.glob(f"*{RECORD_SUFFIX}")) + list(self.blobs.rglob("*.gz")):
+            try:
+                total += p.stat().st_size
+            except OSError:
+                pass
+        return total
+
+
+class RunRecord:
+    """One run's record file: the skeleton line, then a line per executed cell, then the final metadata."""
+
+    def __init__(self, store: RunStore, path: pathlib.Path, nb):
+        self.store, self.path = store, path
+        self._done = set()
+        skeleton = json.loads(json.dumps(nb))
+        for c in skeleton.get("cells", []):
+            if c.get("cell_type") == "code":
+                c["outputs"], c["execution_count"] = [], None
+        self._fh = open(path, "w", encoding="utf-8")
+        self._write({"skeleton": skeleton})
+
+    def _write(self, rec: Dict[str, Any]):
+        line = json.dumps(rec) + "\n"
+        self._fh.write(line)
+        self._fh.flush()
+        self.store._count(written_bytes=len(line.encode("utf-8")))
+
+    def cell(self, cell, cell_index: int):
+        self._write({"i": cell_index, "cell": self.store.compact_cell(cell)})
+        self._done.add(cell_index)
+
+    def finish(self, nb):
+        """Append cells that changed without a per-cell callback (e.g. the one cut off by a timeout), then metadata."""
+        if self._fh.closed:
+            return
+        for i, c in enumerate(nb.cells):
+            if i not in self._done and (c.get("outputs") or c.get("execution_count") is not None):
+                self.cell(c, i)
+        self._write({"metadata": json.loads(json.dumps(nb.metadata))})
+        self._fh.close()
+
+
+_default: Optional[RunStore] = None
+_default_lock = threading.Lock()
+
+def run_store() -> RunStore:
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = RunStore()
+        return _default
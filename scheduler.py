@@ -0,0 +1,157 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# fn(job) -> (result_row, seconds_to_charge)
+JobFn = Callable[[Dict[str, Any]], Tuple[Dict[str, Any], int]]
+
+
+class BudgetScheduler:
+    """
+    Runs jobs on a thread pool under a shared seconds budget.
+
+    Each job is a dict with at least "repo" and "cost" (seconds reserved
+    while it runs, i.e. its timeout). A job only starts when
+    spent + reserved + cost fits the budget, and at most `per_repo` jobs of
+    the same repo run at once so they don't share a checkout/venv mid-run.
+    When it finishes, its reservation is swapped for min(cost, used).
+    Results come back in job order, whatever order workers finished in.
+    """
+
+    def __init__(self, total_budget: int, workers: int = 1, per_repo: int = 1):
+        self.total_budget = int(total_budget)
+        self.workers = max(1, int(workers))
+        self.per_repo = max(1, int(per_repo))
+        self.spent = 0
+        self.reserved = 0
+        self._cond = threading.Condition()
+        self._pending: List[int] = []
+        self._active: Dict[str, int] = {}
+        self._jobs: List[Dict[str, Any]] = []
+        self._results: Dict[int, Dict[str, Any]] = {}
+
+    def _pick(self) -> Optional[int]:
+        for pos, i in enumerate(self._pending):
+            job = self._jobs[i]
+            if self._active.get(job["repo"], 0) >= self.per_repo:
+                continue
+            if self.spent + self.reserved + int(job["cost"]) <= self.total_budget:
+                return self._pending.pop(pos)
+        return None
+
+    def may_run(self, job: Dict[str, Any]) -> bool:
+        """False once the budget already spent leaves no room for the job, even if all reservations come back."""
+        return self.spent + int(job["cost"]) <= self.total_budget
+
+    def upcoming(self, repos: int) -> List[Dict[str, Any]]:
+        """The pending jobs, in start order, of the next `repos` distinct repos whose jobs may still run."""
+        out: List[Dict[str, Any]] = []
+        seen = set()
+        with self._cond:
+            for i in self._pending:
+                job = self._jobs[i]
+                if not self.may_run(job):
+                    continue
+                if job["repo"] not in seen:
+                    if len(seen) >= repos:
+                        break
+                    seen.add(job["repo"])
+                out.append(job)
+        return out
+
+    def _take(self) -> Optional[int]:
+        with self._cond:
+            while self._pending:
+                i = self._pick()
+                if i is not None:
+                    job = self._jobs[i]
+                    self.reserved += int(job["cost"])
+                    self._active[job["repo"]] = self._active.get(job["repo"], 0) + 1
+                    return i
+                if self.reserved == 0:
+                    # Nothing in flight can hand budget back: what's left never fits.
+                    self._pending.clear()
+                    self._cond.notify_all()
+                    return None
+                self._cond.wait()
+            return None
+
+    def _release(self, i: int, row: Optional[Dict[str, Any]], used: int):
+        job = self._jobs[i]
+        with self._cond:
+            self.reserved -= int(job["cost"])
+            self.spent += max(0, min(int(job["cost"]), int(used)))
+            self._active[job["repo"]] -= 1
+            if row is not None:
+                self._results[i] = row
+            self._cond.notify_all()
+
+    def _worker(self, fn: JobFn):
+        while True:
+            i = self._take()
+            if i is None:
+                return
+            row, used = None, 0
+            try:
+                row, used = fn(self._jobs[i])
+            finally:
+                self._release(i, row, used)
+
+    def run(self, jobs: List[Dict[str, Any]], fn: JobFn) -> List[Dict[str, Any]]:
+        self._jobs = list(jobs)
+        self._pending = list(range(len(self._jobs)))
+        self._results = {}
+        n = min(self.workers, len(self._jobs)) or 1
+        with ThreadPoolExecutor(max_workers=n, thread_name_prefix="nbrun") as ex:
+            futs = [ex.submit(self._worker, fn) for _ in range(n)]
+            for f in futs:
+                f.result()
+        return [self._results[i] for i in sorted(self._results)]
+
+
+class Prefetcher:
+    """
+    Computes fn(job) in the background for jobs about to start, e.g. the
+    checkout and env build of the next few notebooks while the current ones
+    execute. `ahead(jobs)` queues work for jobs not seen yet; `get(job)`
+    returns the result, computing it inline if it was never queued or was
+    cancelled; `retain(keep)` cancels queued work for jobs that no longer
+    pass keep(job). Work already running is left to finish.
+    Jobs are told apart by the identity of their "row".
+    """
+
+    def __init__(self, fn: Callable[[Dict[str, Any]], Any], workers: int = 1):
+        self.fn = fn
+        self._lock = threading.Lock()
+        self._futs: Dict[int, Tuple[Dict[str, Any], Future]] = {}
+        self._ex = ThreadPoolExecutor(max_workers=max(1, int(workers)), thread_name_prefix="prefetch")
+        self.hits = self.cancelled = 0
+
+    def ahead(self, jobs: List[Dict[str, Any]]):
+        with self._lock:
+            for job in jobs:
+                if id(job["row"]) not in self._futs:
+                    self._futs[id(job["row"])] = (job, self._ex.submit(self.fn, job))
+
+    def retain(self, keep: Callable[[Dict[str, Any]], bool]):
+        with self._lock:
+            for k, (job, fut) in list(self._futs.items()):
+                if not keep(job) and fut.cancel():
+                    del self._futs[k]
+                    self.cancelled += 1
+
+    def get(self, job: Dict[str, Any]) -> Any:
+        with self._lock:
+            _, fut = self._futs.pop(id(job["row"]), (None, None))
+        if fut is not None and not fut.cancel():
+            self.hits += 1
+            return fut.result()
+        return self.fn(job)
+
+    def close(self):
+        with self._lock:
+            futs, self._futs = self._futs, {}
+        for _, fut in futs.values():
+            if fut.cancel():
+                self.cancelled += 1
+        self._ex.shutdown(wait=True)
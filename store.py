@@ -0,0 +1,221 @@
+import os, csv, json, math, time, sqlite3, pathlib, threading
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+
+HERE = pathlib.Path(__file__).resolve().parent
+DB_PATH = HERE / "notebook_dataset.sqlite"
+SCHEMA_CSV = HERE / "dataset_schema.csv"
+CANDIDATES = HERE / "artifacts" / "candidates.jsonl"
+
+# Dataset columns in export order, with their SQLite types. BOOL is stored as 0/1.
+COLUMNS: Dict[str, str] = {
+    "repo_url": "TEXT", "repo_stars": "INTEGER", "repo_pushed_at": "TEXT", "notebook_path": "TEXT",
+    "notebook_url": "TEXT", "size_kb": "INTEGER", "n_cells": "INTEGER", "libs_detected": "TEXT",
+    "has_relative_data_paths": "BOOL", "missing_paths": "TEXT", "data_elsewhere": "TEXT", "suspect_cuda": "BOOL",
+    "has_heavy_libs": "BOOL", "install_pkgs": "TEXT", "blocked_imports": "TEXT",
+    "unknown_imports": "TEXT", "keep_candidate": "BOOL", "runtime_seconds": "INTEGER", "status": "TEXT",
+    "error_type": "TEXT", "error_message": "TEXT", "commit_sha": "TEXT", "blob_sha": "TEXT",
+    "overhead_seconds": "REAL", "slowest_cell": "INTEGER", "slowest_cell_seconds": "REAL",
+    "peak_rss_mb": "REAL", "first_error_seconds": "REAL", "predicted_seconds": "REAL",
+    "parser": "TEXT", "parse_ms": "REAL", "parse_peak_kb": "INTEGER",
+}
+KEY = ("repo_url", "notebook_path")
+
+
+def _coerce(v: Any, typ: str) -> Any:
+    if v is None or (isinstance(v, float) and math.isnan(v)) or (isinstance(v, str) and v.strip() in ("", "nan", "None")):
+        return None
+    try:
+        if typ == "BOOL":
+            return 1 if (v is True or str(v).strip().lower() in ("true", "1", "1.0")) else 0
+        if typ == "INTEGER":
+            return int(float(v))
+        if typ == "REAL":
+            return float(v)
+    except (TypeError, ValueError):
+        return None
+    return str(v)
+
+
+class DatasetStore:
+    """
+    The notebook dataset as one SQLite table keyed on (repo_url, notebook_path).
+
+    Rows are upserted one at a time (or in one transaction per batch) as
+    results come in, so a crash loses at most the notebook in flight. WAL
+    mode lets exports and readers run while a run is writing; wal=False
+    keeps the rollback journal instead, for a store shared between hosts
+    (WAL needs shared memory, which network filesystems don't provide).
+    The CSV is only produced on demand by export_csv.
+    """
+
+    def __init__(self, path: pathlib.Path = DB_PATH, wal: bool = True):
+        self.path = pathlib.Path(path)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.row_factory = sqlite3.Row
+        if wal:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+        else:
+            self.conn.execute("PRAGMA journal_mode=DELETE")
+        cols = ", ".join(f"{c} {'INTEGER' if t == 'BOOL' else t}" for c, t in COLUMNS.items())
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS notebooks ({cols}, updated_at REAL, PRIMARY KEY (repo_url, notebook_path))")
+        have = {r["name"] for r in self.conn.execute("PRAGMA table_info(notebooks)")}
+        for c, t in COLUMNS.items():
+            if c not in have:
+                self.conn.execute(f"ALTER TABLE notebooks ADD COLUMN {c} {'INTEGER' if t == 'BOOL' else t}")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS notebooks_keep ON notebooks (keep_candidate, has_relative_data_paths)")
+
+    def _upsert(self, row: Dict[str, Any]):
+        cols = [c for c in COLUMNS if c in row]
+        for k in KEY:
+            if k not in cols:
+                raise ValueError(f"row without {k}")
+        vals = [_coerce(row[c], COLUMNS[c]) for c in cols] + [time.time()]
+        sets = ", ".join(f"{c}=excluded.{c}" for c in cols + ["updated_at"] if c not in KEY)
+        self.conn.execute(f"INSERT INTO notebooks ({', '.join(cols)}, updated_at) VALUES ({', '.join('?' * len(vals))}) "
+                          f"ON CONFLICT (repo_url, notebook_path) DO UPDATE SET {sets}", vals)
+
+    def upsert(self, row: Dict[str, Any]):
+        """Insert or update one row; only the columns present in `row` are written."""
+        with self._lock:
+            self._upsert(row)
+
+    def upsert_many(self, rows: Iterable[Dict[str, Any]]) -> int:
+        n = 0
+        with self._lock:
+            self.conn.execute("BEGIN")
+            try:
+                for r in rows:
+                    self._upsert(r)
+                    n += 1
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        return n
+
+    @staticmethod
+    def _out(r: sqlite3.Row) -> Dict[str, Any]:
+        d = dict(r)
+        for c, t in COLUMNS.items():
+            if t == "BOOL" and d.get(c) is not None:
+                d[c] = bool(d[c])
+        return d
+
+    def rows(self, where: str = "", params: Sequence[Any] = ()) -> List[Dict[str, Any]]:
+        sql = "SELECT * FROM notebooks" + (f" WHERE {where}" if where else "") + " ORDER BY rowid"
+        with self._lock:
+            return [self._out(r) for r in self.conn.execute(sql, params)]
+
+    def get(self, repo_url: str, notebook_path: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            r = self.conn.execute("SELECT * FROM notebooks WHERE repo_url = ? AND notebook_path = ?",
+                                  (repo_url, notebook_path)).fetchone()
+        return self._out(r) if r is not None else None
+
+    def by_key(self) -> Dict[Tuple[str, str], Dict[str, Any]]:
+        return {(r["repo_url"], r["notebook_path"]): r for r in self.rows()}
+
+    def candidates(self) -> List[Dict[str, Any]]:
+        """Rows `run` executes: keep_candidate, and every relative data path present."""
+        return self.rows("keep_candidate = 1 AND (has_relative_data_paths = 0 OR COALESCE(missing_paths, '') = '')")
+
+    def count(self) -> int:
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM notebooks").fetchone()[0]
+
+    def import_csv(self, path: pathlib.Path) -> int:
+        with open(path, newline="", encoding="utf-8") as f:
+            return self.upsert_many(csv.DictReader(f))
+
+    def export_csv(self, path: pathlib.Path, columns: Optional[List[str]] = None) -> int:
+        """Write the dataset as CSV (atomically); `columns` defaults to every column."""
+        columns = columns or list(COLUMNS)
+        rows = self.rows()
+        tmp = pathlib.Path(path).with_suffix(".csv.tmp")
+        with open(tmp, "w", newline="", encoding="utf-8") as f:
+            w = csv.DictWriter(f, fieldnames=columns, extrasaction="ignore")
+            w.writeheader()
+            for r in rows:
+                w.writerow({c: "" if r.get(c) is None else r[c] for c in columns})
+        tmp.replace(path)
+        return len(rows)
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+def is_candidate(row: Dict[str, Any]) -> bool:
+    """Python twin of DatasetStore.candidates() for a single row."""
+    return _coerce(row.get("keep_candidate"), "BOOL") == 1 and \
+        (_coerce(row.get("has_relative_data_paths"), "BOOL") != 1 or not _coerce(row.get("missing_paths"), "TEXT"))
+
+
+def schema_columns(path: pathlib.Path = SCHEMA_CSV) -> List[str]:
+    """Column layout of the published CSV, from the header of dataset_schema.csv."""
+    with open(path, newline="", encoding="utf-8") as f:
+        return next(csv.reader(f))
+
+
+class CandidateLog:
+    """
+    Append-only JSONL of search candidates, deduped on (repo_full_name,
+    notebook_path). Only the keys are held in memory; iterating streams the
+    file, so triage never loads the whole log. A legacy candidates.json next
+    to the log is imported (deduped) the first time.
+    """
+
+    def __init__(self, path: pathlib.Path = CANDIDATES):
+        self.path = pathlib.Path(path)
+        self._keys: Set[Tuple[str, str]] = set()
+        legacy = self.path.with_suffix(".json")
+        if not self.path.exists() and legacy.exists():
+            try:
+                items = json.loads(legacy.read_text())
+            except ValueError:
+                items = []
+            self.extend(items)
+            return
+        for c in self:
+            self._keys.add((c["repo_full_name"], c["notebook_path"]))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key: Tuple[str, str]) -> bool:
+        return tuple(key) in self._keys
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        if not self.path.exists():
+            return
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    c = json.loads(line)
+                    if c["repo_full_name"] and c["notebook_path"]:
+                        yield c
+                except (ValueError, KeyError, TypeError):
+                    continue  # torn line from a crash mid-write
+
+    def extend(self, items: Iterable[Dict[str, Any]]) -> int:
+        """Append the candidates not already logged; returns how many were new."""
+        n = 0
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        needs_nl = False
+        if self.path.exists() and self.path.stat().st_size > 0:
+            with open(self.path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                needs_nl = f.read(1) != b"\n"
+        with open(self.path, "a", encoding="utf-8") as f:
+            if needs_nl:
+                f.write("\n")
+            for c in items:
+                key = (c.get("repo_full_name"), c.get("notebook_path"))
+                if not all(key) or key in self._keys:
+                    continue
+                self._keys.add(key)
+                f.write(json.dumps(c) + "\n")
+                n += 1
+        return n
@@ -0,0 +1,57 @@
+import time
+
+import envs
+
+
+def test_refs_are_per_repo_and_env_and_prune_waits_for_last_used(tmp_path, monkeypatch):
+    monkeypatch.setattr(envs, "ENVS", tmp_path)
+    now, old = str(int(time.time())), str(int(time.time() - 30 * 86400))
+    a, b, c = (tmp_path / n for n in ("env-a", "env-b", "env-c"))
+    for d in (a, b, c):
+        d.mkdir()
+        (d / ".last_used").write_text(now)
+
+    # One repo using two envs keeps a ref on both.
+    envs._add_ref(a, "https://github.com/o/r")
+    envs._add_ref(b, "https://github.com/o/r")
+    assert (a / ".refs" / "o-r").exists() and (b / ".refs" / "o-r").exists()
+
+    # No refs but recently used: kept.
+    envs.prune_envs(14)
+    assert c.exists()
+    (c / ".last_used").write_text(old)
+    envs.prune_envs(14)
+    assert not c.exists()
+
+    # Its only ref expired, but the env itself was used recently: kept.
+    (a / ".refs" / "o-r").write_text(old)
+    envs.prune_envs(14)
+    assert a.exists() and not (a / ".refs" / "o-r").exists()
+    (a / ".last_used").write_text(old)
+    envs.prune_envs(14)
+    assert not a.exists() and b.exists()
+
+
+def test_base_provided_covers_dependencies_from_the_lockfile(tmp_path, monkeypatch):
+    import deps
+    monkeypatch.setattr(envs, "ENVS", tmp_path)
+    monkeypatch.setattr(envs, "LOCKS", tmp_path / ".locks")
+    monkeypatch.setattr(envs, "_provided", {})
+    src = ["from IPython.display import display\nimport scipy.stats\nimport joblib\nimport tqdm"]
+    assert set(deps.analyze(src, provided=envs.base_provided())["install"]) >= {"ipython", "scipy", "joblib"}
+
+    base = envs.base_env_dir()
+    base.mkdir()
+    (base / "requirements.lock").write_text("ipython==8.20.0\nscipy==1.11.4\njoblib==1.3.2\n")
+    assert deps.analyze(src, provided=envs.base_provided())["install"] == ["tqdm"]
+
+
+def test_unknown_imports_are_reported_not_installed(tmp_path):
+    import deps
+    (tmp_path / "src" / "mypkg").mkdir(parents=True)   # src/ layout: not found as repo-local
+    src = ["import sys; sys.path.append('src')\nimport mypkg.core\nimport cv2\n%pip install foo==1.0",
+           "import internal_utils\nimport google.colab\ntry:\n    import optional_thing\nexcept ImportError:\n    pass"]
+    got = deps.analyze(src, [tmp_path], provided=["internal-utils"])
+    assert got["install"] == ["foo==1.0", "opencv-python"]
+    assert got["unknown"] == ["mypkg"]
+    assert got["blocked"] == ["google.colab"] and not got["installable"]
@@ -0,0 +1,32 @@
+import nbformat
+
+from execute_nb import _overhead, cell_records_from_nb
+
+
+def _nb(*cells):
+    nb = nbformat.v4.new_notebook()
+    for start, end, status in cells:
+        c = nbformat.v4.new_code_cell("x = 1")
+        c.metadata["papermill"] = {"start_time": start, "end_time": end, "status": status}
+        nb.cells.append(c)
+    return nb
+
+
+def test_overhead_counts_only_time_outside_cells():
+    nb = _nb(("2024-01-01T00:00:00Z", "2024-01-01T00:00:02Z", "completed"),
+             ("2024-01-01T00:00:02Z", "2024-01-01T00:00:05Z", "completed"))
+    cells = cell_records_from_nb(nb)
+    assert [r["wall_seconds"] for r in cells] == [2.0, 3.0]
+    assert _overhead(cells, 7.5, "ok") == 2.5
+
+
+def test_overhead_of_killed_run():
+    nb = _nb(("2024-01-01T00:00:00Z", "2024-01-01T00:00:02Z", "completed"),
+             ("2024-01-01T00:00:02Z", None, "running"))
+    cells = cell_records_from_nb(nb, killed="timeout")
+    assert cells[-1]["status"] == "timeout"
+    # The killed cell ran until now, so its time is not overhead.
+    assert _overhead(cells, 30.0, "timeout") == 0.0
+    # Without a record of the cell that was running, overhead is unknown.
+    assert _overhead(cells[:1], 30.0, "timeout") is None
+    assert _overhead([], 30.0, "oom") is None
@@ -0,0 +1,99 @@
+import json, time, threading
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import gh_search
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, *a):
+        pass
+
+    def _send(self, code, body, headers=()):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in headers:
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        srv = self.server
+        srv.hits.append(self.path)
+        if self.path.startswith("/search/repositories"):
+            page = int(self.path.rsplit("page=", 1)[-1])
+            items = [{"full_name": f"o/r{(page - 1) * 3 + i}"} for i in range(3)]
+            headers = []
+            if page < 3:
+                nxt = f"http://127.0.0.1:{srv.server_port}/search/repositories?q=x&page={page + 1}"
+                headers.append(("Link", f'<{nxt}>; rel="next", <{nxt}>; rel="last"'))
+            return self._send(200, {"items": items}, headers)
+        if self.path.startswith("/limited/"):
+            n = srv.limited.get(self.path, 0)
+            srv.limited[self.path] = n + 1
+            if n == 0:
+                return self._send(403, {"message": "secondary rate limit"}, [("Retry-After", srv.retry_after)])
+            return self._send(200, {"ok": True})
+        self._send(404, {"message": "Not Found"})
+
+
+@pytest.fixture
+def server():
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    srv.hits, srv.limited, srv.retry_after = [], {}, "0"
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+def _client(srv, **kw):
+    return gh_search.GitHubClient(base=f"http://127.0.0.1:{srv.server_port}", cache_dir=None, **kw)
+
+
+def test_paginate_follows_link_headers(server):
+    gh = _client(server)
+    items = gh.paginate("/search/repositories?q=x&page=1", max_items=100)
+    assert [i["full_name"] for i in items] == [f"o/r{i}" for i in range(9)]
+    assert len(server.hits) == 3
+
+    server.hits.clear()
+    assert len(gh.paginate("/search/repositories?q=x&page=1", max_items=4)) == 4
+    assert len(server.hits) == 2
+
+
+@pytest.mark.parametrize("retry_after", ["0", formatdate(time.time() - 5, usegmt=True)])
+def test_rate_limited_403_is_retried(server, retry_after):
+    server.retry_after = retry_after
+    gh = _client(server)
+    started = time.time()
+    body, _ = gh.get("/limited/a")
+    assert body == {"ok": True}
+    assert server.limited["/limited/a"] == 2
+    assert gh.stats["retries"] == 1
+    assert time.time() - started < 2
+
+
+def test_plain_403_and_404_raise(server):
+    gh = _client(server, max_retries=1)
+    with pytest.raises(gh_search.requests.HTTPError):
+        gh.get("/nope")
+    assert gh.stats["retries"] == 0
+
+
+def test_backoff_reads_retry_after_forms():
+    gh = gh_search.GitHubClient(cache_dir=None)
+
+    class R:
+        def __init__(self, h):
+            self.headers = h
+
+    assert gh._backoff(0, R({"Retry-After": "7"})) == 7.0
+    wait = gh._backoff(0, R({"Retry-After": formatdate(time.time() + 30, usegmt=True)}))
+    assert 25 <= wait <= 31
+    assert gh._backoff(0, R({"Retry-After": formatdate(time.time() - 30, usegmt=True)})) == 0.0
+    assert 1 <= gh._backoff(0, R({"Retry-After": "soon"})) <= 2
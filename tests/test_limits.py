@@ -0,0 +1,66 @@
+import gzip, sys, time, threading
+
+from limits import Limits, kill_running, run_limited
+
+
+def _gone(pid: int) -> bool:
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rsplit(")", 1)[1].split()[0] == "Z"
+    except OSError:
+        return True
+
+
+def _wait_gone(pid: int, seconds: float = 5.0) -> bool:
+    end = time.time() + seconds
+    while time.time() < end:
+        if _gone(pid):
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_timeout_kills_the_whole_tree():
+    rc, out, _, dog = run_limited(["sh", "-c", "sleep 60 & echo $!; sleep 60"], timeout=1)
+    assert rc == 124 and dog is None
+    assert _wait_gone(int(out.split()[0]))
+
+
+def test_memory_breach_kills_the_tree():
+    code = "import time; b = bytearray(300 * 2**20); b[::4096] = b'x' * len(b[::4096]); time.sleep(30)"
+    started = time.time()
+    rc, _, _, dog = run_limited([sys.executable, "-c", code], timeout=20, limits=Limits(mem_mb=100))
+    assert dog.breach == "oom" and "limit 100 MB" in dog.detail
+    assert rc != 0 and time.time() - started < 15
+
+
+def test_process_breach_kills_the_tree():
+    rc, out, _, dog = run_limited(["sh", "-c", "for i in 1 2 3 4 5 6; do sleep 30 & echo $!; done; wait"],
+                                  timeout=20, limits=Limits(max_procs=4))
+    assert dog.breach == "proc_limit"
+    assert all(_wait_gone(int(pid)) for pid in out.split())
+
+
+def test_tail_is_bounded_and_log_keeps_everything(tmp_path):
+    log = tmp_path / "run.log"
+    code = "import sys; [sys.stdout.write(f'line {i:06d}\\n') for i in range(20000)]"
+    rc, out, _, _ = run_limited([sys.executable, "-c", code], timeout=30, log_path=log, tail=1000)
+    assert rc == 0
+    head, body = out.split("\n", 1)
+    assert head.startswith("[... ") and "earlier bytes" in head and str(log) in head
+    assert len(body.encode()) == 1000 and body.endswith("line 019999\n")
+    with gzip.open(f"{log}.out.gz", "rt") as f:
+        full = f.read()
+    assert full.count("\n") == 20000 and full.endswith(body)
+
+
+def test_kill_running_stops_waiting_calls():
+    got = {}
+    t = threading.Thread(target=lambda: got.update(rc=run_limited(["sh", "-c", "sleep 60 & sleep 60"], timeout=60)[0]))
+    started = time.time()
+    t.start()
+    while not kill_running() and time.time() - started < 5:
+        time.sleep(0.05)
+    t.join(timeout=10)
+    assert not t.is_alive() and got["rc"] != 0 and time.time() - started < 10
+    assert kill_running() == 0
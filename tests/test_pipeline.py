@@ -0,0 +1,47 @@
+import queue, threading
+
+from pipeline import Stage, _Budget, _DONE
+
+
+def test_stop_drains_upstream_stages_without_processing():
+    stop = threading.Event()
+    seen = []
+    inbox, mid, out = queue.Queue(maxsize=2), queue.Queue(maxsize=2), queue.Queue()
+
+    def first(x):
+        if x == 3:
+            stop.set()
+        return [x]
+
+    def second(x):
+        seen.append(x)
+        return [x]
+
+    stages = [Stage("a", first, 1, inbox, mid, stop).start(), Stage("b", second, 1, mid, out, stop).start()]
+    for i in range(50):   # would block on the bounded queues if stopped stages stopped reading
+        inbox.put(i)
+    inbox.put(_DONE)
+    for s in stages:
+        s.join()
+    assert stages[0].done == 4 and stages[0].skipped == 46
+    assert all(x <= 3 for x in seen)
+    got = []
+    while True:
+        item = out.get()
+        if item is _DONE:
+            break
+        got.append(item)
+    assert got == seen
+
+
+def test_budget_refuses_only_when_nothing_is_in_flight():
+    b = _Budget(100)
+    assert b.reserve(60)
+    done = []
+    t = threading.Thread(target=lambda: done.append(b.reserve(60)))
+    t.start()
+    b.settle(60, 30)   # hands 30 back, so the waiting reservation fits
+    t.join()
+    assert done == [True] and b.left() == 10
+    b.settle(60, 60)
+    assert not b.reserve(20) and b.left() == 10
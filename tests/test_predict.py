@@ -0,0 +1,42 @@
+import random
+
+from predict import RuntimePredictor, adaptive_timeout, plan_jobs
+
+
+def _row(repo, nb, n_cells, secs=None, libs="", status="ok"):
+    return dict(repo_url=repo, notebook_path=nb, n_cells=n_cells, size_kb=n_cells * 2,
+                libs_detected=libs, runtime_seconds=secs, status=status)
+
+
+def test_fit_learns_runtime_growth_with_cells():
+    rng = random.Random(0)
+    hist = [_row(f"r{i}", "a.ipynb", n, secs=3 * n * rng.uniform(0.9, 1.1))
+            for i, n in enumerate(rng.randint(2, 60) for _ in range(40))]
+    m = RuntimePredictor().fit(hist)
+    assert m.w is not None
+    small, big = m.predict(_row("new", "x.ipynb", 5)), m.predict(_row("new", "y.ipynb", 50))
+    assert 5 < small < 40 and 80 < big < 300
+
+
+def test_prior_and_history_overrides():
+    m = RuntimePredictor().fit([_row("r", "a.ipynb", 10, secs=42), _row("r", "b.ipynb", 10, secs=9, status="error")])
+    assert m.w is None
+    assert m.predict(_row("r", "a.ipynb", 10)) == 42           # same notebook ran before
+    assert m.predict(_row("q", "c.ipynb", 10, libs="torch")) == 10 + 20 + 60   # prior
+    # Other notebooks of the repo pull the prior toward their median.
+    assert 30 < m.predict(_row("r", "c.ipynb", 10)) < 42
+
+
+def test_adaptive_timeout_is_clamped():
+    assert adaptive_timeout(5, per_nb=480) == 60                  # floor
+    assert adaptive_timeout(50, per_nb=480) == 150
+    assert adaptive_timeout(50.1, per_nb=480) == 151              # rounds up
+    assert adaptive_timeout(1000, per_nb=480) == 480              # cap
+    assert adaptive_timeout(10, per_nb=480, factor=2, floor=5) == 20
+
+
+def test_plan_jobs_shortest_first_with_adaptive_cost():
+    rows = [_row("r1", "big.ipynb", 50), _row("r2", "small.ipynb", 2)]
+    jobs = plan_jobs(rows, [], per_nb=120, factor=3, floor=30)
+    assert [j["row"]["notebook_path"] for j in jobs] == ["small.ipynb", "big.ipynb"]
+    assert jobs[0]["cost"] == 42 and jobs[1]["cost"] == 120
@@ -0,0 +1,87 @@
+import subprocess
+
+import pytest
+
+import repos
+
+
+def _git(*args, cwd=None):
+    subprocess.run(["git", "-c", "user.name=t", "-c", "user.email=t@t", *args], cwd=cwd,
+                   check=True, capture_output=True)
+
+
+@pytest.fixture
+def remote(tmp_path, monkeypatch):
+    """A bare repo at <tmp>/remotes/acme/demo.git served through NB_GIT_REMOTE_BASE-style file:// URLs."""
+    src = tmp_path / "src"
+    (src / "nbs").mkdir(parents=True)
+    (src / "data").mkdir()
+    (src / "nbs" / "a.ipynb").write_text("{}")
+    (src / "data" / "train.csv").write_text("x\n1\n")
+    (src / "big.bin").write_bytes(b"\0" * 4096)
+    (src / "requirements.txt").write_text("numpy\n")
+    _git("init", "-q", "-b", "main", cwd=src)
+    _git("add", "-A", cwd=src)
+    _git("commit", "-qm", "one", cwd=src)
+    bare = tmp_path / "remotes" / "acme" / "demo.git"
+    _git("clone", "-q", "--bare", str(src), str(bare))
+    _git("config", "uploadpack.allowFilter", "true", cwd=bare)
+    monkeypatch.setattr(repos, "GIT_REMOTE_BASE", (tmp_path / "remotes").as_uri())
+    monkeypatch.setattr(repos, "MIRRORS", tmp_path / "mirrors")
+    return src
+
+
+def test_mirror_clone_and_refresh(remote, tmp_path):
+    mirror = repos.update_mirror("acme/demo")
+    assert (mirror / "HEAD").exists()
+    dest = tmp_path / "work" / "demo"
+    assert repos.ensure_repo_checked_out("acme/demo", dest) > 0
+    assert (dest / "big.bin").exists() and (dest / "data" / "train.csv").exists()
+    # The clone's origin points at the real remote, not the mirror.
+    out = subprocess.run(["git", "-C", str(dest), "remote", "get-url", "origin"], capture_output=True, text=True).stdout
+    assert out.strip() == repos.remote_url("acme/demo")
+    assert repos.ensure_repo_checked_out("acme/demo", dest) == 0.0
+
+    (remote / "new.txt").write_text("new")
+    _git("add", "-A", cwd=remote)
+    _git("commit", "-qm", "two", cwd=remote)
+    _git("push", "-q", str(tmp_path / "remotes" / "acme" / "demo.git"), "main", cwd=remote)
+    repos.update_mirror("acme/demo")
+    fresh = tmp_path / "work" / "demo2"
+    repos.clone_repo("acme/demo", fresh)
+    assert (fresh / "new.txt").read_text() == "new"
+
+
+def test_sparse_clone_only_checks_out_requested_paths(remote, tmp_path):
+    dest = tmp_path / "work" / "demo"
+    repos.ensure_repo_checked_out("acme/demo", dest, sparse_paths=["nbs/a.ipynb"])
+    assert repos.is_sparse(dest)
+    assert (dest / "nbs" / "a.ipynb").exists()
+    assert (dest / "requirements.txt").exists()
+    assert not (dest / "big.bin").exists()
+    assert not (dest / "data").exists()
+
+    # A later call with more paths adds them; one without paths widens to the full tree.
+    repos.ensure_repo_checked_out("acme/demo", dest, sparse_paths=["data/train.csv"])
+    assert (dest / "data" / "train.csv").exists() and not (dest / "big.bin").exists()
+    repos.ensure_repo_checked_out("acme/demo", dest)
+    assert not repos.is_sparse(dest)
+    assert (dest / "big.bin").exists()
+
+
+def test_sparse_checkout_index_adds_paths_lazily(remote, tmp_path):
+    dest = tmp_path / "work" / "demo"
+    repos.sparse_clone("acme/demo", dest, ["nbs/a.ipynb"])
+    idx = repos.SparseCheckout(dest)
+    assert idx.has("data/train.csv") and not (dest / "data").exists()
+
+    assert idx.find("../data/train.csv", "nbs") == "data/train.csv"
+    assert (dest / "data" / "train.csv").read_text() == "x\n1\n"
+    assert idx.materialized == 1
+    assert idx.find("missing.csv", "nbs") is None
+    assert idx.exists(dest / "data" / "train.csv")
+    assert idx.materialized == 1
+    assert not (dest / "big.bin").exists()
+
+    assert idx.exists(dest / "big.bin")
+    assert (dest / "big.bin").exists() and idx.materialized == 2
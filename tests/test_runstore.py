@@ -0,0 +1,56 @@
+import base64, gzip, os
+
+import nbformat
+
+from runstore import RunStore, record_path
+
+
+def _nb(png: bytes, text: str):
+    nb = nbformat.v4.new_notebook()
+    for i in range(2):
+        c = nbformat.v4.new_code_cell(f"plot({i})", execution_count=i + 1)
+        c.outputs = [nbformat.v4.new_output("display_data", data={"image/png": base64.b64encode(png).decode("ascii"),
+                                                                   "text/plain": "<Figure>"}),
+                     nbformat.v4.new_output("stream", name="stdout", text=text)]
+        nb.cells.append(c)
+    nb.cells.append(nbformat.v4.new_markdown_cell("done"))
+    return nb
+
+
+def test_blob_is_gzipped_and_content_addressed(tmp_path):
+    store = RunStore(tmp_path)
+    data = os.urandom(5000)
+    sha = store.put_blob(data)
+    assert store.put_blob(data) == sha
+    assert gzip.decompress(store._blob_path(sha).read_bytes()) == data == store.get_blob(sha)
+    assert store.stats["blobs_new"] == 1 and store.stats["blobs_deduped"] == 1
+
+
+def test_record_round_trip_dedups_outputs(tmp_path):
+    store = RunStore(tmp_path, min_blob=1024)
+    nb = _nb(os.urandom(4000), "x" * 3000)
+    out_path = tmp_path / "a.ipynb"
+    rec = store.begin(out_path, nb)
+    rec.cell(nb.cells[0], 0)
+    rec.finish(nb)   # cell 1 had no callback: picked up here
+    assert rec.path == record_path(out_path)
+    # Same image and text in both cells: two blobs written, two reused.
+    assert store.stats["blobs_new"] == 2 and store.stats["blobs_deduped"] == 2
+    assert store.stats["written_bytes"] < store.stats["output_bytes"]
+    assert "<Figure>" in rec.path.read_text()   # small outputs stay inline
+
+    back = nbformat.read(str(store.materialize(rec.path)), as_version=4)
+    assert [c.get("outputs") for c in back.cells] == [c.get("outputs") for c in nb.cells]
+    assert [c.get("execution_count") for c in back.cells] == [1, 2, None]
+
+
+def test_materialize_tolerates_torn_last_line(tmp_path):
+    store = RunStore(tmp_path)
+    nb = _nb(b"png", "hi")
+    rec = store.begin(tmp_path / "b.ipynb", nb)
+    rec.cell(nb.cells[0], 0)
+    rec._fh.write('{"i": 1, "cell": {"cell_ty')   # killed mid-write
+    rec._fh.close()
+    back = nbformat.read(str(store.materialize(rec.path)), as_version=4)
+    assert back.cells[0].outputs == nb.cells[0].outputs
+    assert back.cells[1].outputs == [] and back.cells[1].execution_count is None
@@ -0,0 +1,92 @@
+import random, threading, time
+
+from scheduler import BudgetScheduler, Prefetcher
+
+
+def _job(i, repo, cost):
+    return {"i": i, "repo": repo, "cost": cost, "row": {"i": i}}
+
+
+class _Track:
+    """fn for BudgetScheduler.run recording how many jobs (and of which repo) ran at once."""
+
+    def __init__(self, sched, used=None, sleep=0.01):
+        self.sched, self.used, self.sleep = sched, used, sleep
+        self.lock = threading.Lock()
+        self.live, self.by_repo = 0, {}
+        self.max_live, self.max_repo, self.max_reserved = 0, 0, 0
+        self.ran = []
+
+    def __call__(self, job):
+        with self.lock:
+            self.live += 1
+            self.by_repo[job["repo"]] = self.by_repo.get(job["repo"], 0) + 1
+            self.max_live = max(self.max_live, self.live)
+            self.max_repo = max(self.max_repo, self.by_repo[job["repo"]])
+            self.max_reserved = max(self.max_reserved, self.sched.spent + self.sched.reserved)
+            self.ran.append(job["i"])
+        time.sleep(self.sleep * random.random())
+        with self.lock:
+            self.live -= 1
+            self.by_repo[job["repo"]] -= 1
+        return dict(job["row"]), job["cost"] if self.used is None else self.used(job)
+
+
+def test_reservations_never_exceed_the_budget_and_settle_to_used():
+    s = BudgetScheduler(total_budget=120, workers=4, per_repo=4)
+    fn = _Track(s, used=lambda job: job["cost"] // 2)
+    rows = s.run([_job(i, f"r{i}", 30) for i in range(6)], fn)
+    assert fn.max_reserved <= 120
+    assert len(rows) == 6 and s.spent == 6 * 15 and s.reserved == 0
+
+
+def test_per_repo_cap():
+    s = BudgetScheduler(total_budget=10_000, workers=6, per_repo=2)
+    fn = _Track(s, sleep=0.02)
+    s.run([_job(i, f"r{i % 2}", 1) for i in range(24)], fn)
+    assert fn.max_repo <= 2 and fn.max_live > 1
+    assert sorted(fn.ran) == list(range(24))
+
+
+def test_jobs_that_cannot_fit_are_dropped_and_smaller_ones_still_run():
+    s = BudgetScheduler(total_budget=10, workers=2)
+    fn = _Track(s)
+    rows = s.run([_job(0, "a", 6), _job(1, "b", 20), _job(2, "c", 6), _job(3, "d", 3)], fn)
+    assert [r["i"] for r in rows] == [0, 3]
+    assert s.spent == 9 and not s._pending
+    assert not s.may_run(_job(9, "z", 2))
+
+
+def test_results_come_back_in_job_order():
+    for seed in range(3):
+        random.seed(seed)
+        s = BudgetScheduler(total_budget=10_000, workers=5, per_repo=3)
+        rows = s.run([_job(i, f"r{i % 4}", 1) for i in range(40)], _Track(s, sleep=0.01))
+        assert [r["i"] for r in rows] == list(range(40))
+
+
+def test_failing_job_releases_its_reservation():
+    s = BudgetScheduler(total_budget=5, workers=1)
+
+    def fn(job):
+        if job["i"] == 0:
+            raise RuntimeError("boom")
+        return dict(job["row"]), 1
+
+    try:
+        s.run([_job(0, "a", 5)], fn)
+    except RuntimeError:
+        pass
+    assert s.reserved == 0 and s.spent == 0
+    assert [r["i"] for r in s.run([_job(1, "a", 5)], fn)] == [1]
+
+
+def test_prefetcher_hits_and_inline_fallback():
+    calls = []
+    p = Prefetcher(lambda job: calls.append(job["i"]) or job["i"] * 10, workers=2)
+    jobs = [_job(i, "r", 1) for i in range(3)]
+    p.ahead(jobs[:2])
+    time.sleep(0.05)
+    assert [p.get(j) for j in jobs] == [0, 10, 20]
+    assert p.hits == 2 and sorted(calls) == [0, 1, 2]
+    p.close()
@@ -0,0 +1,63 @@
+import json
+
+from build_dataset import keep_run_fields, triage_row
+from store import CandidateLog, DatasetStore
+
+
+def _cand():
+    return {"repo_html_url": "https://github.com/o/r", "notebook_path": "a.ipynb"}
+
+
+def test_retriage_clears_run_fields_only_when_blob_changes(tmp_path):
+    store = DatasetStore(tmp_path / "d.sqlite")
+    ran = dict(repo_url="https://github.com/o/r", notebook_path="a.ipynb", blob_sha="b1", status="ok",
+               runtime_seconds=12, overhead_seconds=1.0, slowest_cell=3, slowest_cell_seconds=9.0,
+               peak_rss_mb=300.0, first_error_seconds=None, predicted_seconds=10.0)
+    store.upsert(ran)
+
+    same = triage_row(_cand(), {"status": "ok"}, ("", "c1", "", "b1"))
+    keep_run_fields(same, store.get("https://github.com/o/r", "a.ipynb"))
+    store.upsert(same)
+    got = store.get("https://github.com/o/r", "a.ipynb")
+    assert got["runtime_seconds"] == 12 and got["peak_rss_mb"] == 300.0 and got["status"] == "ok"
+
+    changed = triage_row(_cand(), {"status": "ok"}, ("", "c2", "", "b2"))
+    keep_run_fields(changed, store.get("https://github.com/o/r", "a.ipynb"))
+    store.upsert(changed)
+    got = store.get("https://github.com/o/r", "a.ipynb")
+    for k in ("runtime_seconds", "overhead_seconds", "slowest_cell", "slowest_cell_seconds",
+              "peak_rss_mb", "first_error_seconds", "predicted_seconds"):
+        assert got[k] is None, k
+    assert got["status"] == "ok" and got["blob_sha"] == "b2"
+
+
+def _c(repo, nb, **kw):
+    return dict(repo_full_name=repo, notebook_path=nb, **kw)
+
+
+def test_candidate_log_dedups_across_reopen(tmp_path):
+    log = CandidateLog(tmp_path / "c.jsonl")
+    assert log.extend([_c("o/r", "a.ipynb"), _c("o/r", "a.ipynb"), _c("o/r", "b.ipynb"), _c("", "x.ipynb")]) == 2
+    log = CandidateLog(tmp_path / "c.jsonl")
+    assert len(log) == 2 and ("o/r", "b.ipynb") in log
+    assert log.extend([_c("o/r", "b.ipynb"), _c("o/s", "a.ipynb")]) == 1
+    assert [c["notebook_path"] for c in log] == ["a.ipynb", "b.ipynb", "a.ipynb"]
+
+
+def test_candidate_log_skips_torn_line(tmp_path):
+    path = tmp_path / "c.jsonl"
+    CandidateLog(path).extend([_c("o/r", "a.ipynb")])
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"repo_full_name": "o/r", "notebook_pa')   # crash mid-write
+    log = CandidateLog(path)
+    assert len(log) == 1
+    assert log.extend([_c("o/r", "b.ipynb")]) == 1
+    assert [c["notebook_path"] for c in CandidateLog(path)] == ["a.ipynb", "b.ipynb"]
+
+
+def test_candidate_log_imports_legacy_json_once(tmp_path):
+    (tmp_path / "c.json").write_text(json.dumps([_c("o/r", "a.ipynb", size_kb=3), _c("o/r", "a.ipynb")]))
+    log = CandidateLog(tmp_path / "c.jsonl")
+    assert len(log) == 1 and next(iter(log))["size_kb"] == 3
+    (tmp_path / "c.json").write_text(json.dumps([_c("o/r", "z.ipynb")]))
+    assert len(CandidateLog(tmp_path / "c.jsonl")) == 1   # the log exists now; legacy file is ignored
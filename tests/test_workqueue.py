@@ -0,0 +1,76 @@
+import time, multiprocessing
+
+from workqueue import WorkQueue
+from store import DatasetStore
+
+N_JOBS, N_PROCS, N_REPOS = 200, 6, 20
+
+
+def _jobs(n=N_JOBS, repos=N_REPOS):
+    return [{"row": {"repo_url": f"r{i % repos}", "notebook_path": f"nb{i:03d}.ipynb"}, "cost": 1} for i in range(n)]
+
+
+def _worker(path, name, out):
+    q = WorkQueue(path, lease_seconds=60)
+    got = []
+    while True:
+        job = q.lease(name, per_repo=1)
+        if job is None:
+            if q.remaining()[0] == 0 and not q.counts().get("leased"):
+                break
+            time.sleep(0.01)
+            continue
+        start = time.monotonic()
+        time.sleep(0.002)
+        got.append((job["repo_url"], job["notebook_path"], start, time.monotonic()))
+        assert q.complete((job["repo_url"], job["notebook_path"]), name, "ok")
+    q.close()
+    out.put(got)
+
+
+def test_processes_never_share_a_lease(tmp_path):
+    path = tmp_path / "q.sqlite"
+    q = WorkQueue(path)
+    assert q.enqueue(_jobs()) == N_JOBS
+    ctx = multiprocessing.get_context("spawn")
+    out = ctx.Queue()
+    procs = [ctx.Process(target=_worker, args=(str(path), f"w{i}", out)) for i in range(N_PROCS)]
+    for p in procs:
+        p.start()
+    results = [out.get(timeout=120) for _ in procs]
+    for p in procs:
+        p.join(timeout=30)
+        assert p.exitcode == 0
+    leases = [r for got in results for r in got]
+    keys = [(r[0], r[1]) for r in leases]
+    assert len(keys) == N_JOBS and len(set(keys)) == N_JOBS   # every job exactly once
+    assert sum(1 for got in results if got) > 1                # the work was actually shared
+    # per_repo=1 across processes: no two runs of one repo overlap.
+    by_repo = {}
+    for repo, _, start, end in leases:
+        by_repo.setdefault(repo, []).append((start, end))
+    for spans in by_repo.values():
+        spans.sort()
+        assert all(a[1] <= b[0] for a, b in zip(spans, spans[1:]))
+    assert q.counts() == {"done": N_JOBS}
+    q.close()
+
+
+def test_release_hands_a_job_back_without_using_an_attempt(tmp_path):
+    q = WorkQueue(tmp_path / "q.sqlite", max_attempts=1)
+    q.enqueue(_jobs(1))
+    job = q.lease("a")
+    key = (job["repo_url"], job["notebook_path"])
+    q.release(key, "a")
+    assert q.counts() == {"queued": 1}
+    again = q.lease("b")
+    assert again["attempts"] == 1 and again["worker"] == "b"
+    assert not q.complete(key, "a", "ok") and q.complete(key, "b", "ok")
+
+
+def test_store_can_use_the_rollback_journal(tmp_path):
+    DatasetStore(tmp_path / "d.sqlite").close()
+    store = DatasetStore(tmp_path / "d.sqlite", wal=False)
+    assert store.conn.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+    store.close()
+    assert not (tmp_path / "d.sqlite-wal").exists()
@@ -1,5 +1,6 @@
-import os, json, pathlib, re, warnings
-from typing import Dict, Any, Tuple, List
+import os, json, time, pathlib, warnings, tracemalloc
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, Any, Tuple, List, Callable, Optional, Iterator
 
 warnings.filterwarnings("ignore", category=UserWarning, module="nbformat")
 
@@ -9,14 +10,19 @@ try:
     from jsonschema.exceptions import ValidationError
 except Exception:  # fallback if jsonschema import path differs
     class ValidationError(Exception): ...
-from utils import detect_libs, find_relative_paths
+from utils import scan_notebook
+from deps import analyze, notebook_sources, requirements_lines
+from envs import base_provided
+from nbstream import read_code_cells
+from repos import RepoIndex, SparseCheckout
 
 HERE = pathlib.Path(__file__).resolve().parent
 WORK = HERE / "work"; WORK.mkdir(exist_ok=True)
 ART = HERE / "artifacts"; ART.mkdir(exist_ok=True)
 
+TRIAGE_CACHE = ART / "triage_cache.jsonl"
+
 HEAVY_LIBS = {"torch", "tensorflow", "transformers"}
-CUDA_PAT = re.compile(r"\b(cuda|torch\.cuda|device\s*=\s*['\"]cuda)", re.I)
 
 
 def _safe_read_nb_from_text(raw: str) -> Tuple[Any, str]:
@@ -41,10 +47,49 @@ def _concat_code_from_cells(nb) -> str:
     return "\n".join(parts)
 
 
-def triage_notebook(nb_path: str, repo_root: str) -> Dict[str, Any]:
+def _data_paths(rels: List[str], nb_dir: pathlib.Path, repo_root: pathlib.Path, index: Optional[RepoIndex],
+                exists: Callable[[pathlib.Path], bool]) -> Tuple[List[str], List[str]]:
+    """
+    (missing, elsewhere) for a notebook's relative data paths. A path counts
+    as present when it resolves from the notebook's directory, the cwd it
+    runs in. For a missing path, `elsewhere` records where it does exist:
+    relative to the repo root, or the same file name in another directory.
+    """
+    missing, elsewhere = [], []
+    base = index.rel(nb_dir) if index is not None else None
+    for rp in rels:
+        if index is not None and base is not None:
+            if index.find(rp, base) is not None:
+                continue
+            missing.append(rp)
+            alt = (index.find(rp) if base else None) or next(iter(index.elsewhere(rp, limit=1)), None)
+            if alt:
+                elsewhere.append(f"{rp}=>{alt}")
+            continue
+        try:
+            cand = (nb_dir / rp).resolve()
+            if not str(cand).startswith(str(repo_root)) or not exists(cand):
+                missing.append(rp)
+        except Exception:
+            missing.append(rp)
+    return missing, elsewhere
+
+
+def triage_notebook(nb_path: str, repo_root: str,
+                    exists: Optional[Callable[[pathlib.Path], bool]] = None,
+                    stream: bool = True, index: Optional[RepoIndex] = None,
+                    trace_mem: bool = False) -> Dict[str, Any]:
     """
     Robust triage: never raises. Returns a dict with consistent keys.
+    `index` is the repo's RepoIndex (shared by its notebooks; a
+    SparseCheckout fetches paths of a sparse clone on demand); without one,
+    data paths are checked on disk with `exists` (default Path.exists).
+    With `stream`, cells are read by nbstream (outputs skipped) and nbformat is
+    only used when that fails; `parser` and `parse_ms` record which ran and how long.
+    With `trace_mem`, `parse_peak_kb` is the parse's peak Python heap
+    (tracemalloc, which also inflates `parse_ms`); otherwise it is None.
     """
+    exists = exists or (index.exists if index is not None else pathlib.Path.exists)
     p = pathlib.Path(nb_path)
     repo_root = pathlib.Path(repo_root).resolve()
 
@@ -55,14 +100,21 @@ def triage_notebook(nb_path: str, repo_root: str) -> Dict[str, Any]:
         libs_detected="",
         has_relative_data_paths=False,
         missing_paths="",
+        data_elsewhere="",
         suspect_cuda=False,
         has_heavy_libs=False,
+        install_pkgs="",
+        blocked_imports="",
+        unknown_imports="",
         keep_candidate=False,
         path=str(p),
         repo_root=str(repo_root),
         error_type="",
         error_message="",
         sample="",
+        parser="",
+        parse_ms=0.0,
+        parse_peak_kb=None,
     )
 
     if (not p.exists()) or (not p.is_file()):
@@ -75,8 +127,8 @@ def triage_notebook(nb_path: str, repo_root: str) -> Dict[str, Any]:
         result["status"] = "skip_empty"
         return result
 
-    raw = p.read_text(encoding="utf-8", errors="ignore")
-    head = raw.lstrip()[:200]
+    with open(p, "rb") as f:
+        head = f.read(4096).decode("utf-8", errors="ignore").lstrip()[:200]
     result["sample"] = head
 
     if head.startswith("version https://git-lfs.github.com/spec/v1"):
@@ -87,7 +139,25 @@ def triage_notebook(nb_path: str, repo_root: str) -> Dict[str, Any]:
         result["status"] = "skip_html_notebook"
         return result
 
-    nb, load_err = _safe_read_nb_from_text(raw)
+    own_trace = trace_mem and not tracemalloc.is_tracing()
+    if own_trace:
+        tracemalloc.start()
+    if trace_mem:
+        tracemalloc.reset_peak()
+        heap0 = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    nb = read_code_cells(str(p)) if stream else None
+    if nb is not None:
+        result["parser"] = "stream"
+    else:
+        result["parser"] = "nbformat"
+        raw = p.read_text(encoding="utf-8", errors="ignore")
+        nb, load_err = _safe_read_nb_from_text(raw)
+    result["parse_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    if trace_mem:
+        result["parse_peak_kb"] = max(0, tracemalloc.get_traced_memory()[1] - heap0) // 1024
+        if own_trace:
+            tracemalloc.stop()
     if nb is None:
         result.update(
             status="invalid",
@@ -97,48 +167,33 @@ def triage_notebook(nb_path: str, repo_root: str) -> Dict[str, Any]:
         return result
 
     try:
-        libs = detect_libs(nb)
+        scan = scan_notebook(nb)
     except Exception as e:
-        libs = []
+        scan = dict(libs=[], rel_paths=[], suspect_cuda=False, n_code_cells=0)
         result["error_type"] = result["error_type"] or type(e).__name__
         result["error_message"] = (result["error_message"] or str(e))[:500]
+    libs, rels = scan["libs"], scan["rel_paths"]
 
-    try:
-        rels = find_relative_paths(nb)
-    except Exception as e:
-        rels = []
-        result["error_type"] = result["error_type"] or type(e).__name__
-        result["error_message"] = (result["error_message"] or str(e))[:500]
+    missing, elsewhere = _data_paths(rels, p.parent.resolve(), repo_root, index, exists)
 
-    missing = []
-    for rp in rels:
-        try:
-            cand = (repo_root / rp).resolve()
-
-            if not str(cand).startswith(str(repo_root)) or not cand.exists():
-                missing.append(rp)
-        except Exception:
-            missing.append(rp)
-
-    src_all = _concat_code_from_cells(nb)
-    suspect_cuda = bool(CUDA_PAT.search(src_all))
+    suspect_cuda = scan["suspect_cuda"]
 
     has_heavy_libs = bool(set(libs) & HEAVY_LIBS)
 
+    n_code_cells = scan["n_code_cells"]
+
     try:
-        n_code_cells = sum(
-            1 for c in getattr(nb, "cells", [])
-            if (isinstance(c, dict) and c.get("cell_type") == "code") or
-               (hasattr(c, "cell_type") and getattr(c, "cell_type") == "code")
-        )
+        deps = analyze(notebook_sources(nb), [p.parent.resolve(), repo_root],
+                       provided=base_provided() + requirements_lines(repo_root), exists=exists)
     except Exception:
-        n_code_cells = 0
+        deps = dict(install=[], blocked=[], unknown=[], installable=True)
 
     keep_candidate = (
         (result["size_kb"] <= 500) and
         (n_code_cells <= 60) and
         (not suspect_cuda) and
-        (not has_heavy_libs)
+        (not has_heavy_libs) and
+        deps["installable"]
     )
 
     result.update(
@@ -147,8 +202,113 @@ def triage_notebook(nb_path: str, repo_root: str) -> Dict[str, Any]:
         libs_detected=";".join(libs),
         has_relative_data_paths=bool(rels),
         missing_paths=";".join(sorted(set(missing))) if missing else "",
+        data_elsewhere=";".join(sorted(set(elsewhere))),
         suspect_cuda=suspect_cuda,
         has_heavy_libs=has_heavy_libs,
+        install_pkgs=";".join(deps["install"]),
+        blocked_imports=";".join(deps["blocked"]),
+        unknown_imports=";".join(deps["unknown"]),
         keep_candidate=keep_candidate,
     )
     return result
+
+
+
+# (index, notebook path, repo root)
+TriageItem = Tuple[int, str, str]
+
+
+def triage_batch(items: List[TriageItem], sparse: bool = False,
+                 trace_mem: bool = False) -> List[Tuple[int, Dict[str, Any]]]:
+    """
+    Triage a batch in one process. Keep each repo's notebooks in one batch:
+    sparse checkouts are materialized with git, which must not race.
+    """
+    views: Dict[str, Optional[RepoIndex]] = {}
+    out = []
+    for idx, nb_path, repo_root in items:
+        if repo_root not in views:
+            try:
+                views[repo_root] = (SparseCheckout if sparse else RepoIndex)(pathlib.Path(repo_root))
+            except Exception:
+                views[repo_root] = None   # checked on disk instead
+        out.append((idx, triage_notebook(nb_path, repo_root, index=views[repo_root], trace_mem=trace_mem)))
+    return out
+
+
+def _chunks_by_repo(items: List[TriageItem], chunk_size: int) -> List[List[TriageItem]]:
+    by_repo: Dict[str, List[TriageItem]] = {}
+    for it in items:
+        by_repo.setdefault(it[2], []).append(it)
+    chunks: List[List[TriageItem]] = []
+    cur: List[TriageItem] = []
+    for group in by_repo.values():
+        if cur and len(cur) + len(group) > chunk_size:
+            chunks.append(cur); cur = []
+        cur.extend(group)
+    if cur:
+        chunks.append(cur)
+    return chunks
+
+
+def triage_parallel(items: List[TriageItem], jobs: int = 1, sparse: bool = False,
+                    chunk_size: int = 16, trace_mem: bool = False) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """
+    Fan triage out over a process pool in per-repo chunks of about `chunk_size`
+    notebooks, yielding (index, result) as each chunk completes.
+    """
+    chunks = _chunks_by_repo(items, max(1, chunk_size))
+    if jobs <= 1 or len(chunks) <= 1:
+        for ch in chunks:
+            yield from triage_batch(ch, sparse, trace_mem)
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as ex:
+        futs = [ex.submit(triage_batch, ch, sparse, trace_mem) for ch in chunks]
+        for f in as_completed(futs):
+            yield from f.result()
+
+class TriageCache:
+    """
+    Append-only JSONL of triage results keyed on (repo, commit SHA, notebook
+    path, blob SHA). Each result is flushed as soon as it is produced, so an
+    interrupted triage resumes after the last notebook it finished.
+    """
+
+    def __init__(self, path: pathlib.Path = TRIAGE_CACHE):
+        self.path = path
+        self._rows: Dict[Tuple[str, ...], Dict[str, Any]] = {}
+        self._fh = None
+        if path.exists():
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                        self._rows[tuple(rec["key"])] = rec["tri"]
+                    except (ValueError, KeyError, TypeError):
+                        continue  # torn line from a crash mid-write
+
+    def __len__(self):
+        return len(self._rows)
+
+    def get(self, key: Tuple[str, ...]) -> Optional[Dict[str, Any]]:
+        return self._rows.get(tuple(key))
+
+    def put(self, key: Tuple[str, ...], tri: Dict[str, Any]):
+        tri = {k: v for k, v in tri.items() if k != "sample"}
+        self._rows[tuple(key)] = tri
+        if self._fh is None:
+            needs_nl = False
+            if self.path.exists() and self.path.stat().st_size > 0:
+                with open(self.path, "rb") as f:
+                    f.seek(-1, os.SEEK_END)
+                    needs_nl = f.read(1) != b"\n"
+            self._fh = open(self.path, "a", encoding="utf-8")
+            if needs_nl:
+                self._fh.write("\n")
+        self._fh.write(json.dumps({"key": list(key), "tri": tri}) + "\n")
+        self._fh.flush()
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
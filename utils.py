@@ -1,43 +1,47 @@
-import os, re, json, subprocess, pathlib,venv
-from typing import List, Dict, Any, Tuple
+import os, re, pathlib,venv
+from typing import List, Dict, Any, Optional, Tuple
+
+from limits import run_limited, TAIL_BYTES
 
 HERE = pathlib.Path(__file__).resolve().parent
 ART = HERE / "artifacts"
 ART.mkdir(exist_ok=True)
 
-def run(cmd: List[str], cwd=None, env=None, timeout=None) -> Tuple[int, str, str]:
-    p = subprocess.Popen(cmd, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    try:
-        out, err = p.communicate(timeout=timeout)
-    except subprocess.TimeoutExpired:
-        p.kill()
-        out, err = p.communicate()
-        return 124, out, err
-    return p.returncode, out, err
+def run(cmd: List[str], cwd=None, env=None, timeout=None, log_path=None,
+        tail: Optional[int] = TAIL_BYTES) -> Tuple[int, str, str]:
+    """
+    (returncode, stdout, stderr); rc 124 on timeout, after killing the whole
+    process tree. Only the last `tail` bytes of each stream are kept (see
+    limits.run_limited); callers that parse all of stdout, like git ls-tree,
+    pass tail=None.
+    """
+    rc, out, err, _ = run_limited(cmd, timeout=timeout, cwd=cwd, env=env, log_path=log_path, tail=tail)
+    return rc, out, err
 
 def slug(s: str) -> str:
     return re.sub(r"[^A-Za-z0-9_.-]+", "-", s)[:200]
 
+LIB_PATS = {
+    "sklearn": r"\bfrom\s+sklearn\b|\bimport\s+sklearn\b",
+    "tensorflow": r"\bimport\s+tensorflow\b|\bfrom\s+tensorflow\b",
+    "torch": r"\bimport\s+torch\b|\bfrom\s+torch\b",
+    "xgboost": r"\bimport\s+xgboost\b",
+    "lightgbm": r"\bimport\s+lightgbm\b",
+    "transformers": r"\bfrom\s+transformers\b|\bimport\s+transformers\b",
+    "catboost": r"\bimport\s+catboost\b",
+    "statsmodels": r"\bimport\s+statsmodels\b",
+    "pandas": r"\bimport\s+pandas\b|\bfrom\s+pandas\b",
+    "matplotlib": r"\bimport\s+matplotlib\b|\bfrom\s+matplotlib\b",
+    "seaborn": r"\bimport\s+seaborn\b",
+}
+
 def detect_libs(nb_json: Dict[str, Any]) -> List[str]:
     libs = set()
-    pats = {
-        "sklearn": r"\bfrom\s+sklearn\b|\bimport\s+sklearn\b",
-        "tensorflow": r"\bimport\s+tensorflow\b|\bfrom\s+tensorflow\b",
-        "torch": r"\bimport\s+torch\b|\bfrom\s+torch\b",
-        "xgboost": r"\bimport\s+xgboost\b",
-        "lightgbm": r"\bimport\s+lightgbm\b",
-        "transformers": r"\bfrom\s+transformers\b|\bimport\s+transformers\b",
-        "catboost": r"\bimport\s+catboost\b",
-        "statsmodels": r"\bimport\s+statsmodels\b",
-        "pandas": r"\bimport\s+pandas\b|\bfrom\s+pandas\b",
-        "matplotlib": r"\bimport\s+matplotlib\b|\bfrom\s+matplotlib\b",
-        "seaborn": r"\bimport\s+seaborn\b",
-    }
     for cell in nb_json.get("cells", []):
         if cell.get("cell_type") != "code":
             continue
         src = "".join(cell.get("source", []))
-        for name, pat in pats.items():
+        for name, pat in LIB_PATS.items():
             if re.search(pat, src):
                 libs.add(name)
     return sorted(libs)
@@ -62,6 +66,43 @@ def find_relative_paths(nb_json):
             hits.append(p)
     return hits
 
+CUDA_PAT = re.compile(r"\b(cuda|torch\.cuda|device\s*=\s*['\"]cuda)", re.I)
+
+# --- single-pass scanner ----------------------------------------------------
+# Code cells are joined with a separator none of the patterns can match
+# across: \s runs and words stop at the \x00 (the path capture excludes it
+# explicitly) and . stops at the \n, so one pass of each precompiled
+# pattern over the buffer equals the per-cell scans above.
+_CELL_SEP = "\n\x00\n"
+
+def _lib_scan_pat():
+    alts: Dict[str, List[str]] = {"import": [], "from": []}
+    for pat in LIB_PATS.values():
+        for kw, mod in re.findall(r"\\b(import|from)\\s\+(\w+)\\b", pat):
+            alts[kw].append(mod)
+    return re.compile(r"\bimport\s+(%s)\b|\bfrom\s+(%s)\b" % ("|".join(alts["import"]), "|".join(alts["from"])))
+
+LIB_SCAN_PAT = _lib_scan_pat()
+REL_SCAN_PAT = re.compile(REL_PATH_PAT.pattern.replace("""([^'"]+)""", r"""([^'"\x00]+)"""), re.X)
+
+def scan_notebook(nb_json) -> Dict[str, Any]:
+    """
+    One walk over a notebook's code cells. Returns libs (as detect_libs),
+    rel_paths (as find_relative_paths), suspect_cuda (CUDA_PAT) and n_code_cells.
+    """
+    srcs = []
+    for cell in nb_json.get("cells", []):
+        if cell.get("cell_type") != "code":
+            continue
+        src = cell.get("source", "")
+        srcs.append(src if isinstance(src, str) else "".join(src))
+    code = _CELL_SEP.join(srcs)
+    libs = {m.group(1) or m.group(2) for m in LIB_SCAN_PAT.finditer(code)}
+    rels = [m.group(1) for m in REL_SCAN_PAT.finditer(code)
+            if not m.group(1).startswith(("http://", "https://", "s3://"))]
+    return dict(libs=sorted(libs), rel_paths=rels, suspect_cuda=bool(CUDA_PAT.search(code)),
+                n_code_cells=len(srcs))
+
 def clone_repo(repo_full_name: str, dest: pathlib.Path):
     url = f"https://github.com/{repo_full_name}.git"
     rc, out, err = run(["git", "clone", "--depth", "1", url, str(dest)])
@@ -0,0 +1,202 @@
+"""
+Shared work queue for `build_dataset.py worker`.
+
+`enqueue` puts the runnable notebooks in a SQLite table in schedule order;
+any number of worker processes, on this or other hosts sharing the
+directory, then lease one notebook at a time. A lease expires unless its
+holder renews it (Heartbeat), so a notebook whose worker crashed or lost
+its host is handed out again; after `max_attempts` leases it is parked as
+failed instead of taking down worker after worker. Results go to the
+central DatasetStore as each notebook finishes.
+
+SQLite over a network filesystem needs working POSIX locks; WAL mode needs
+shared memory, so the queue uses the rollback journal.
+"""
+import time, sqlite3, pathlib, threading
+from typing import Any, Dict, List, Optional, Tuple
+
+HERE = pathlib.Path(__file__).resolve().parent
+QUEUE_PATH = HERE / "work_queue.sqlite"
+LEASE_SECONDS = 120
+MAX_ATTEMPTS = 3
+
+Key = Tuple[str, str]   # (repo_url, notebook_path), as in the dataset store
+
+
+class WorkQueue:
+    """
+    jobs(repo_url, notebook_path) with a priority (lower runs first), the
+    seconds to reserve for the run (cost) and a state: queued, leased, done
+    or failed. A leased job whose lease_until has passed counts as queued.
+    """
+
+    def __init__(self, path: pathlib.Path = QUEUE_PATH, lease_seconds: int = LEASE_SECONDS,
+                 max_attempts: int = MAX_ATTEMPTS):
+        self.path = pathlib.Path(path)
+        self.lease_seconds, self.max_attempts = int(lease_seconds), int(max_attempts)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None, timeout=60)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=DELETE")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            repo_url TEXT, notebook_path TEXT, priority REAL, cost INTEGER, pred REAL,
+            state TEXT, worker TEXT, lease_until REAL, attempts INTEGER DEFAULT 0,
+            status TEXT, enqueued_at REAL, finished_at REAL,
+            PRIMARY KEY (repo_url, notebook_path))""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, priority)")
+
+    def _tx(self, fn):
+        """Run fn() in one IMMEDIATE transaction: the write lock is taken up front, so two hosts never lease the same job."""
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                out = fn()
+                self.conn.execute("COMMIT")
+                return out
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def enqueue(self, jobs: List[Dict[str, Any]], requeue: bool = False) -> int:
+        """
+        Add jobs ({"row", "cost", "pred"?}) with priority = position in the
+        list. Jobs already known are left alone, unless requeue, which puts
+        finished and failed ones back. Returns how many were (re)queued.
+        """
+        now = time.time()
+
+        def go():
+            n = 0
+            for i, job in enumerate(jobs):
+                row = job["row"]
+                cur = self.conn.execute(
+                    "INSERT INTO jobs (repo_url, notebook_path, priority, cost, pred, state, attempts, enqueued_at) "
+                    "VALUES (?, ?, ?, ?, ?, 'queued', 0, ?) ON CONFLICT (repo_url, notebook_path) DO "
+                    + ("UPDATE SET priority=excluded.priority, cost=excluded.cost, pred=excluded.pred, state='queued', "
+                       "attempts=0, worker=NULL, lease_until=NULL, status=NULL, enqueued_at=excluded.enqueued_at "
+                       "WHERE state IN ('done', 'failed', 'queued')" if requeue else "NOTHING"),
+                    (row["repo_url"], row["notebook_path"], i, int(job["cost"]), job.get("pred"), now))
+                n += cur.rowcount
+            return n
+        return self._tx(go)
+
+    def lease(self, worker: str, per_repo: int = 1, fits=None) -> Optional[Dict[str, Any]]:
+        """
+        Lease the first queued (or expired) job whose repo has fewer than
+        per_repo live leases and for which fits(job) is true; None when
+        nothing is left. Jobs leased max_attempts times are marked failed.
+        """
+        def go():
+            now = time.time()
+            self.conn.execute("UPDATE jobs SET state='failed', status='worker_lost', worker=NULL, finished_at=? "
+                              "WHERE state='leased' AND lease_until < ? AND attempts >= ?",
+                              (now, now, self.max_attempts))
+            busy: Dict[str, int] = {}
+            for r in self.conn.execute("SELECT repo_url, COUNT(*) n FROM jobs WHERE state='leased' AND lease_until >= ? "
+                                       "GROUP BY repo_url", (now,)):
+                busy[r["repo_url"]] = r["n"]
+            for r in self.conn.execute("SELECT * FROM jobs WHERE state='queued' OR (state='leased' AND lease_until < ?) "
+                                       "ORDER BY priority", (now,)):
+                job = dict(r)
+                if busy.get(job["repo_url"], 0) >= per_repo or (fits is not None and not fits(job)):
+                    continue
+                self.conn.execute("UPDATE jobs SET state='leased', worker=?, lease_until=?, attempts=attempts+1 "
+                                  "WHERE repo_url=? AND notebook_path=?",
+                                  (worker, now + self.lease_seconds, job["repo_url"], job["notebook_path"]))
+                job.update(state="leased", worker=worker, attempts=job["attempts"] + 1)
+                return job
+            return None
+        return self._tx(go)
+
+    def renew(self, key: Key, worker: str) -> bool:
+        """Extend a lease; False if the worker no longer holds it (it expired and was handed out again)."""
+        with self._lock:
+            cur = self.conn.execute("UPDATE jobs SET lease_until=? WHERE repo_url=? AND notebook_path=? "
+                                    "AND state='leased' AND worker=?",
+                                    (time.time() + self.lease_seconds, key[0], key[1], worker))
+        return cur.rowcount == 1
+
+    def complete(self, key: Key, worker: str, status: str) -> bool:
+        """Mark a leased job done; False if the lease had been lost meanwhile."""
+        with self._lock:
+            cur = self.conn.execute("UPDATE jobs SET state='done', status=?, finished_at=?, lease_until=NULL "
+                                    "WHERE repo_url=? AND notebook_path=? AND state='leased' AND worker=?",
+                                    (status, time.time(), key[0], key[1], worker))
+        return cur.rowcount == 1
+
+    def release(self, key: Key, worker: str):
+        """Hand a leased job back untouched (e.g. the worker is shutting down before running it)."""
+        with self._lock:
+            self.conn.execute("UPDATE jobs SET state='queued', worker=NULL, lease_until=NULL, attempts=MAX(0, attempts-1) "
+                              "WHERE repo_url=? AND notebook_path=? AND state='leased' AND worker=?",
+                              (key[0], key[1], worker))
+
+    def pending(self, repo_url: str) -> int:
+        """Queued jobs of a repo (whether a warm kernel for it is worth keeping)."""
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM jobs WHERE repo_url=? AND state='queued'",
+                                     (repo_url,)).fetchone()[0]
+
+    def remaining(self) -> Tuple[int, Optional[int]]:
+        """(jobs available to lease now, the smallest cost among them)."""
+        with self._lock:
+            r = self.conn.execute("SELECT COUNT(*), MIN(cost) FROM jobs WHERE state='queued' "
+                                  "OR (state='leased' AND lease_until < ?)", (time.time(),)).fetchone()
+        return r[0], r[1]
+
+    def counts(self) -> Dict[str, int]:
+        now = time.time()
+        with self._lock:
+            rows = self.conn.execute("SELECT CASE WHEN state='leased' AND lease_until < ? THEN 'expired' ELSE state END s, "
+                                     "COUNT(*) n FROM jobs GROUP BY s", (now,)).fetchall()
+        return {r["s"]: r["n"] for r in rows}
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+class Heartbeat:
+    """Renews every lease a worker process holds each lease_seconds/3 until stopped."""
+
+    def __init__(self, queue: WorkQueue):
+        self.queue = queue
+        self.held: Dict[Key, str] = {}
+        self.lost = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="lease-heartbeat", daemon=True)
+
+    def start(self) -> "Heartbeat":
+        self._thread.start()
+        return self
+
+    def hold(self, key: Key, worker: str):
+        with self._lock:
+            self.held[key] = worker
+
+    def drop(self, key: Key):
+        with self._lock:
+            self.held.pop(key, None)
+
+    def holding(self) -> List[Tuple[Key, str]]:
+        with self._lock:
+            return list(self.held.items())
+
+    def _loop(self):
+        while not self._stop.wait(max(1.0, self.queue.lease_seconds / 3)):
+            for key, worker in self.holding():
+                try:
+                    ok = self.queue.renew(key, worker)
+                except sqlite3.Error as e:
+                    print(f"⚠️ Lease renewal failed for {key[1]}: {e}")
+                    continue
+                if not ok:
+                    print(f"⚠️ Lost the lease on {key[0]} :: {key[1]}; another worker may run it too")
+                    with self._lock:
+                        self.lost += 1
+                        self.held.pop(key, None)
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()